@@ -11,7 +11,11 @@ from qhub.cli.destroy import create_destroy_subcommand
 from qhub.cli.support import create_support_subcommand
 from qhub.cli.upgrade import create_upgrade_subcommand
 from qhub.cli.keycloak import create_keycloak_subcommand
+from qhub.cli.profile import create_profile_subcommand
+from qhub.cli.fleet import create_fleet_subcommand
 from qhub.provider.terraform import TerraformException
+from qhub.stages.checks import CheckException
+from qhub.tracing import TRACE_FILE_ENVIRONMENT_VARIABLE, trace
 from qhub.version import __version__
 from qhub.utils import QHUB_GH_BRANCH
 
@@ -25,9 +29,14 @@ def cli(args):
         version=__version__,
         help="QHub version number",
     )
+    parser.add_argument(
+        "--trace",
+        metavar="FILENAME",
+        help=f"Export an OpenTelemetry (OTLP json) trace of the command, defaults to ${TRACE_FILE_ENVIRONMENT_VARIABLE}",
+    )
     parser.set_defaults(func=None)
 
-    subparser = parser.add_subparsers(help=f"QHub - {__version__}")
+    subparser = parser.add_subparsers(help=f"QHub - {__version__}", dest="command")
     create_deploy_subcommand(subparser)
     create_render_subcommand(subparser)
     create_init_subcommand(subparser)
@@ -36,6 +45,8 @@ def cli(args):
     create_support_subcommand(subparser)
     create_upgrade_subcommand(subparser)
     create_keycloak_subcommand(subparser)
+    create_profile_subcommand(subparser)
+    create_fleet_subcommand(subparser)
 
     args = parser.parse_args(args)
 
@@ -49,7 +60,8 @@ def cli(args):
         logging.info(f"Modifying for development branch {QHUB_GH_BRANCH}")
 
     try:
-        args.func(args)
+        with trace(args.command, args.trace):
+            args.func(args)
     except ValidationError as valerr:
         sys.exit(
             "Error: The schema validation of the qhub-config.yaml failed."
@@ -60,3 +72,5 @@ def cli(args):
         sys.exit("\nProblem encountered: " + str(ve) + "\n")
     except TerraformException:
         sys.exit("\nProblem encountered: Terraform error\n")
+    except CheckException as ce:
+        sys.exit("\nProblem encountered: " + str(ce) + "\n")
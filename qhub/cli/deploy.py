@@ -1,10 +1,12 @@
 import pathlib
 import logging
+import sys
 
 from qhub.deploy import deploy_configuration
 from qhub.schema import verify
 from qhub.render import render_template
-from qhub.utils import load_yaml
+from qhub.profile import profile
+from qhub.utils import load_yaml, timer
 
 logger = logging.getLogger(__name__)
 
@@ -40,27 +42,74 @@ def create_deploy_subcommand(subparser):
         action="store_true",
         help="Disable auto-rendering in deploy stage",
     )
+    subparser.add_argument(
+        "--terraform-upgrade",
+        action="store_true",
+        help="Always run `terraform init -upgrade` instead of skipping init for stages whose providers, modules and backend are unchanged",
+    )
+    subparser.add_argument(
+        "--force-stage",
+        action="append",
+        dest="force_stages",
+        metavar="STAGE",
+        help="Apply the given stage (e.g. `07`, `07-kubernetes-services` or `all`) even if unchanged since its last deployment, may be repeated",
+    )
+    subparser.add_argument(
+        "--plan",
+        action="store_true",
+        dest="terraform_plan",
+        help="Run `terraform plan` for each stage first and only apply stages with changes",
+    )
+    subparser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only plan each stage against the existing deployment and report the planned changes, exits with 2 when there are changes",
+    )
+    subparser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a previously failed deployment at the first stage which is incomplete or changed, reusing the recorded outputs of the stages before it",
+    )
+    subparser.add_argument(
+        "--profile",
+        metavar="FILENAME",
+        help="Write the duration of every phase to a json profile, see `qhub profile compare`",
+    )
     subparser.set_defaults(func=handle_deploy)
 
 
 def handle_deploy(args):
-    config_filename = pathlib.Path(args.config)
-    if not config_filename.is_file():
-        raise ValueError(
-            f"passed in configuration filename={config_filename} must exist"
-        )
+    with profile("deploy", args.profile):
+        config_filename = pathlib.Path(args.config)
+        if not config_filename.is_file():
+            raise ValueError(
+                f"passed in configuration filename={config_filename} must exist"
+            )
 
-    config = load_yaml(config_filename)
+        config = load_yaml(config_filename)
 
-    verify(config)
+        with timer(logger, "verify"):
+            verify(config)
 
-    if not args.disable_render:
-        render_template(args.output, args.config, force=True)
+        if not args.disable_render:
+            with timer(logger, "render"):
+                render_template(args.output, args.config, force=True)
 
-    deploy_configuration(
-        config,
-        args.dns_provider,
-        args.dns_auto_provision,
-        args.disable_prompt,
-        args.skip_remote_state_provision,
-    )
+        plan_summaries = deploy_configuration(
+            config,
+            args.dns_provider,
+            args.dns_auto_provision,
+            args.disable_prompt,
+            args.skip_remote_state_provision,
+            terraform_upgrade=args.terraform_upgrade,
+            force_stages=args.force_stages,
+            terraform_plan=args.terraform_plan,
+            dry_run=args.dry_run,
+            resume=args.resume,
+        )
+
+        # mirror `terraform plan -detailed-exitcode`
+        if args.dry_run and any(
+            any(summary.values()) for summary in plan_summaries.values()
+        ):
+            sys.exit(2)
@@ -4,7 +4,8 @@ import logging
 from qhub.destroy import destroy_configuration
 from qhub.schema import verify
 from qhub.render import render_template
-from qhub.utils import load_yaml
+from qhub.profile import profile
+from qhub.utils import load_yaml, timer
 
 logger = logging.getLogger(__name__)
 
@@ -18,21 +19,34 @@ def create_destroy_subcommand(subparser):
         action="store_true",
         help="Disable auto-rendering before destroy",
     )
+    subparser.add_argument(
+        "--import-state",
+        action="store_true",
+        help="Import the resources of the terraform state stage before destroying, required when its local terraform state was lost",
+    )
+    subparser.add_argument(
+        "--profile",
+        metavar="FILENAME",
+        help="Write the duration of every phase to a json profile, see `qhub profile compare`",
+    )
     subparser.set_defaults(func=handle_destroy)
 
 
 def handle_destroy(args):
-    config_filename = pathlib.Path(args.config)
-    if not config_filename.is_file():
-        raise ValueError(
-            f"passed in configuration filename={config_filename} must exist"
-        )
+    with profile("destroy", args.profile):
+        config_filename = pathlib.Path(args.config)
+        if not config_filename.is_file():
+            raise ValueError(
+                f"passed in configuration filename={config_filename} must exist"
+            )
 
-    config = load_yaml(config_filename)
+        config = load_yaml(config_filename)
 
-    verify(config)
+        with timer(logger, "verify"):
+            verify(config)
 
-    if not args.disable_render:
-        render_template(args.output, args.config, force=True)
+        if not args.disable_render:
+            with timer(logger, "render"):
+                render_template(args.output, args.config, force=True)
 
-    destroy_configuration(config)
+        destroy_configuration(config, terraform_import=args.import_state)
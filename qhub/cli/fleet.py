@@ -0,0 +1,61 @@
+import logging
+import sys
+
+from qhub.fleet import (
+    DEFAULT_MAX_PARALLEL,
+    FLEET_ACTIONS,
+    FLEET_REPORT_FILENAME,
+    run_fleet,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_fleet_subcommand(subparser):
+    subparser = subparser.add_parser("fleet")
+    subparser.add_argument(
+        "fleet_action",
+        choices=sorted(FLEET_ACTIONS),
+        help="qhub command to run for each configuration",
+    )
+    subparser.add_argument(
+        "configs", nargs="+", metavar="CONFIG", help="qhub configuration yaml files"
+    )
+    subparser.add_argument(
+        "-j",
+        "--parallel",
+        type=int,
+        default=DEFAULT_MAX_PARALLEL,
+        help="maximum number of configurations processed at once",
+    )
+    subparser.add_argument(
+        "--output-root",
+        help="create the output directory of each configuration within this directory instead of using the directory of the configuration",
+    )
+    subparser.add_argument(
+        "--report",
+        default=FLEET_REPORT_FILENAME,
+        help="filename of the aggregated json status and timing report",
+    )
+    subparser.add_argument(
+        "--arg",
+        action="append",
+        dest="extra_args",
+        default=[],
+        metavar="ARG",
+        help="additional argument passed to every run e.g. `--arg=--dns-provider=cloudflare`, may be repeated",
+    )
+    subparser.set_defaults(func=handle_fleet)
+
+
+def handle_fleet(args):
+    report = run_fleet(
+        args.fleet_action,
+        args.configs,
+        max_parallel=args.parallel,
+        output_root=args.output_root,
+        extra_args=args.extra_args,
+        report_filename=args.report,
+    )
+    if report["failed"]:
+        sys.exit(1)
@@ -0,0 +1,57 @@
+import logging
+import sys
+
+from qhub.profile import (
+    REGRESSION_MIN_SECONDS,
+    REGRESSION_THRESHOLD,
+    compare_profiles,
+    load_profile,
+    print_comparison,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_profile_subcommand(subparser):
+    subparser = subparser.add_parser("profile")
+    subparser.add_argument(
+        "profile_action",
+        choices=["compare"],
+        help="`compare <base> <new>` the phases of two profiles",
+    )
+    subparser.add_argument("base", help="profile of the baseline run")
+    subparser.add_argument("new", help="profile of the run to compare")
+    subparser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="relative slowdown of a phase to count as a regression",
+    )
+    subparser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=REGRESSION_MIN_SECONDS,
+        help="absolute slowdown in seconds of a phase to count as a regression",
+    )
+    subparser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with status 1 when any phase regressed",
+    )
+    subparser.set_defaults(func=handle_profile)
+
+
+def handle_profile(args):
+    base = load_profile(args.base)
+    new = load_profile(args.new)
+
+    rows = compare_profiles(
+        base, new, threshold=args.threshold, min_seconds=args.min_seconds
+    )
+    print_comparison(rows)
+
+    regressions = [row["phase"] for row in rows if row["regression"]]
+    if regressions:
+        logger.warning(f"{len(regressions)} phases regressed: {regressions}")
+        if args.fail_on_regression:
+            sys.exit(1)
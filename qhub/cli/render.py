@@ -1,8 +1,12 @@
+import logging
 import pathlib
 
 from qhub.render import render_template
 from qhub.schema import verify
-from qhub.utils import load_yaml
+from qhub.profile import profile
+from qhub.utils import load_yaml, timer
+
+logger = logging.getLogger(__name__)
 
 
 def create_render_subcommand(subparser):
@@ -16,18 +20,37 @@ def create_render_subcommand(subparser):
         action="store_true",
         help="simulate rendering files without actually writing or updating any files",
     )
+    subparser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the render manifest and re-hash every output file",
+    )
+    subparser.add_argument(
+        "--profile",
+        metavar="FILENAME",
+        help="Write the duration of every phase to a json profile, see `qhub profile compare`",
+    )
     subparser.set_defaults(func=handle_render)
 
 
 def handle_render(args):
-    config_filename = pathlib.Path(args.config)
-    if not config_filename.is_file():
-        raise ValueError(
-            f"passed in configuration filename={config_filename} must exist"
-        )
-
-    config = load_yaml(config_filename)
-
-    verify(config)
-
-    render_template(args.output, args.config, force=True, dry_run=args.dry_run)
+    with profile("render", args.profile):
+        config_filename = pathlib.Path(args.config)
+        if not config_filename.is_file():
+            raise ValueError(
+                f"passed in configuration filename={config_filename} must exist"
+            )
+
+        config = load_yaml(config_filename)
+
+        with timer(logger, "verify"):
+            verify(config)
+
+        with timer(logger, "render"):
+            render_template(
+                args.output,
+                args.config,
+                force=True,
+                dry_run=args.dry_run,
+                full=args.full,
+            )
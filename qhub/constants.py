@@ -1 +1,2 @@
 TERRAFORM_VERSION = "1.0.5"
+QHUB_STATE_DIRECTORY = ".qhub"
@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Dict
+
+# terraform provider environment variables of each credential
+KUBERNETES_CREDENTIAL_VARIABLES = {
+    "config_path": "KUBE_CONFIG_PATH",
+    "config_context": "KUBE_CTX",
+    "username": "KUBE_USER",
+    "password": "KUBE_PASSWORD",
+    "client_certificate": "KUBE_CLIENT_CERT_DATA",
+    "client_key": "KUBE_CLIENT_KEY_DATA",
+    "cluster_ca_certificate": "KUBE_CLUSTER_CA_CERT_DATA",
+    "host": "KUBE_HOST",
+    "token": "KUBE_TOKEN",
+}
+KEYCLOAK_CREDENTIAL_VARIABLES = {
+    "client_id": "KEYCLOAK_CLIENT_ID",
+    "url": "KEYCLOAK_URL",
+    "username": "KEYCLOAK_USER",
+    "password": "KEYCLOAK_PASSWORD",
+    "realm": "KEYCLOAK_REALM",
+}
+
+
+def kubernetes_credentials_environment(
+    kubernetes_credentials: Dict[str, str]
+) -> Dict[str, str]:
+    return {
+        KUBERNETES_CREDENTIAL_VARIABLES[k]: v
+        for k, v in kubernetes_credentials.items()
+        if v is not None
+    }
+
+
+def keycloak_credentials_environment(
+    keycloak_credentials: Dict[str, str]
+) -> Dict[str, str]:
+    return {
+        KEYCLOAK_CREDENTIAL_VARIABLES[k]: v for k, v in keycloak_credentials.items()
+    }
+
+
+class ExecutionContext:
+    """Environment of the terraform subprocesses of a single deployment
+
+    Starts from a snapshot of `os.environ`, or `env` when given, and
+    collects the kubernetes and keycloak credentials of the deployment
+    as its stages are provisioned. The process environment is never
+    modified, so several contexts, e.g. of different deployments, may be
+    used concurrently. `environment` returns a consistent copy which is
+    passed as `env=` to each subprocess.
+    """
+
+    def __init__(self, env: Dict[str, str] = None):
+        self._env = dict(os.environ if env is None else env)
+        self._lock = threading.Lock()
+
+    def environment(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._env)
+
+    def update(self, variables: Dict[str, str]):
+        with self._lock:
+            self._env.update(variables)
+
+    def add_kubernetes_credentials(self, kubernetes_credentials: Dict[str, str]):
+        self.update(kubernetes_credentials_environment(kubernetes_credentials))
+
+    def add_keycloak_credentials(self, keycloak_credentials: Dict[str, str]):
+        self.update(keycloak_credentials_environment(keycloak_credentials))
@@ -1,37 +1,218 @@
+import functools
+import json
 import logging
 import os
 import textwrap
 import subprocess
+from typing import Any, Dict, List
 
-from qhub.utils import (
-    check_cloud_credentials,
-    timer,
-    kubernetes_provider_context,
-    keycloak_provider_context,
-)
+from qhub.utils import check_cloud_credentials, timer
+from qhub import constants
+from qhub.context import ExecutionContext
 from qhub.stages import checks, state_imports, input_vars
+from qhub.stages.scheduler import DEFAULT_MAX_WORKERS, Scheduler
+from qhub.stages.journal import (
+    STAGE_APPLIED,
+    STAGE_COMPLETE,
+    StageJournal,
+    is_stage_forced,
+    stage_digest,
+)
 from qhub.provider import terraform
 from qhub.provider.dns.cloudflare import update_record
 
 
 logger = logging.getLogger(__name__)
 
+PLAN_SUMMARY_FILENAME = "plan-summary.json"
+
+
+def stage_terraform_directory(stage, config):
+    """Terraform directory of a stage, which for the first two stages is
+    specific to the cloud provider"""
+    if stage in {"stages/01-terraform-state", "stages/02-infrastructure"}:
+        return os.path.join(stage, config["provider"])
+    return stage
+
+
+def stage_names(config):
+    """All rendered stages in deployment order"""
+    stages = [
+        "stages/02-infrastructure",
+        "stages/03-kubernetes-initialize",
+        "stages/04-kubernetes-ingress",
+        "stages/05-kubernetes-keycloak",
+        "stages/06-kubernetes-keycloak-configuration",
+        "stages/07-kubernetes-services",
+        "stages/08-qhub-tf-extensions",
+    ]
+    if config["provider"] != "local" and config["terraform_state"]["type"] == "remote":
+        stages.insert(0, "stages/01-terraform-state")
+    return stages
+
+
+def stage_directories(config):
+    """Terraform directories of all rendered stages in deployment order"""
+    return [stage_terraform_directory(stage, config) for stage in stage_names(config)]
+
+
+def deploy_stage(
+    stage_outputs,
+    stage: str,
+    terraform_directory: str,
+    input_vars: Dict[str, Any],
+    journal: StageJournal = None,
+    force_stages: List[str] = None,
+    refresh_when_unchanged: bool = False,
+    required_files: List[str] = None,
+    resume: bool = False,
+    context: ExecutionContext = None,
+    **kwargs,
+):
+    """Deploy the terraform directory of a stage unless it is unchanged
+
+    A stage is unchanged when its rendered files, `input_vars` and the
+    outputs of all upstream stages match the digest recorded in the
+    `journal` by its last successful deployment. Unchanged stages skip
+    `terraform apply` and only read their outputs from the terraform
+    state, or refresh it first when `refresh_when_unchanged` is set.
+    Stages whose `required_files`, e.g. a kubeconfig written by a
+    `local_file` resource, no longer exist are applied to recreate them.
+    When resuming, unchanged stages which are complete use the outputs
+    recorded in the journal instead. Stages selected by `force_stages`
+    are always applied. Terraform runs with the environment of the
+    `context` when given.
+    """
+    if context is not None:
+        kwargs["env"] = context.environment()
+
+    terraform_apply = kwargs.get("terraform_apply", True)
+    if not terraform_apply:
+        # without an apply the state is not modified by imports either
+        kwargs["terraform_import"] = False
+
+    if journal is None:
+        return terraform.deploy(terraform_directory, input_vars=input_vars, **kwargs)
+
+    upstream_outputs = {k: v for k, v in stage_outputs.items() if k != stage}
+    digest = stage_digest(terraform_directory, input_vars, upstream_outputs)
+
+    missing_files = [_ for _ in required_files or [] if not os.path.exists(_)]
+    if missing_files:
+        print(f"Stage={stage} files={missing_files} missing, applying to recreate")
+
+    if (
+        journal.is_unchanged(stage, digest)
+        and not is_stage_forced(stage, force_stages)
+        and not missing_files
+    ):
+        if resume and not refresh_when_unchanged and journal.is_complete(stage):
+            outputs = journal.outputs(stage)
+            if outputs is not None:
+                print(f"Stage={stage} complete, resuming with recorded outputs")
+                return outputs
+
+        print(f"Stage={stage} unchanged since last deployment, skipping apply")
+        kwargs.update(
+            terraform_import=False, terraform_apply=False, terraform_plan=False
+        )
+        outputs = terraform.deploy(
+            terraform_directory,
+            input_vars=input_vars,
+            terraform_refresh=refresh_when_unchanged,
+            **kwargs,
+        )
+        journal.update_outputs(stage, outputs)
+        return outputs
+
+    if terraform_apply:
+        journal.invalidate(stage)
+    outputs = terraform.deploy(terraform_directory, input_vars=input_vars, **kwargs)
+    if terraform_apply:
+        journal.record(stage, digest, outputs)
+    return outputs
+
+
+def check_stage(
+    stage: str,
+    check_function,
+    stage_outputs,
+    config,
+    check: bool = True,
+    journal: StageJournal = None,
+    resume: bool = False,
+    **kwargs,
+):
+    """Run the checks of a deployed stage and mark it complete in the
+    `journal` once they pass
+
+    When resuming, the checks of stages which are already complete are
+    skipped.
+    """
+    if not check or not kwargs.get("terraform_apply", True):
+        return
+
+    if journal is None:
+        if check_function is not None:
+            with timer(logger, "check", stage=stage):
+                check_function(stage_outputs, config)
+        return
+
+    if resume and journal.is_complete(stage):
+        return
+
+    journal.set_status(stage, STAGE_APPLIED)
+    if check_function is not None:
+        with timer(logger, "check", stage=stage):
+            check_function(stage_outputs, config)
+    journal.set_status(stage, STAGE_COMPLETE)
+
+
+def plan_summary_path(output_directory=None) -> str:
+    return os.path.join(
+        output_directory or os.curdir,
+        constants.QHUB_STATE_DIRECTORY,
+        PLAN_SUMMARY_FILENAME,
+    )
+
+
+def report_plan_summaries(plan_summaries: Dict[str, Dict], filename: str = None):
+    """Print the planned changes of each stage and save them as json to
+    `.qhub/plan-summary.json` within the output directory"""
+    filename = filename or plan_summary_path()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump({"stages": plan_summaries}, f, indent=2, sort_keys=True)
+
+    for directory, summary in plan_summaries.items():
+        print(
+            f"Stage={directory} plan: {len(summary['add'])} to add, "
+            f"{len(summary['change'])} to change, "
+            f"{len(summary['replace'])} to replace, "
+            f"{len(summary['destroy'])} to destroy"
+        )
+    print(f"Plan summary written to {filename}")
+
 
-def provision_01_terraform_state(stage_outputs, config):
+def provision_01_terraform_state(stage_outputs, config, check=True, **kwargs):
     directory = "stages/01-terraform-state"
 
     if config["provider"] == "local":
         stage_outputs[directory] = {}
     else:
-        stage_outputs[directory] = terraform.deploy(
+        stage_outputs[directory] = deploy_stage(
+            stage_outputs,
+            directory,
             terraform_import=True,
-            directory=os.path.join(directory, config["provider"]),
+            terraform_directory=os.path.join(directory, config["provider"]),
             input_vars=input_vars.stage_01_terraform_state(stage_outputs, config),
             state_imports=state_imports.stage_01_terraform_state(stage_outputs, config),
+            **kwargs,
         )
+        check_stage(directory, None, stage_outputs, config, check=check, **kwargs)
 
 
-def provision_02_infrastructure(stage_outputs, config, check=True):
+def provision_02_infrastructure(stage_outputs, config, check=True, **kwargs):
     """Generalized method to provision infrastructure
 
     After succesfull deployment the following properties are set on
@@ -48,37 +229,71 @@ def provision_02_infrastructure(stage_outputs, config, check=True):
     """
     directory = "stages/02-infrastructure"
 
-    stage_outputs[directory] = terraform.deploy(
-        os.path.join(directory, config["provider"]),
-        input_vars=input_vars.stage_02_infrastructure(stage_outputs, config),
+    # short lived kubernetes credentials are only renewed by a refresh,
+    # while the kubeconfig within the temporary directory only by an apply
+    stage_input_vars = input_vars.stage_02_infrastructure(stage_outputs, config)
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=os.path.join(directory, config["provider"]),
+        input_vars=stage_input_vars,
+        refresh_when_unchanged=True,
+        required_files=[
+            _ for _ in [stage_input_vars.get("kubeconfig_filename")] if _ is not None
+        ],
+        **kwargs,
     )
 
-    if check:
-        checks.stage_02_infrastructure(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_02_infrastructure,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
-def provision_03_kubernetes_initialize(stage_outputs, config, check=True):
+def provision_03_kubernetes_initialize(stage_outputs, config, check=True, **kwargs):
     directory = "stages/03-kubernetes-initialize"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_03_kubernetes_initialize(stage_outputs, config),
+        **kwargs,
     )
 
-    if check:
-        checks.stage_03_kubernetes_initialize(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_03_kubernetes_initialize,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
-def provision_04_kubernetes_ingress(stage_outputs, config, check=True):
+def provision_04_kubernetes_ingress(stage_outputs, config, check=True, **kwargs):
     directory = "stages/04-kubernetes-ingress"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_04_kubernetes_ingress(stage_outputs, config),
+        **kwargs,
     )
 
-    if check:
-        checks.stage_04_kubernetes_ingress(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_04_kubernetes_ingress,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
 def add_clearml_dns(zone_name, record_name, record_type, ip_or_hostname):
@@ -132,102 +347,346 @@ def provision_ingress_dns(
         )
 
     if check:
-        checks.check_ingress_dns(stage_outputs, config, disable_prompt)
+        with timer(logger, "dns wait", domain=config["domain"]):
+            checks.check_ingress_dns(stage_outputs, config, disable_prompt)
 
 
-def provision_05_kubernetes_keycloak(stage_outputs, config, check=True):
+def provision_05_kubernetes_keycloak(stage_outputs, config, check=True, **kwargs):
     directory = "stages/05-kubernetes-keycloak"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_05_kubernetes_keycloak(stage_outputs, config),
+        **kwargs,
     )
 
-    if check:
-        checks.stage_05_kubernetes_keycloak(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_05_kubernetes_keycloak,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
-def provision_06_kubernetes_keycloak_configuration(stage_outputs, config, check=True):
+def provision_06_kubernetes_keycloak_configuration(
+    stage_outputs, config, check=True, **kwargs
+):
     directory = "stages/06-kubernetes-keycloak-configuration"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_06_kubernetes_keycloak_configuration(
             stage_outputs, config
         ),
+        **kwargs,
     )
 
-    if check:
-        checks.stage_06_kubernetes_keycloak_configuration(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_06_kubernetes_keycloak_configuration,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
-def provision_07_kubernetes_services(stage_outputs, config, check=True):
+def provision_07_kubernetes_services(stage_outputs, config, check=True, **kwargs):
     directory = "stages/07-kubernetes-services"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_07_kubernetes_services(stage_outputs, config),
+        **kwargs,
     )
 
-    if check:
-        checks.stage_07_kubernetes_services(stage_outputs, config)
+    check_stage(
+        directory,
+        checks.stage_07_kubernetes_services,
+        stage_outputs,
+        config,
+        check=check,
+        **kwargs,
+    )
 
 
-def provision_08_qhub_tf_extensions(stage_outputs, config, check=True):
+def provision_08_qhub_tf_extensions(stage_outputs, config, check=True, **kwargs):
     directory = "stages/08-qhub-tf-extensions"
 
-    stage_outputs[directory] = terraform.deploy(
-        directory=directory,
+    stage_outputs[directory] = deploy_stage(
+        stage_outputs,
+        directory,
+        terraform_directory=directory,
         input_vars=input_vars.stage_08_qhub_tf_extensions(stage_outputs, config),
+        **kwargs,
     )
 
-    if check:
-        pass
+    check_stage(directory, None, stage_outputs, config, check=check, **kwargs)
 
 
-def guided_install(
+def provision_stages(
+    stage_outputs,
     config,
     dns_provider,
     dns_auto_provision,
     disable_prompt=False,
     skip_remote_state_provision=False,
+    dry_run=False,
+    concurrent_init=True,
+    max_workers=DEFAULT_MAX_WORKERS,
+    **stage_kwargs,
 ):
-    # 01 Check Environment Variables
-    check_cloud_credentials(config)
+    """Provision all stages as a graph of tasks, without running checks
+    or updating dns records for a `dry_run`
+
+    Each stage is split into an init, a deploy (import, apply and
+    output) and a check task. A stage is deployed once it is initialized
+    and the previous stage passed its checks. The init of all stages,
+    the dns update of the ingress and the checks of a stage run
+    concurrently with all tasks they do not depend on. Without
+    `concurrent_init` the stages are initialized one after another. The
+    stages keeping their state in a kubernetes backend are initialized
+    once the credentials of stage 02 are known.
+    """
+    check = not dry_run
 
-    stage_outputs = {}
+    stages = [
+        (
+            "stages/02-infrastructure",
+            provision_02_infrastructure,
+            checks.stage_02_infrastructure,
+        ),
+        (
+            "stages/03-kubernetes-initialize",
+            provision_03_kubernetes_initialize,
+            checks.stage_03_kubernetes_initialize,
+        ),
+        (
+            "stages/04-kubernetes-ingress",
+            provision_04_kubernetes_ingress,
+            checks.stage_04_kubernetes_ingress,
+        ),
+        (
+            "stages/05-kubernetes-keycloak",
+            provision_05_kubernetes_keycloak,
+            checks.stage_05_kubernetes_keycloak,
+        ),
+        (
+            "stages/06-kubernetes-keycloak-configuration",
+            provision_06_kubernetes_keycloak_configuration,
+            checks.stage_06_kubernetes_keycloak_configuration,
+        ),
+        (
+            "stages/07-kubernetes-services",
+            provision_07_kubernetes_services,
+            checks.stage_07_kubernetes_services,
+        ),
+        ("stages/08-qhub-tf-extensions", provision_08_qhub_tf_extensions, None),
+    ]
     if config["provider"] != "local" and config["terraform_state"]["type"] == "remote":
         if skip_remote_state_provision:
             print("Skipping remote state provision")
         else:
-            provision_01_terraform_state(stage_outputs, config)
+            stages.insert(
+                0, ("stages/01-terraform-state", provision_01_terraform_state, None)
+            )
+    stage_names = [stage for stage, _, _ in stages]
 
-    provision_02_infrastructure(stage_outputs, config)
+    # credentials are added to the environment of all following
+    # terraform runs within the context rather than to os.environ
+    context = stage_kwargs.setdefault("context", ExecutionContext())
 
-    with kubernetes_provider_context(
-        stage_outputs["stages/02-infrastructure"]["kubernetes_credentials"]["value"]
-    ):
-        provision_03_kubernetes_initialize(stage_outputs, config)
-        provision_04_kubernetes_ingress(stage_outputs, config)
-        provision_ingress_dns(
-            stage_outputs,
-            config,
-            dns_provider=dns_provider,
-            dns_auto_provision=dns_auto_provision,
-            disable_prompt=disable_prompt,
+    def add_kubernetes_credentials():
+        context.add_kubernetes_credentials(
+            stage_outputs["stages/02-infrastructure"]["kubernetes_credentials"]["value"]
         )
-        provision_05_kubernetes_keycloak(stage_outputs, config)
 
-        with keycloak_provider_context(
+    def add_keycloak_credentials():
+        context.add_keycloak_credentials(
             stage_outputs["stages/05-kubernetes-keycloak"]["keycloak_credentials"][
                 "value"
             ]
+        )
+
+    dependencies = {
+        "kubernetes-credentials": ["deploy:stages/02-infrastructure"],
+        "keycloak-credentials": ["check:stages/05-kubernetes-keycloak"],
+        "deploy:stages/03-kubernetes-initialize": ["kubernetes-credentials"],
+        "deploy:stages/06-kubernetes-keycloak-configuration": ["keycloak-credentials"],
+        # keycloak is reached through the domain of the ingress
+        "check:stages/05-kubernetes-keycloak": [] if dry_run else ["ingress-dns"],
+    }
+
+    scheduler = Scheduler(max_workers=max_workers)
+    scheduler.add(
+        "kubernetes-credentials",
+        add_kubernetes_credentials,
+        dependencies["kubernetes-credentials"],
+    )
+    scheduler.add(
+        "keycloak-credentials",
+        add_keycloak_credentials,
+        dependencies["keycloak-credentials"],
+    )
+    if not dry_run:
+        scheduler.add(
+            "ingress-dns",
+            functools.partial(
+                provision_ingress_dns,
+                stage_outputs,
+                config,
+                dns_provider=dns_provider,
+                dns_auto_provision=dns_auto_provision,
+                disable_prompt=disable_prompt,
+            ),
+            ["deploy:stages/04-kubernetes-ingress"],
+        )
+
+    # the kubernetes backend of the local provider stores the state of
+    # the stages after 02 in the cluster which stage 02 creates
+    kubernetes_state = (
+        config["terraform_state"]["type"] == "remote" and config["provider"] == "local"
+    ) or (
+        config["terraform_state"]["type"] == "existing"
+        and config["terraform_state"].get("backend") == "kubernetes"
+    )
+
+    def init_stage(stage):
+        # the environment is read when the task runs so that it includes
+        # the credentials added by the tasks it depends on
+        terraform.init(
+            stage_terraform_directory(stage, config),
+            upgrade=stage_kwargs.get("terraform_upgrade", False),
+            env=context.environment(),
+        )
+
+    for index, (stage, provision, check_function) in enumerate(stages):
+        init_dependencies = []
+        if kubernetes_state and stage_names.index(stage) > stage_names.index(
+            "stages/02-infrastructure"
         ):
-            provision_06_kubernetes_keycloak_configuration(stage_outputs, config)
-            provision_07_kubernetes_services(stage_outputs, config)
-            provision_08_qhub_tf_extensions(stage_outputs, config)
+            init_dependencies.append("kubernetes-credentials")
+        deploy_dependencies = [f"init:{stage}"]
+        if index > 0:
+            previous_stage = stage_names[index - 1]
+            if not concurrent_init:
+                init_dependencies.append(f"init:{previous_stage}")
+            # extensions only need the outputs of stage 07 not its checks
+            if stage == "stages/08-qhub-tf-extensions":
+                deploy_dependencies.append(f"deploy:{previous_stage}")
+            else:
+                deploy_dependencies.append(f"check:{previous_stage}")
+
+        scheduler.add(
+            f"init:{stage}",
+            functools.partial(init_stage, stage),
+            init_dependencies,
+        )
+        scheduler.add(
+            f"deploy:{stage}",
+            functools.partial(
+                provision,
+                stage_outputs,
+                config,
+                check=False,
+                terraform_init=False,
+                **stage_kwargs,
+            ),
+            deploy_dependencies + dependencies.get(f"deploy:{stage}", []),
+        )
+        scheduler.add(
+            f"check:{stage}",
+            functools.partial(
+                check_stage,
+                stage,
+                check_function,
+                stage_outputs,
+                config,
+                check=check,
+                **stage_kwargs,
+            ),
+            [f"deploy:{stage}"] + dependencies.get(f"check:{stage}", []),
+        )
+
+    scheduler.run()
+
+
+def guided_install(
+    config,
+    dns_provider,
+    dns_auto_provision,
+    disable_prompt=False,
+    skip_remote_state_provision=False,
+    terraform_upgrade=False,
+    force_stages=None,
+    terraform_plan=False,
+    dry_run=False,
+    resume=False,
+):
+    """Deploy all stages of QHub
+
+    With `terraform_plan` each stage is planned first and only applied
+    when its plan has changes. A `dry_run` only plans the stages against
+    the outputs of the existing deployment. Both report the planned
+    changes of each stage. When resuming, stages complete since the
+    last deployment are skipped entirely. Returns the plan summaries of
+    all stages.
+    """
+    # 01 Check Environment Variables
+    check_cloud_credentials(config)
+
+    # download the providers of all stages once so that each stage
+    # `terraform init` links them from the shared plugin cache
+    concurrent_init = terraform.preflight(
+        stage_directories(config), upgrade=terraform_upgrade
+    )
+
+    plan_summaries = {}
+    stage_kwargs = {
+        "terraform_upgrade": terraform_upgrade,
+        "terraform_plan": terraform_plan or dry_run,
+        "terraform_apply": not dry_run,
+        "plan_summaries": plan_summaries,
+        "journal": StageJournal.load(),
+        "force_stages": force_stages,
+        "resume": resume,
+    }
+
+    stage_outputs = {}
+    try:
+        provision_stages(
+            stage_outputs,
+            config,
+            dns_provider,
+            dns_auto_provision,
+            disable_prompt=disable_prompt,
+            skip_remote_state_provision=skip_remote_state_provision,
+            dry_run=dry_run,
+            concurrent_init=concurrent_init,
+            **stage_kwargs,
+        )
+    except KeyError as e:
+        if not dry_run:
+            raise
+        print(
+            f"Stage output {e} does not exist yet, remaining stages can only be planned once the previous stages are deployed"
+        )
 
-            print("QHub deployed successfully")
+    if terraform_plan or dry_run:
+        report_plan_summaries(plan_summaries)
+
+    if dry_run:
+        return plan_summaries
+
+    print("QHub deployed successfully")
 
     print("Services:")
     for service_name, service in stage_outputs["stages/07-kubernetes-services"][
@@ -249,6 +708,8 @@ def guided_install(
         "Additional administration docs can be found at https://docs.qhub.dev/en/stable/source/admin_guide/"
     )
 
+    return plan_summaries
+
 
 def deploy_configuration(
     config,
@@ -256,6 +717,11 @@ def deploy_configuration(
     dns_auto_provision,
     disable_prompt,
     skip_remote_state_provision,
+    terraform_upgrade=False,
+    force_stages=None,
+    terraform_plan=False,
+    dry_run=False,
+    resume=False,
 ):
     if config.get("prevent_deploy", False):
         # Note if we used the Pydantic model properly, we might get that qhub_config.prevent_deploy always exists but defaults to False
@@ -279,12 +745,17 @@ def deploy_configuration(
 
     with timer(logger, "deploying QHub"):
         try:
-            guided_install(
+            return guided_install(
                 config,
                 dns_provider,
                 dns_auto_provision,
                 disable_prompt,
                 skip_remote_state_provision,
+                terraform_upgrade=terraform_upgrade,
+                force_stages=force_stages,
+                terraform_plan=terraform_plan,
+                dry_run=dry_run,
+                resume=resume,
             )
         except subprocess.CalledProcessError as e:
             logger.error(e.output)
@@ -1,77 +1,73 @@
+import concurrent.futures
+import contextvars
 import logging
 import os
-import functools
-
-from qhub.utils import (
-    timer,
-    check_cloud_credentials,
-    kubernetes_provider_context,
-    keycloak_provider_context,
-)
+
+from qhub.utils import timer, check_cloud_credentials
+from qhub.context import ExecutionContext
 from qhub.stages import input_vars, state_imports
+from qhub.stages.journal import StageJournal
+from qhub.deploy import stage_names, stage_terraform_directory
 from qhub.provider import terraform
 
 logger = logging.getLogger(__name__)
 
 
-def gather_stage_outputs(config):
+def gather_stage_outputs(config, terraform_import=False):
+    """Outputs of all stages which provide the credentials to kubernetes
+    and keycloak while destroying
+
+    Outputs recorded in the stage journal by the last deployment are
+    used as is. All other stages are initialized and their outputs read
+    with `terraform output` concurrently. The state of stage 01 is only
+    imported beforehand with `terraform_import`, which is required when
+    its local terraform state was lost.
+    """
+    journal = StageJournal.load()
     stage_outputs = {}
+    for stage in stage_names(config):
+        outputs = journal.outputs(stage)
+        if outputs is not None:
+            stage_outputs[stage] = outputs
+    if terraform_import:
+        stage_outputs.pop("stages/01-terraform-state", None)
+    if stage_outputs:
+        logger.info(
+            f"using outputs of stages={list(stage_outputs)} recorded by the last deployment"
+        )
 
-    _terraform_init_output = functools.partial(
-        terraform.deploy,
-        terraform_init=True,
-        terraform_import=True,
-        terraform_apply=False,
-        terraform_destroy=False,
+    missing_stages = [_ for _ in stage_names(config) if _ not in stage_outputs]
+    terraform.init_all(
+        [stage_terraform_directory(stage, config) for stage in missing_stages]
     )
 
-    if config["provider"] != "local" and config["terraform_state"]["type"] == "remote":
-        stage_outputs["stages/01-terraform-state"] = _terraform_init_output(
-            directory=os.path.join("stages/01-terraform-state", config["provider"]),
+    if "stages/01-terraform-state" in missing_stages and terraform_import:
+        missing_stages.remove("stages/01-terraform-state")
+        stage_outputs["stages/01-terraform-state"] = terraform.deploy(
+            directory=stage_terraform_directory("stages/01-terraform-state", config),
+            terraform_init=False,
+            terraform_import=True,
+            terraform_apply=False,
             input_vars=input_vars.stage_01_terraform_state(stage_outputs, config),
             state_imports=state_imports.stage_01_terraform_state(stage_outputs, config),
         )
 
-    stage_outputs["stages/02-infrastructure"] = _terraform_init_output(
-        directory=os.path.join("stages/02-infrastructure", config["provider"]),
-        input_vars=input_vars.stage_02_infrastructure(stage_outputs, config),
-    )
+    with timer(logger, "terraform output of all stages"):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=terraform.INIT_MAX_WORKERS
+        ) as executor:
+            futures = {
+                stage: executor.submit(
+                    contextvars.copy_context().run,
+                    terraform.output,
+                    stage_terraform_directory(stage, config),
+                )
+                for stage in missing_stages
+            }
+        for stage, future in futures.items():
+            stage_outputs[stage] = future.result()
 
-    stage_outputs["stages/03-kubernetes-initialize"] = _terraform_init_output(
-        directory="stages/03-kubernetes-initialize",
-        input_vars=input_vars.stage_03_kubernetes_initialize(stage_outputs, config),
-    )
-
-    stage_outputs["stages/04-kubernetes-ingress"] = _terraform_init_output(
-        directory="stages/04-kubernetes-ingress",
-        input_vars=input_vars.stage_04_kubernetes_ingress(stage_outputs, config),
-    )
-
-    stage_outputs["stages/05-kubernetes-keycloak"] = _terraform_init_output(
-        directory="stages/05-kubernetes-keycloak",
-        input_vars=input_vars.stage_05_kubernetes_keycloak(stage_outputs, config),
-    )
-
-    stage_outputs[
-        "stages/06-kubernetes-keycloak-configuration"
-    ] = _terraform_init_output(
-        directory="stages/06-kubernetes-keycloak-configuration",
-        input_vars=input_vars.stage_06_kubernetes_keycloak_configuration(
-            stage_outputs, config
-        ),
-    )
-
-    stage_outputs["stages/07-kubernetes-services"] = _terraform_init_output(
-        directory="stages/07-kubernetes-services",
-        input_vars=input_vars.stage_07_kubernetes_services(stage_outputs, config),
-    )
-
-    stage_outputs["stages/08-qhub-tf-extensions"] = _terraform_init_output(
-        directory="stages/08-qhub-tf-extensions",
-        input_vars=input_vars.stage_08_qhub_tf_extensions(stage_outputs, config),
-    )
-
-    return stage_outputs
+    return {stage: stage_outputs[stage] for stage in stage_names(config)}
 
 
 def destroy_stages(stage_outputs, config):
@@ -92,55 +88,59 @@ def destroy_stages(stage_outputs, config):
 
     status = {}
 
-    with kubernetes_provider_context(
+    context = ExecutionContext()
+    context.add_kubernetes_credentials(
         stage_outputs["stages/02-infrastructure"]["kubernetes_credentials"]["value"]
-    ):
-        with keycloak_provider_context(
-            stage_outputs["stages/05-kubernetes-keycloak"]["keycloak_credentials"][
-                "value"
-            ]
-        ):
-            status["stages/08-qhub-tf-extensions"] = _terraform_destroy(
-                directory="stages/08-qhub-tf-extensions",
-                input_vars=input_vars.stage_08_qhub_tf_extensions(
-                    stage_outputs, config
-                ),
-                ignore_errors=True,
-            )
+    )
+    kubernetes_env = context.environment()
+    context.add_keycloak_credentials(
+        stage_outputs["stages/05-kubernetes-keycloak"]["keycloak_credentials"]["value"]
+    )
+    keycloak_env = context.environment()
 
-            status["stages/07-kubernetes-services"] = _terraform_destroy(
-                directory="stages/07-kubernetes-services",
-                input_vars=input_vars.stage_07_kubernetes_services(
-                    stage_outputs, config
-                ),
-                ignore_errors=True,
-            )
+    status["stages/08-qhub-tf-extensions"] = _terraform_destroy(
+        directory="stages/08-qhub-tf-extensions",
+        input_vars=input_vars.stage_08_qhub_tf_extensions(stage_outputs, config),
+        ignore_errors=True,
+        env=keycloak_env,
+    )
 
-            status["stages/06-kubernetes-keycloak-configuration"] = _terraform_destroy(
-                directory="stages/06-kubernetes-keycloak-configuration",
-                input_vars=input_vars.stage_06_kubernetes_keycloak_configuration(
-                    stage_outputs, config
-                ),
-                ignore_errors=True,
-            )
+    status["stages/07-kubernetes-services"] = _terraform_destroy(
+        directory="stages/07-kubernetes-services",
+        input_vars=input_vars.stage_07_kubernetes_services(stage_outputs, config),
+        ignore_errors=True,
+        env=keycloak_env,
+    )
 
-        status["stages/05-kubernetes-keycloak"] = _terraform_destroy(
-            directory="stages/05-kubernetes-keycloak",
-            input_vars=input_vars.stage_05_kubernetes_keycloak(stage_outputs, config),
-            ignore_errors=True,
-        )
+    status["stages/06-kubernetes-keycloak-configuration"] = _terraform_destroy(
+        directory="stages/06-kubernetes-keycloak-configuration",
+        input_vars=input_vars.stage_06_kubernetes_keycloak_configuration(
+            stage_outputs, config
+        ),
+        ignore_errors=True,
+        env=keycloak_env,
+    )
 
-        status["stages/04-kubernetes-ingress"] = _terraform_destroy(
-            directory="stages/04-kubernetes-ingress",
-            input_vars=input_vars.stage_04_kubernetes_ingress(stage_outputs, config),
-            ignore_errors=True,
-        )
+    status["stages/05-kubernetes-keycloak"] = _terraform_destroy(
+        directory="stages/05-kubernetes-keycloak",
+        input_vars=input_vars.stage_05_kubernetes_keycloak(stage_outputs, config),
+        ignore_errors=True,
+        env=kubernetes_env,
+    )
 
-        status["stages/03-kubernetes-initialize"] = _terraform_destroy(
-            directory="stages/03-kubernetes-initialize",
-            input_vars=input_vars.stage_03_kubernetes_initialize(stage_outputs, config),
-            ignore_errors=True,
-        )
+    status["stages/04-kubernetes-ingress"] = _terraform_destroy(
+        directory="stages/04-kubernetes-ingress",
+        input_vars=input_vars.stage_04_kubernetes_ingress(stage_outputs, config),
+        ignore_errors=True,
+        env=kubernetes_env,
+    )
+
+    status["stages/03-kubernetes-initialize"] = _terraform_destroy(
+        directory="stages/03-kubernetes-initialize",
+        input_vars=input_vars.stage_03_kubernetes_initialize(stage_outputs, config),
+        ignore_errors=True,
+        env=kubernetes_env,
+    )
 
     status["stages/02-infrastructure"] = _terraform_destroy(
         directory=os.path.join("stages/02-infrastructure", config["provider"]),
@@ -161,7 +161,7 @@ def destroy_stages(stage_outputs, config):
     return status
 
 
-def destroy_configuration(config):
+def destroy_configuration(config, terraform_import=False):
     logger.info(
         """Removing all infrastructure, your local files will still remain,
     you can use 'qhub deploy' to re-install infrastructure using same config file\n"""
@@ -170,7 +170,10 @@ def destroy_configuration(config):
 
     # Populate stage_outputs to determine progress of deployment and
     # get credentials to kubernetes and keycloak context
-    stage_outputs = gather_stage_outputs(config)
+    stage_outputs = gather_stage_outputs(config, terraform_import=terraform_import)
+
+    # even a partial destroy invalidates the recorded stage digests
+    StageJournal.load().clear()
 
     with timer(logger, "destroying QHub"):
         status = destroy_stages(stage_outputs, config)
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+from typing import Any, Dict, List
+
+from qhub import constants
+from qhub.process import async_run_subprocess_cmd
+from qhub.profile import aggregate_phases, load_profile
+from qhub.provider import terraform
+from qhub.utils import qhub_cache_directory
+
+logger = logging.getLogger(__name__)
+
+FLEET_ACTIONS = {"deploy", "render"}
+DEFAULT_MAX_PARALLEL = 4
+FLEET_REPORT_FILENAME = "qhub-fleet-report.json"
+FLEET_PROFILE_FILENAME = "fleet-profile.json"
+FLEET_LOG_FILENAME = "fleet.log"
+
+
+def fleet_runs(config_filenames: List[str], output_root: str = None) -> List[Dict]:
+    """Configuration and isolated working directory of each run
+
+    A run works in the directory of its configuration, or within
+    `output_root` in a directory named after the configuration. Every
+    run needs a working directory of its own.
+    """
+    runs = []
+    for config_filename in config_filenames:
+        config_filename = pathlib.Path(config_filename).resolve()
+        if not config_filename.is_file():
+            raise ValueError(
+                f"passed in configuration filename={config_filename} must exist"
+            )
+
+        if output_root:
+            name = config_filename.stem
+            if name in {"qhub-config", "config"}:
+                name = config_filename.parent.name
+            output_directory = pathlib.Path(output_root).resolve() / name
+        else:
+            output_directory = config_filename.parent
+        runs.append(
+            {"config": str(config_filename), "output_directory": str(output_directory)}
+        )
+
+    output_directories = [_["output_directory"] for _ in runs]
+    duplicates = {_ for _ in output_directories if output_directories.count(_) > 1}
+    if duplicates:
+        raise ValueError(
+            f"fleet runs would share the working directories={sorted(duplicates)}, use --output-root"
+        )
+    return runs
+
+
+def fleet_environment(output_directory: str) -> Dict[str, str]:
+    """Environment of a single run
+
+    All runs share the qhub cache, and with it the terraform binary and
+    the terraform plugin cache, while temporary files and the kubeconfig
+    are kept within the state directory of the run.
+    """
+    state_directory = os.path.join(output_directory, constants.QHUB_STATE_DIRECTORY)
+    temp_directory = os.path.join(state_directory, "tmp")
+    os.makedirs(temp_directory, exist_ok=True)
+
+    env = terraform.terraform_environment()
+    env.update(
+        {
+            "QHUB_CACHE_DIR": str(qhub_cache_directory()),
+            "QHUB_KUBECONFIG": os.path.join(state_directory, "kubeconfig"),
+            "TMPDIR": temp_directory,
+        }
+    )
+    return env
+
+
+def fleet_command(action: str, run: Dict, extra_args: List[str] = None) -> List[str]:
+    command = [
+        sys.executable,
+        "-m",
+        "qhub",
+        action,
+        "--config",
+        run["config"],
+        "--output",
+        run["output_directory"],
+        "--profile",
+        os.path.join(
+            run["output_directory"],
+            constants.QHUB_STATE_DIRECTORY,
+            FLEET_PROFILE_FILENAME,
+        ),
+    ]
+    if action == "deploy":
+        # nobody can answer the prompts of concurrent deployments
+        command.append("--disable-prompt")
+    return command + list(extra_args or [])
+
+
+async def _run_fleet(
+    action: str, runs: List[Dict], max_parallel: int, extra_args: List[str]
+) -> List[Dict]:
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def _run(run):
+        name = os.path.basename(run["output_directory"])
+        state_directory = os.path.join(
+            run["output_directory"], constants.QHUB_STATE_DIRECTORY
+        )
+        async with semaphore:
+            logger.info(f"fleet {action} of config={run['config']} started")
+            start_time = time.time()
+            exit_code = await async_run_subprocess_cmd(
+                fleet_command(action, run, extra_args),
+                prefix=name,
+                log_filename=os.path.join(state_directory, "logs", FLEET_LOG_FILENAME),
+                # deploy expects the stages relative to its working directory
+                cwd=run["output_directory"],
+                env=fleet_environment(run["output_directory"]),
+            )
+            duration = time.time() - start_time
+        logger.info(f"fleet {action} of config={run['config']} exit code={exit_code}")
+        return fleet_result(run, exit_code, duration)
+
+    return await asyncio.gather(*[_run(_) for _ in runs])
+
+
+def fleet_result(run: Dict, exit_code: int, duration: float) -> Dict[str, Any]:
+    """Status and timing of a single run along with the durations of its
+    phases from the profile written by the run"""
+    try:
+        profile = load_profile(
+            os.path.join(
+                run["output_directory"],
+                constants.QHUB_STATE_DIRECTORY,
+                FLEET_PROFILE_FILENAME,
+            )
+        )
+        phases = {
+            key: phase["duration"] for key, phase in aggregate_phases(profile).items()
+        }
+    except (OSError, ValueError, KeyError):
+        phases = {}
+
+    return {
+        **run,
+        "status": "succeeded" if exit_code == 0 else "failed",
+        "exit_code": exit_code,
+        "duration": duration,
+        "phases": phases,
+    }
+
+
+def run_fleet(
+    action: str,
+    config_filenames: List[str],
+    max_parallel: int = DEFAULT_MAX_PARALLEL,
+    output_root: str = None,
+    extra_args: List[str] = None,
+    report_filename: str = FLEET_REPORT_FILENAME,
+) -> Dict[str, Any]:
+    """Run `qhub <action>` for many configurations with at most
+    `max_parallel` runs at once and write an aggregated report
+
+    Each run is a separate qhub process within its own working
+    directory, see `fleet_runs` and `fleet_environment`. The terraform
+    binary is downloaded once before any run starts.
+    """
+    if action not in FLEET_ACTIONS:
+        raise ValueError(f"fleet action={action} must be one of {FLEET_ACTIONS}")
+
+    runs = fleet_runs(config_filenames, output_root)
+    for run in runs:
+        os.makedirs(run["output_directory"], exist_ok=True)
+
+    if action == "deploy":
+        terraform.download_terraform_binary()
+
+    start_time = time.time()
+    results = asyncio.run(_run_fleet(action, runs, max_parallel, extra_args))
+    report = {
+        "action": action,
+        "max_parallel": max_parallel,
+        "duration": time.time() - start_time,
+        "succeeded": sum(_["status"] == "succeeded" for _ in results),
+        "failed": sum(_["status"] == "failed" for _ in results),
+        "runs": results,
+    }
+
+    with open(report_filename, "w") as f:
+        json.dump(report, f, indent=2)
+    print_fleet_report(report)
+    print(f"Fleet report written to {report_filename}")
+    return report
+
+
+def print_fleet_report(report: Dict[str, Any]):
+    print(f"{'status':>10} {'duration [s]':>13}  config")
+    for run in sorted(report["runs"], key=lambda _: -_["duration"]):
+        print(f"{run['status']:>10} {run['duration']:>13.1f}  {run['config']}")
+    print(
+        f"qhub fleet {report['action']}: {report['succeeded']} succeeded, "
+        f"{report['failed']} failed in {report['duration']:.1f} [s]"
+    )
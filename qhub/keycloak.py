@@ -1,5 +1,7 @@
+import inspect
 import logging
 import os
+import threading
 
 import keycloak
 
@@ -8,6 +10,9 @@ from .utils import load_yaml
 
 logger = logging.getLogger(__name__)
 
+_keycloak_admin_sessions = {}
+_keycloak_admin_sessions_lock = threading.Lock()
+
 
 def do_keycloak(config_filename, *args):
     config = load_yaml(config_filename)
@@ -20,19 +25,23 @@ def do_keycloak(config_filename, *args):
 
     keycloak_admin = get_keycloak_admin_from_config(config)
 
-    if args[0] == "adduser":
-        if len(args) < 2:
-            raise ValueError(
-                "keycloak command 'adduser' requires `username [password]`"
-            )
-
-        username = args[1]
-        password = args[2] if len(args) >= 3 else None
-        create_user(keycloak_admin, username, password, domain=config["domain"])
-    elif args[0] == "listusers":
-        list_users(keycloak_admin)
-    else:
-        raise ValueError(f"unknown keycloak command {args[0]}")
+    try:
+        if args[0] == "adduser":
+            if len(args) < 2:
+                raise ValueError(
+                    "keycloak command 'adduser' requires `username [password]`"
+                )
+
+            username = args[1]
+            password = args[2] if len(args) >= 3 else None
+            create_user(keycloak_admin, username, password, domain=config["domain"])
+        elif args[0] == "listusers":
+            list_users(keycloak_admin)
+        else:
+            raise ValueError(f"unknown keycloak command {args[0]}")
+    except keycloak.exceptions.KeycloakError:
+        evict_keycloak_admin_session(keycloak_admin)
+        raise
 
 
 def create_user(
@@ -77,6 +86,71 @@ def list_users(keycloak_admin: keycloak.KeycloakAdmin):
         )
 
 
+def keycloak_admin_session(
+    server_url: str,
+    username: str,
+    password: str,
+    realm_name: str = "master",
+    user_realm_name: str = None,
+    client_id: str = "admin-cli",
+    verify: bool = True,
+) -> keycloak.KeycloakAdmin:
+    """Authenticated keycloak admin client shared within the process
+
+    The client logs in before it is shared, so that only sessions which
+    obtained a token are cached. The token exchange therefore happens
+    once for each server and credentials, the client then refreshes its
+    token and reuses the connections of its http session. A failed login
+    raises and caches nothing and a session whose calls fail is dropped
+    with `evict_keycloak_admin_session`, so that callers may retry with
+    a new session.
+    """
+    key = (
+        server_url,
+        username,
+        password,
+        realm_name,
+        user_realm_name,
+        client_id,
+        verify,
+    )
+    with _keycloak_admin_sessions_lock:
+        if key not in _keycloak_admin_sessions:
+            kwargs = {}
+            # python-keycloak < 2 logs in when the client is built but
+            # only refreshes its token when asked to
+            parameters = inspect.signature(keycloak.KeycloakAdmin).parameters
+            if "auto_refresh_token" in parameters:
+                kwargs["auto_refresh_token"] = ("get", "put", "post", "delete")
+
+            keycloak_admin = keycloak.KeycloakAdmin(
+                server_url=server_url,
+                username=username,
+                password=password,
+                realm_name=realm_name,
+                user_realm_name=user_realm_name,
+                client_id=client_id,
+                verify=verify,
+                **kwargs,
+            )
+            # newer releases log in lazily on the first call and refresh
+            # the token of their connection automatically
+            connection = getattr(keycloak_admin, "connection", None)
+            if connection is not None:
+                connection.get_token()
+            _keycloak_admin_sessions[key] = keycloak_admin
+        return _keycloak_admin_sessions[key]
+
+
+def evict_keycloak_admin_session(keycloak_admin: keycloak.KeycloakAdmin):
+    """Drop a session e.g. with an expired or revoked token, the next
+    `keycloak_admin_session` call authenticates again"""
+    with _keycloak_admin_sessions_lock:
+        for key, session in list(_keycloak_admin_sessions.items()):
+            if session is keycloak_admin:
+                del _keycloak_admin_sessions[key]
+
+
 def get_keycloak_admin_from_config(config):
     keycloak_server_url = os.environ.get(
         "KEYCLOAK_SERVER_URL", f"https://{config['domain']}/auth/"
@@ -91,13 +165,12 @@ def get_keycloak_admin_from_config(config):
     should_verify_tls = config.get("certificate", {}).get("type", "") != "self-signed"
 
     try:
-        keycloak_admin = keycloak.KeycloakAdmin(
+        keycloak_admin = keycloak_admin_session(
             server_url=keycloak_server_url,
             username=keycloak_username,
             password=keycloak_password,
             realm_name=os.environ.get("KEYCLOAK_REALM", "qhub"),
             user_realm_name="master",
-            auto_refresh_token=("get", "put", "post", "delete"),
             verify=should_verify_tls,
         )
     except (
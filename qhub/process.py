@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# output is written once this many bytes are buffered or this many
+# seconds have passed since the last write
+OUTPUT_BATCH_SIZE = 64 * 1024  # bytes
+OUTPUT_FLUSH_INTERVAL = 0.1  # seconds
+# seconds a process group has to exit after SIGTERM before SIGKILL
+KILL_GRACE_PERIOD = 10
+STREAM_LIMIT = 4 * 1024 * 1024  # bytes, terraform json lines can be long
+DEFAULT_MAX_CONCURRENCY = 4
+
+_output_lock = threading.Lock()
+_child_watcher_lock = threading.Lock()
+
+
+class BatchedOutput:
+    """Write complete lines of output in batches
+
+    Lines from concurrent processes are never interleaved since each
+    batch is written under a lock shared by all processes.
+    """
+
+    def __init__(self, stream=None, log_file=None):
+        self.stream = stream or sys.stdout.buffer
+        self.log_file = log_file
+        self.lines = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, line: bytes):
+        self.lines.append(line)
+        self.size += len(line)
+        if (
+            self.size >= OUTPUT_BATCH_SIZE
+            or time.monotonic() - self.last_flush >= OUTPUT_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.lines:
+            return
+        batch = b"".join(self.lines)
+        self.lines, self.size = [], 0
+        with _output_lock:
+            self.stream.write(batch)
+            self.stream.flush()
+
+    async def flush_periodically(self):
+        """Flush lines which would otherwise wait for the next line of a
+        quiet process"""
+        while True:
+            await asyncio.sleep(OUTPUT_FLUSH_INTERVAL)
+            if time.monotonic() - self.last_flush >= OUTPUT_FLUSH_INTERVAL:
+                self.flush()
+
+
+if sys.version_info < (3, 8):
+
+    class ThreadedChildWatcher(asyncio.AbstractChildWatcher):
+        """Backport of the python 3.8 `asyncio.ThreadedChildWatcher`
+
+        The default watcher of python 3.7 only works for the event loop
+        of the main thread. This watcher waits for each child within a
+        thread of its own, so event loops of any thread may start
+        subprocesses.
+        """
+
+        def is_active(self):
+            return True
+
+        def close(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def attach_loop(self, loop):
+            pass
+
+        def add_child_handler(self, pid, callback, *args):
+            threading.Thread(
+                target=self._do_waitpid, args=(pid, callback, args), daemon=True
+            ).start()
+
+        def remove_child_handler(self, pid):
+            return True
+
+        def _do_waitpid(self, pid, callback, args):
+            try:
+                _, status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                returncode = 255  # already reaped elsewhere
+            else:
+                if os.WIFSIGNALED(status):
+                    returncode = -os.WTERMSIG(status)
+                elif os.WIFEXITED(status):
+                    returncode = os.WEXITSTATUS(status)
+                else:
+                    returncode = status
+            callback(pid, returncode, *args)
+
+
+def install_child_watcher():
+    """Allow subprocesses from event loops outside of the main thread,
+    which python 3.8+ already does by default"""
+    if sys.version_info >= (3, 8):
+        return
+    with _child_watcher_lock:
+        if not isinstance(asyncio.get_child_watcher(), ThreadedChildWatcher):
+            asyncio.set_child_watcher(ThreadedChildWatcher())
+
+
+def kill_process_group(process, sig=signal.SIGTERM):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass  # Already finished
+
+
+async def terminate_process_group(process, grace_period=KILL_GRACE_PERIOD) -> int:
+    """SIGTERM the process group of `process` then SIGKILL it when it
+    has not exited after `grace_period` seconds"""
+    kill_process_group(process, signal.SIGTERM)
+    try:
+        return await asyncio.wait_for(process.wait(), grace_period)
+    except asyncio.TimeoutError:
+        logger.warning(f"process pid={process.pid} ignored SIGTERM, killing")
+        kill_process_group(process, signal.SIGKILL)
+        return await process.wait()
+
+
+async def async_run_subprocess_cmd(
+    processargs: Sequence[str],
+    prefix: str = None,
+    timeout: float = 0,
+    strip_errors: bool = False,
+    line_handler: Callable[[bytes], Optional[bytes]] = None,
+    log_filename: str = None,
+    output=None,
+    **kwargs,
+) -> int:
+    """Run a command within its own process group and stream its output
+
+    Each line of combined stdout and stderr is passed through the
+    optional `line_handler`, prefixed with `[prefix]: ` and written in
+    batches to stdout. With `log_filename` the lines are also appended,
+    without prefix, to that file. After `timeout` seconds, or when the
+    coroutine is cancelled, the whole process group is terminated.
+    Returns the exit code of the process.
+    """
+    line_prefix = f"[{prefix}]: ".encode("utf-8") if prefix else b""
+
+    log_file = None
+    if log_filename:
+        os.makedirs(os.path.dirname(log_filename) or os.curdir, exist_ok=True)
+        log_file = open(log_filename, "ab")
+        log_file.write(f"$ {' '.join(map(str, processargs))}\n".encode("utf-8"))
+
+    output = output or BatchedOutput()
+    process = await asyncio.create_subprocess_exec(
+        *processargs,
+        **kwargs,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+        limit=STREAM_LIMIT,
+    )
+
+    async def _read_output():
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            if line_handler is not None:
+                line = line_handler(line)
+                if line is None:
+                    continue
+            if strip_errors:
+                line = re.sub(rb"\x1b\[31m", b"", line)  # Remove red ANSI escape code
+            if log_file is not None:
+                log_file.write(line)
+            output.write(line_prefix + line)
+        return await process.wait()
+
+    flusher = asyncio.ensure_future(output.flush_periodically())
+    try:
+        return await asyncio.wait_for(_read_output(), timeout or None)
+    except asyncio.TimeoutError:
+        logger.warning(f"command={processargs[0]} timed out after {timeout} [s]")
+        return await terminate_process_group(process)
+    except asyncio.CancelledError:
+        await terminate_process_group(process)
+        raise
+    finally:
+        flusher.cancel()
+        output.flush()
+        if log_file is not None:
+            log_file.close()
+
+
+def run_subprocess_cmd(processargs, **kwargs) -> int:
+    """Blocking `async_run_subprocess_cmd` which may be called from any
+    thread, a KeyboardInterrupt kills the process group"""
+    install_child_watcher()
+    return asyncio.run(async_run_subprocess_cmd(processargs, **kwargs))
+
+
+async def async_run_subprocess_cmds(
+    commands: List[Dict], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> List[int]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(command):
+        command = dict(command)
+        async with semaphore:
+            return await async_run_subprocess_cmd(command.pop("processargs"), **command)
+
+    return await asyncio.gather(*[_run(_) for _ in commands])
+
+
+def run_subprocess_cmds(
+    commands: List[Dict], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> List[int]:
+    """Run many commands concurrently within a single event loop
+
+    Each command is a dict of `processargs` and the keyword arguments
+    of `async_run_subprocess_cmd`. Returns the exit codes in order.
+    """
+    install_child_watcher()
+    return asyncio.run(async_run_subprocess_cmds(commands, max_concurrency))
@@ -0,0 +1,170 @@
+import contextlib
+import json
+import threading
+import time
+from typing import Any, Dict, List
+
+from qhub.version import __version__
+
+PROFILE_VERSION = 1
+
+# relative slowdown and absolute seconds for a phase to be a regression
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_SECONDS = 5.0
+TOTAL_PHASE = "total"
+
+_active_profiles = []
+_lock = threading.Lock()
+
+
+class Profile:
+    """Timings of all phases of a qhub command
+
+    Every `qhub.utils.timer` completed while the profile is active is
+    recorded as a phase along with its attributes, e.g. the stage
+    directory of a terraform command.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.start_time = time.time()
+        self.end_time = None
+        self.phases = []
+
+    def record(
+        self, name: str, start_time: float, duration: float, status: str, **attributes
+    ):
+        with _lock:
+            self.phases.append(
+                {
+                    "name": name,
+                    "attributes": attributes,
+                    "start": start_time - self.start_time,
+                    "duration": duration,
+                    "status": status,
+                }
+            )
+
+    def report(self) -> Dict[str, Any]:
+        end_time = self.end_time or time.time()
+        return {
+            "version": PROFILE_VERSION,
+            "qhub_version": __version__,
+            "command": self.command,
+            "start_time": self.start_time,
+            "duration": end_time - self.start_time,
+            "phases": sorted(self.phases, key=lambda _: _["start"]),
+        }
+
+    def save(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+@contextlib.contextmanager
+def profile(command: str, filename: str = None):
+    """Record the phases of `command` and save them as json to `filename`
+
+    Nothing is recorded without a `filename`. The report is saved even
+    when the command fails.
+    """
+    if filename is None:
+        yield None
+        return
+
+    _profile = Profile(command)
+    with _lock:
+        _active_profiles.append(_profile)
+    try:
+        yield _profile
+    finally:
+        with _lock:
+            _active_profiles.remove(_profile)
+        _profile.end_time = time.time()
+        _profile.save(filename)
+        print(f"Profile of qhub {command} written to {filename}")
+
+
+def record_phase(name: str, start_time: float, duration: float, status: str, **kwargs):
+    """Record a phase within all active profiles"""
+    for _profile in list(_active_profiles):
+        _profile.record(name, start_time, duration, status, **kwargs)
+
+
+def load_profile(filename: str) -> Dict[str, Any]:
+    with open(filename) as f:
+        report = json.load(f)
+    if report.get("version") != PROFILE_VERSION:
+        raise ValueError(
+            f"profile={filename} has unsupported version={report.get('version')}"
+        )
+    return report
+
+
+def phase_key(phase: Dict[str, Any]) -> str:
+    attributes = " ".join(f"{k}={v}" for k, v in sorted(phase["attributes"].items()))
+    return f"{phase['name']} {attributes}".strip()
+
+
+def aggregate_phases(report: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Total duration and count of each phase, phases that repeat such
+    as health check attempts are summed"""
+    phases = {}
+    for phase in report["phases"]:
+        aggregate = phases.setdefault(phase_key(phase), {"duration": 0.0, "count": 0})
+        aggregate["duration"] += phase["duration"]
+        aggregate["count"] += 1
+    return phases
+
+
+def compare_profiles(
+    base: Dict[str, Any],
+    new: Dict[str, Any],
+    threshold: float = REGRESSION_THRESHOLD,
+    min_seconds: float = REGRESSION_MIN_SECONDS,
+) -> List[Dict[str, Any]]:
+    """Compare the phases of two profiles
+
+    A phase regressed when it became both more than `threshold` slower
+    relative to and at least `min_seconds` slower than in `base`. Rows
+    are ordered by the absolute change in duration.
+    """
+    base_phases = aggregate_phases(base)
+    new_phases = aggregate_phases(new)
+    base_phases[TOTAL_PHASE] = {"duration": base["duration"], "count": 1}
+    new_phases[TOTAL_PHASE] = {"duration": new["duration"], "count": 1}
+
+    rows = []
+    for key in set(base_phases) | set(new_phases):
+        base_duration = base_phases.get(key, {}).get("duration")
+        new_duration = new_phases.get(key, {}).get("duration")
+        delta = (new_duration or 0.0) - (base_duration or 0.0)
+        relative = delta / base_duration if base_duration else None
+        rows.append(
+            {
+                "phase": key,
+                "base": base_duration,
+                "new": new_duration,
+                "delta": delta,
+                "relative": relative,
+                "regression": relative is not None
+                and new_duration is not None
+                and delta >= min_seconds
+                and relative > threshold,
+            }
+        )
+
+    return sorted(rows, key=lambda _: (_["phase"] != TOTAL_PHASE, -abs(_["delta"])))
+
+
+def print_comparison(rows: List[Dict[str, Any]]):
+    def _format(duration):
+        return "-" if duration is None else f"{duration:.1f}"
+
+    print(f"{'base [s]':>10} {'new [s]':>10} {'delta [s]':>10} {'change':>8}  phase")
+    for row in rows:
+        relative = "-" if row["relative"] is None else f"{row['relative']:+.0%}"
+        marker = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{_format(row['base']):>10} {_format(row['new']):>10} {row['delta']:>+10.1f} {relative:>8}  {row['phase']}{marker}"
+        )
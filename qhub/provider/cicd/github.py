@@ -8,6 +8,7 @@ from pydantic import BaseModel, Field
 import requests
 from nacl import encoding, public
 
+from qhub.tracing import SPAN_KIND_CLIENT, span
 from qhub.utils import pip_install_qhub
 
 
@@ -26,14 +27,18 @@ def github_request(url, method="GET", json=None):
         "POST": requests.post,
     }
 
-    response = method_map[method](
-        f"{GITHUB_BASE_URL}{url}",
-        json=json,
-        auth=requests.auth.HTTPBasicAuth(
-            os.environ["USERNAME_GITHUB"], os.environ["TOKEN_GITHUB"]
-        ),
-    )
-    response.raise_for_status()
+    with span(
+        f"github {method}", kind=SPAN_KIND_CLIENT, method=method, url=url
+    ) as _span:
+        response = method_map[method](
+            f"{GITHUB_BASE_URL}{url}",
+            json=json,
+            auth=requests.auth.HTTPBasicAuth(
+                os.environ["USERNAME_GITHUB"], os.environ["TOKEN_GITHUB"]
+            ),
+        )
+        _span.set_attribute("status_code", response.status_code)
+        response.raise_for_status()
     return response
 
 
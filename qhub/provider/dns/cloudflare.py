@@ -3,6 +3,8 @@ import logging
 
 import CloudFlare
 
+from qhub.tracing import SPAN_KIND_CLIENT, span
+
 
 logger = logging.getLogger(__name__)
 
@@ -25,23 +27,29 @@ def update_record(zone_name, record_name, record_type, record_address):
     }
 
     zone_id = None
-    for zone in cf.zones.get():
+    with span("cloudflare list zones", kind=SPAN_KIND_CLIENT):
+        zones = cf.zones.get()
+    for zone in zones:
         if zone["name"] == zone_name:
             zone_id = zone["id"]
             break
     else:
         raise ValueError(f"Cloudflare zone {zone_name} not found")
 
-    existing_record = cf.zones.dns_records.get(
-        zone_id, params={"name": f"{record_name}.{zone_name}", "type": record_type}
-    )
+    attributes = {"zone": zone_name, "record": record_name, "type": record_type}
+    with span("cloudflare get dns record", kind=SPAN_KIND_CLIENT, **attributes):
+        existing_record = cf.zones.dns_records.get(
+            zone_id, params={"name": f"{record_name}.{zone_name}", "type": record_type}
+        )
     if existing_record:
         logger.info(
             f"record name={record_name} type={record_type} address={record_address} already exists updating"
         )
-        cf.zones.dns_records.put(zone_id, existing_record[0]["id"], data=record)
+        with span("cloudflare update dns record", kind=SPAN_KIND_CLIENT, **attributes):
+            cf.zones.dns_records.put(zone_id, existing_record[0]["id"], data=record)
     else:
         logger.info(
             f"record name={record_name} type={record_type} address={record_address} does not exists creating"
         )
-        cf.zones.dns_records.post(zone_id, data=record)
+        with span("cloudflare create dns record", kind=SPAN_KIND_CLIENT, **attributes):
+            cf.zones.dns_records.post(zone_id, data=record)
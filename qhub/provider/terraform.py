@@ -1,24 +1,44 @@
-import io
+import functools
+import hashlib
 import json
 import logging
 import os
+import pathlib
 import platform
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import urllib.request
 import zipfile
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Set, Tuple
 import contextlib
+import contextvars
+import concurrent.futures
 
 
-from qhub.utils import timer, run_subprocess_cmd, deep_merge
+from qhub.utils import (
+    timer,
+    run_subprocess_cmd,
+    deep_merge,
+    qhub_cache_directory,
+    file_lock,
+)
 from qhub import constants
+from qhub.provider.terraform_progress import terraform_progress
+from qhub.tracing import SPAN_KIND_CLIENT, span
 
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
+INIT_MAX_WORKERS = 4
+IMPORT_TIMINGS_FILENAME = "import-timings.json"
+INIT_FINGERPRINT_FILENAME = "qhub-init-fingerprint"
+LOGS_DIRECTORY = "logs"
+
 
 class TerraformException(Exception):
     pass
@@ -30,8 +50,13 @@ def deploy(
     terraform_import: bool = False,
     terraform_apply: bool = True,
     terraform_destroy: bool = False,
+    terraform_upgrade: bool = False,
+    terraform_refresh: bool = False,
+    terraform_plan: bool = False,
     input_vars: Dict[str, Any] = None,
     state_imports: List = None,
+    plan_summaries: Dict[str, Dict] = None,
+    env: Dict[str, str] = None,
 ):
     """Execute a given terraform directory
 
@@ -48,40 +73,78 @@ def deploy(
       terraform_destroy: whether to run `terraform destroy` default
         False
 
+      terraform_upgrade: whether to always run `terraform init
+        -upgrade` default False, otherwise init is skipped when its
+        fingerprint is unchanged
+
+      terraform_refresh: whether to run `terraform refresh` default
+        False
+
+      terraform_plan: whether to run `terraform plan` before apply
+        default False, the saved plan is only applied if it has changes
+
       input_vars: supply values for "variable" resources within
         terraform module
 
       state_imports: (addr, id) pairs for iterate through and attempt
         to terraform import
+
+      plan_summaries: when given the `plan_summary` of the directory
+        is stored in it when planning
+
+      env: environment of all terraform commands, e.g. of an
+        `ExecutionContext`, default `os.environ`
     """
     input_vars = input_vars or {}
     state_imports = state_imports or []
 
-    with tempfile.NamedTemporaryFile(
-        mode="w", encoding="utf-8", suffix=".tfvars.json"
-    ) as f:
-        json.dump(input_vars, f.file)
-        f.file.flush()
+    with tempfile.TemporaryDirectory() as tempdir:
+        var_file = os.path.join(tempdir, "input.tfvars.json")
+        with open(var_file, "w", encoding="utf-8") as f:
+            json.dump(input_vars, f)
 
         if terraform_init:
-            init(directory)
+            init(directory, upgrade=terraform_upgrade, env=env)
 
         if terraform_import:
-            for addr, id in state_imports:
-                tfimport(
-                    addr, id, directory=directory, var_files=[f.name], exist_ok=True
-                )
+            import_missing(directory, state_imports, var_files=[var_file], env=env)
 
-        if terraform_apply:
-            apply(directory, var_files=[f.name])
+        if terraform_refresh:
+            refresh(directory, var_files=[var_file], env=env)
+
+        if terraform_plan:
+            plan_file = os.path.join(tempdir, "qhub.tfplan")
+            has_changes = plan(
+                directory, var_files=[var_file], plan_file=plan_file, env=env
+            )
+            if plan_summaries is not None:
+                plan_summaries[directory] = plan_summary(
+                    show(directory, plan_file, env=env)
+                )
+            if terraform_apply and has_changes:
+                apply(directory, plan_file=plan_file, env=env)
+            elif terraform_apply:
+                logger.info(f"terraform plan directory={directory} has no changes")
+        elif terraform_apply:
+            apply(directory, var_files=[var_file], env=env)
 
         if terraform_destroy:
-            destroy(directory, var_files=[f.name])
+            destroy(directory, var_files=[var_file], env=env)
 
-        return output(directory)
+        return output(directory, env=env)
 
 
+@functools.lru_cache(maxsize=None)
 def download_terraform_binary(version=constants.TERRAFORM_VERSION):
+    """Return the path to the terraform binary of the given version
+
+    The binary is downloaded once into the per-user qhub cache
+    directory and verified against the SHA256SUMS published alongside
+    the release. Concurrent qhub processes serialize on a lock file
+    within the cache directory and the binary is only moved into place
+    once fully extracted. The resolved path is memoized for the
+    lifetime of the process.
+    """
     os_mapping = {
         "linux": "linux",
         "win32": "windows",
@@ -98,82 +161,564 @@ def download_terraform_binary(version=constants.TERRAFORM_VERSION):
         "aarch64": "arm64",
     }
 
-    download_url = f"https://releases.hashicorp.com/terraform/{version}/terraform_{version}_{os_mapping[sys.platform]}_{architecture_mapping[platform.machine()]}.zip"
-    filename_directory = os.path.join(tempfile.gettempdir(), "terraform", version)
-    filename_path = os.path.join(filename_directory, "terraform")
+    release_url = f"https://releases.hashicorp.com/terraform/{version}"
+    download_filename = f"terraform_{version}_{os_mapping[sys.platform]}_{architecture_mapping[platform.machine()]}.zip"
+    download_url = f"{release_url}/{download_filename}"
+    checksums_url = f"{release_url}/terraform_{version}_SHA256SUMS"
+    filename_directory = qhub_cache_directory() / "terraform" / version
+    filename_path = filename_directory / "terraform"
+
+    if filename_path.is_file():
+        return str(filename_path)
+
+    filename_directory.mkdir(parents=True, exist_ok=True)
+    with file_lock(filename_directory / ".lock"):
+        # another process may have downloaded terraform while waiting
+        if filename_path.is_file():
+            return str(filename_path)
 
-    if not os.path.isfile(filename_path):
         logger.info(
             f"downloading and extracting terraform binary from url={download_url} to path={filename_path}"
         )
-        with urllib.request.urlopen(download_url) as f:
-            bytes_io = io.BytesIO(f.read())
-        download_file = zipfile.ZipFile(bytes_io)
-        download_file.extract("terraform", filename_directory)
+        with urllib.request.urlopen(checksums_url) as f:
+            checksums = parse_checksums(f.read().decode("utf-8"))
+        if download_filename not in checksums:
+            raise TerraformException(
+                f"no checksum for {download_filename} published at url={checksums_url}"
+            )
+
+        with tempfile.TemporaryFile(dir=filename_directory) as download_file:
+            sha256 = hashlib.sha256()
+            with urllib.request.urlopen(download_url) as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    download_file.write(chunk)
+
+            if sha256.hexdigest() != checksums[download_filename]:
+                raise TerraformException(
+                    f"checksum mismatch for url={download_url} expected sha256={checksums[download_filename]} got sha256={sha256.hexdigest()}"
+                )
+
+            download_file.seek(0)
+            with zipfile.ZipFile(download_file) as zip_file:
+                with tempfile.NamedTemporaryFile(
+                    dir=filename_directory, delete=False
+                ) as binary_file:
+                    with zip_file.open("terraform") as f:
+                        shutil.copyfileobj(f, binary_file, DOWNLOAD_CHUNK_SIZE)
+
+        os.chmod(binary_file.name, 0o555)
+        os.replace(binary_file.name, filename_path)
+
+    return str(filename_path)
+
+
+def parse_checksums(content: str) -> Dict[str, str]:
+    """Parse a SHA256SUMS file into a mapping of filename to sha256"""
+    checksums = {}
+    for line in content.splitlines():
+        if line.strip():
+            checksum, filename = line.split()
+            checksums[filename] = checksum
+    return checksums
+
+
+def plugin_cache_directory() -> pathlib.Path:
+    return qhub_cache_directory() / "terraform" / "plugins"
+
+
+def terraform_environment(env: Dict[str, str] = None) -> Dict[str, str]:
+    """Environment for terraform subprocesses
+
+    Sets `TF_PLUGIN_CACHE_DIR` to the qhub plugin cache shared by all
+    stages unless it is already set.
+    """
+    env = dict(os.environ if env is None else env)
+    if not env.get("TF_PLUGIN_CACHE_DIR"):
+        env["TF_PLUGIN_CACHE_DIR"] = str(plugin_cache_directory())
+    os.makedirs(env["TF_PLUGIN_CACHE_DIR"], exist_ok=True)
+    return env
+
+
+def stage_log_path(directory=None, output_directory=None) -> str:
+    """Log of all terraform commands run within a stage directory, e.g.
+    `.qhub/logs/stages-07-kubernetes-services.log`"""
+    name = (directory or "").strip("/").replace("/", "-") or "terraform"
+    return os.path.join(
+        output_directory or os.curdir,
+        constants.QHUB_STATE_DIRECTORY,
+        LOGS_DIRECTORY,
+        f"{name}.log",
+    )
 
-    os.chmod(filename_path, 0o555)
-    return filename_path
 
+def run_terraform_subprocess(processargs, exit_codes=(0,), **kwargs):
+    """Run terraform with `processargs` and return its exit code
 
-def run_terraform_subprocess(processargs, **kwargs):
+    The output is also appended to the `stage_log_path` of the
+    directory. Raises `TerraformException` for any exit code not in
+    `exit_codes`.
+    """
     terraform_path = download_terraform_binary()
     logger.info(f" terraform at {terraform_path}")
-    if run_subprocess_cmd([terraform_path] + processargs, **kwargs):
+    kwargs["env"] = terraform_environment(kwargs.get("env"))
+    kwargs.setdefault("log_filename", stage_log_path(kwargs.get("cwd")))
+    with span(
+        f"terraform {processargs[0]}",
+        kind=SPAN_KIND_CLIENT,
+        directory=kwargs.get("cwd"),
+        args=processargs,
+    ) as _span:
+        exit_code = run_subprocess_cmd([terraform_path] + processargs, **kwargs)
+        _span.set_attribute("exit_code", exit_code)
+        if exit_code not in exit_codes:
+            _span.set_error(f"terraform exited with code {exit_code}")
+    if exit_code not in exit_codes:
         raise TerraformException("Terraform returned an error")
+    return exit_code
 
 
 def version():
     terraform_path = download_terraform_binary()
     logger.info(f"checking terraform={terraform_path} version")
 
-    version_output = subprocess.check_output([terraform_path, "--version"]).decode(
-        "utf-8"
-    )
+    version_output = subprocess.check_output(
+        [terraform_path, "--version"], env=terraform_environment()
+    ).decode("utf-8")
     return re.search(r"(\d+)\.(\d+).(\d+)", version_output).group(0)
 
 
-def init(directory=None, upgrade=True):
-    logger.info(f"terraform init directory={directory}")
-    with timer(logger, "terraform init"):
+def init(directory=None, upgrade=False, env=None):
+    """Run `terraform init` within directory
+
+    Init is skipped when the directory was already initialized and its
+    `init_fingerprint` is unchanged since. Without `upgrade` a failed
+    init, for example because the lock file no longer satisfies the
+    provider versions of a newer qhub, is retried with `-upgrade`.
+    """
+    if not upgrade and is_initialized(directory):
+        logger.info(f"terraform init directory={directory} skipped, unchanged")
+        return
+
+    logger.info(f"terraform init directory={directory} upgrade={upgrade}")
+    # stages may be initialized concurrently so prefix with the directory
+    prefix = f"terraform {directory}" if directory else "terraform"
+    with timer(logger, "terraform init", directory=directory):
         command = ["init"]
         if upgrade:
             command.append("-upgrade")
-        run_terraform_subprocess(command, cwd=directory, prefix="terraform")
+
+        try:
+            run_terraform_subprocess(command, cwd=directory, prefix=prefix, env=env)
+        except TerraformException:
+            if upgrade:
+                raise
+            logger.warning(
+                f"terraform init directory={directory} failed, retrying with -upgrade"
+            )
+            run_terraform_subprocess(
+                ["init", "-upgrade"], cwd=directory, prefix=prefix, env=env
+            )
+
+    # init may have written the lock file so fingerprint again
+    write_init_fingerprint(directory, init_fingerprint(directory))
+
+
+def preflight(directories: List[str], upgrade: bool = False) -> bool:
+    """Prepare the directories to be initialized and return whether they
+    may be initialized concurrently
+
+    Unless all directories are initialized already the providers of all
+    of them are downloaded into the shared plugin cache once, after
+    which `init` only links them. Concurrent downloads into the plugin
+    cache are not safe so without a seeded cache the directories have
+    to be initialized one after another.
+    """
+    if not upgrade and all(map(is_initialized, directories)):
+        return True
+
+    try:
+        seed_plugin_cache(directories)
+    except TerraformException:
+        logger.warning("unable to seed terraform plugin cache, continuing")
+        return False
+    return True
+
+
+def init_all(
+    directories: List[str],
+    upgrade: bool = False,
+    max_workers: int = INIT_MAX_WORKERS,
+    env: Dict[str, str] = None,
+):
+    """Run `init` within all directories concurrently
+
+    Raises the first failure once all directories were attempted.
+    """
+    if not preflight(directories, upgrade=upgrade):
+        max_workers = 1
+
+    with timer(logger, "terraform init of all stages"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    init,
+                    directory,
+                    upgrade=upgrade,
+                    env=env,
+                )
+                for directory in directories
+            ]
+        for future in futures:
+            future.result()
+
+
+def is_initialized(directory=None) -> bool:
+    """Whether directory was initialized with its current `init_fingerprint`
+    and its providers are still installed"""
+    fingerprint = read_init_fingerprint(directory)
+    return (
+        fingerprint is not None
+        and fingerprint == init_fingerprint(directory)
+        and providers_installed(directory)
+    )
+
+
+def providers_installed(directory=None) -> bool:
+    """Whether the providers installed within `.terraform/providers` still
+    exist
+
+    With a plugin cache the installed providers are links into the
+    shared cache directory, which may have been removed since.
+    """
+    providers_directory = os.path.join(
+        directory or os.curdir, ".terraform", "providers"
+    )
+    installed = False
+    for root, dirs, files in os.walk(providers_directory):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                logger.info(f"terraform provider={path} missing from plugin cache")
+                return False
+            installed = installed or name in files or os.path.islink(path)
+    return installed or not required_providers(directory or os.curdir)
+
+
+def init_fingerprint(directory=None) -> str:
+    """Digest of everything that requires `terraform init` to be rerun
+
+    Covers the terraform version, required providers and `versions.tf`
+    files, the backend blocks of `*.tf.json` files, the sources of all
+    module calls and the dependency lock file.
+    """
+    directory = directory or os.curdir
+    fingerprint = {
+        "terraform_version": constants.TERRAFORM_VERSION,
+        "required_providers": sorted(required_providers(directory)),
+        "versions": {},
+        "backend": {},
+        "modules": [],
+        "lock": None,
+    }
+
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != ".terraform")
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            relative_path = os.path.relpath(path, directory)
+            if filename.endswith(".tf.json"):
+                with open(path) as f:
+                    backend = json.load(f).get("terraform", {}).get("backend")
+                if backend:
+                    fingerprint["backend"][relative_path] = backend
+            elif filename.endswith(".tf"):
+                with open(path) as f:
+                    content = f.read()
+                if filename == "versions.tf":
+                    fingerprint["versions"][relative_path] = content
+                for module in re.split(r"(?m)^\s*(?=module\s+\")", content)[1:]:
+                    name = re.match(r'module\s+"([^"]+)"', module)
+                    source = re.search(r'source\s*=\s*"([^"]+)"', module)
+                    fingerprint["modules"].append(
+                        [
+                            relative_path,
+                            name and name.group(1),
+                            source and source.group(1),
+                        ]
+                    )
+
+    lock_filename = os.path.join(directory, ".terraform.lock.hcl")
+    if os.path.isfile(lock_filename):
+        with open(lock_filename) as f:
+            fingerprint["lock"] = f.read()
+
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def init_fingerprint_path(directory=None) -> pathlib.Path:
+    # stored within `.terraform` so that removing it forces an init
+    return (
+        pathlib.Path(directory or os.curdir) / ".terraform" / INIT_FINGERPRINT_FILENAME
+    )
+
+
+def read_init_fingerprint(directory=None) -> str:
+    try:
+        return init_fingerprint_path(directory).read_text().strip()
+    except OSError:
+        return None
 
 
-def apply(directory=None, targets=None, var_files=None):
+def write_init_fingerprint(directory, fingerprint: str):
+    path = init_fingerprint_path(directory)
+    if path.parent.is_dir():
+        path.write_text(fingerprint)
+
+
+def apply(directory=None, targets=None, var_files=None, plan_file=None, env=None):
+    """Run `terraform apply` within directory
+
+    When `plan_file` is given exactly the saved plan is applied, the
+    targets and variables of which were fixed by `terraform plan`.
+    """
     targets = targets or []
     var_files = var_files or []
 
     logger.info(f"terraform apply directory={directory} targets={targets}")
+    if plan_file:
+        command = ["apply", "-auto-approve", "-input=false", "-json", plan_file]
+    else:
+        command = (
+            ["apply", "-auto-approve", "-json"]
+            + ["-target=" + _ for _ in targets]
+            + ["-var-file=" + _ for _ in var_files]
+        )
+    with timer(logger, "terraform apply", directory=directory), terraform_progress(
+        directory, "apply"
+    ) as line_handler:
+        run_terraform_subprocess(
+            command,
+            cwd=directory,
+            prefix="terraform",
+            line_handler=line_handler,
+            env=env,
+        )
+
+
+def plan(
+    directory=None, targets=None, var_files=None, plan_file=None, env=None
+) -> bool:
+    """Run `terraform plan` within directory and return whether the plan
+    has any changes
+
+    With `-detailed-exitcode` terraform exits with 0 for an empty plan
+    and 2 for a plan with changes. The plan is saved to `plan_file`
+    when given so that `apply` performs exactly what was planned.
+    """
+    targets = targets or []
+    var_files = var_files or []
+
+    logger.info(f"terraform plan directory={directory} targets={targets}")
     command = (
-        ["apply", "-auto-approve"]
+        ["plan", "-input=false", "-detailed-exitcode", "-json"]
+        + (["-out=" + plan_file] if plan_file else [])
         + ["-target=" + _ for _ in targets]
         + ["-var-file=" + _ for _ in var_files]
     )
-    with timer(logger, "terraform apply"):
-        run_terraform_subprocess(command, cwd=directory, prefix="terraform")
+    with timer(logger, "terraform plan", directory=directory), terraform_progress(
+        directory, "plan"
+    ) as line_handler:
+        exit_code = run_terraform_subprocess(
+            command,
+            cwd=directory,
+            prefix="terraform",
+            exit_codes=(0, 2),
+            line_handler=line_handler,
+            env=env,
+        )
+    return exit_code == 2
 
 
-def output(directory=None):
+def show(directory=None, plan_file=None, env=None) -> Dict[str, Any]:
+    """Return the `terraform show -json` representation of a saved plan"""
+    terraform_path = download_terraform_binary()
+
+    logger.info(f"terraform={terraform_path} show directory={directory}")
+    with timer(logger, "terraform show", directory=directory):
+        return json.loads(
+            subprocess.check_output(
+                [terraform_path, "show", "-json", plan_file],
+                cwd=directory,
+                env=terraform_environment(env),
+            ).decode("utf8")
+        )
+
+
+def plan_summary(plan_json: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Addresses of the resources a plan will add, change, replace and
+    destroy along with the names of the outputs it changes"""
+    summary = {"add": [], "change": [], "replace": [], "destroy": [], "outputs": []}
+    actions_mapping = {
+        ("create",): "add",
+        ("update",): "change",
+        ("delete", "create"): "replace",
+        ("create", "delete"): "replace",
+        ("delete",): "destroy",
+    }
+    for resource_change in plan_json.get("resource_changes", []):
+        actions = tuple(resource_change["change"]["actions"])
+        if actions in actions_mapping:
+            summary[actions_mapping[actions]].append(resource_change["address"])
+
+    for name, output_change in plan_json.get("output_changes", {}).items():
+        if output_change["actions"] != ["no-op"]:
+            summary["outputs"].append(name)
+    return summary
+
+
+def required_providers(directory) -> Set[Tuple[str, str]]:
+    """Collect the (source, version) of providers required within directory
+
+    Both `*.tf` and `*.tf.json` files of the directory and all modules
+    within it are searched for `required_providers` blocks. Providers
+    only implied by the type of a resource or data source are assumed
+    to be unversioned `hashicorp` providers, as terraform does.
+    """
+    providers = set()
+    provider_names = set()
+    implied_provider_names = set()
+
+    def _add_provider(name, source=None, version=None):
+        source = source or f"hashicorp/{name}"
+        providers.add((source, version or ""))
+        provider_names.add(name)
+
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != ".terraform"]
+        for filename in files:
+            path = os.path.join(root, filename)
+            if filename.endswith(".tf.json"):
+                with open(path) as f:
+                    blocks = json.load(f).get("terraform", {})
+                for block in blocks if isinstance(blocks, list) else [blocks]:
+                    for name, requirement in block.get(
+                        "required_providers", {}
+                    ).items():
+                        _add_provider(name, **requirement)
+            elif filename.endswith(".tf"):
+                with open(path) as f:
+                    content = f.read()
+                implied_provider_names.update(
+                    re.findall(r'^\s*(?:resource|data)\s+"([a-z0-9]+)_', content, re.M)
+                )
+                for block in re.finditer(
+                    r"required_providers\s*{((?:[^{}]|{[^{}]*})*)}", content
+                ):
+                    for name, requirement in re.findall(
+                        r"([\w-]+)\s*=\s*{([^{}]*)}", block.group(1)
+                    ):
+                        source = re.search(r'source\s*=\s*"([^"]+)"', requirement)
+                        version = re.search(r'version\s*=\s*"([^"]+)"', requirement)
+                        _add_provider(
+                            name,
+                            source=source and source.group(1),
+                            version=version and version.group(1),
+                        )
+
+    for name in implied_provider_names - provider_names:
+        providers.add((f"hashicorp/{name}", ""))
+
+    return providers
+
+
+def seed_plugin_cache(directories: List[str]):
+    """Download the providers required by all directories into the plugin cache
+
+    Terraform does not support concurrent writes to the plugin cache.
+    Running a single `terraform init` over the union of providers
+    before the stages are initialized means every stage init afterwards
+    only links providers from the cache.
+    """
+    providers = set()
+    for directory in directories:
+        if os.path.isdir(directory):
+            providers.update(required_providers(directory))
+
+    # unversioned requirements are satisfied by any seeded version
+    versioned_sources = {source for source, version in providers if version}
+    providers = {
+        (source, version)
+        for source, version in providers
+        if version or source not in versioned_sources
+    }
+
+    # a module may only require a single version of each provider
+    # so conflicting versions are seeded in separate modules
+    modules = []
+    for source, version in sorted(providers):
+        for module in modules:
+            if source not in module:
+                break
+        else:
+            module = {}
+            modules.append(module)
+        module[source] = version
+
+    logger.info(f"seeding terraform plugin cache with providers={sorted(providers)}")
+    # concurrent qhub processes, e.g. of `qhub fleet`, share the cache
+    cache_directory = terraform_environment()["TF_PLUGIN_CACHE_DIR"]
+    with timer(logger, "terraform seed plugin cache"), file_lock(
+        f"{cache_directory}.lock"
+    ):
+        for module in modules:
+            with tempfile.TemporaryDirectory() as seed_directory:
+                # built directly since `RequiredProvider` registers into
+                # the objects rendered by `tf_render`
+                seed_config = {
+                    "terraform": {
+                        "required_providers": {
+                            f"provider{i}": {
+                                "source": source,
+                                **({"version": version} if version else {}),
+                            }
+                            for i, (source, version) in enumerate(module.items())
+                        }
+                    }
+                }
+                with open(os.path.join(seed_directory, "main.tf.json"), "w") as f:
+                    json.dump(seed_config, f, indent=4)
+                run_terraform_subprocess(
+                    ["init", "-backend=false"],
+                    cwd=seed_directory,
+                    prefix="terraform",
+                )
+
+
+def output(directory=None, env=None):
     terraform_path = download_terraform_binary()
 
     logger.info(f"terraform={terraform_path} output directory={directory}")
-    with timer(logger, "terraform output"):
+    with timer(logger, "terraform output", directory=directory):
         return json.loads(
             subprocess.check_output(
-                [terraform_path, "output", "-json"], cwd=directory
+                [terraform_path, "output", "-json"],
+                cwd=directory,
+                env=terraform_environment(env),
             ).decode("utf8")[:-1]
         )
 
 
-def tfimport(addr, id, directory=None, var_files=None, exist_ok=False):
+def tfimport(addr, id, directory=None, var_files=None, exist_ok=False, env=None):
     var_files = var_files or []
 
     logger.info(f"terraform import directory={directory} addr={addr} id={id}")
     command = ["import"] + ["-var-file=" + _ for _ in var_files] + [addr, id]
     logger.error(str(command))
-    with timer(logger, "terraform import"):
+    with timer(logger, "terraform import", directory=directory, addr=addr):
         try:
             run_terraform_subprocess(
                 command,
@@ -181,23 +726,117 @@ def tfimport(addr, id, directory=None, var_files=None, exist_ok=False):
                 prefix="terraform",
                 strip_errors=True,
                 timeout=30,
+                env=env,
             )
         except TerraformException as e:
             if not exist_ok:
                 raise e
 
 
-def refresh(directory=None, var_files=None):
+def state_list(directory=None, env=None) -> Optional[Set[str]]:
+    """Addresses of all resources within the terraform state of directory
+    or None when the state can not be read"""
+    terraform_path = download_terraform_binary()
+
+    logger.info(f"terraform={terraform_path} state list directory={directory}")
+    with timer(logger, "terraform state list", directory=directory):
+        process = subprocess.run(
+            [terraform_path, "state", "list"],
+            cwd=directory,
+            env=terraform_environment(env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    if process.returncode != 0:
+        logger.warning(
+            f"terraform state list directory={directory} failed: {process.stderr.decode('utf-8')}"
+        )
+        return None
+    return set(process.stdout.decode("utf-8").split())
+
+
+def import_timings_path() -> pathlib.Path:
+    return qhub_cache_directory() / IMPORT_TIMINGS_FILENAME
+
+
+def average_import_duration() -> Optional[float]:
+    """Average duration of a `terraform import` measured by previous runs"""
+    try:
+        with import_timings_path().open() as f:
+            return json.load(f)["average"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def record_import_durations(durations: List[float]):
+    """Fold the measured durations into the running average of imports"""
+    try:
+        with import_timings_path().open() as f:
+            timings = json.load(f)
+        count, average = timings["count"], timings["average"]
+    except (OSError, ValueError, KeyError, TypeError):
+        count, average = 0, 0.0
+
+    total = average * count + sum(durations)
+    count += len(durations)
+    try:
+        import_timings_path().parent.mkdir(parents=True, exist_ok=True)
+        with import_timings_path().open("w") as f:
+            json.dump({"count": count, "average": total / count}, f)
+    except OSError:
+        pass
+
+
+def import_missing(directory, state_imports, var_files=None, env=None):
+    """Import each (addr, id) pair of `state_imports` whose address is not
+    within the terraform state of directory yet
+
+    A single `terraform state list` replaces an import attempt per
+    address, each of which spawns terraform and waits up to 30 seconds
+    to fail for addresses already in state. When the state can not be
+    listed every pair is imported as before. The time saved is estimated
+    from the average duration of previous imports.
+    """
+    if not state_imports:
+        return
+
+    addresses = state_list(directory, env=env)
+    missing_imports = [
+        (addr, id)
+        for addr, id in state_imports
+        if addresses is None or addr not in addresses
+    ]
+
+    durations = []
+    for addr, id in missing_imports:
+        start_time = time.time()
+        tfimport(
+            addr, id, directory=directory, var_files=var_files, exist_ok=True, env=env
+        )
+        durations.append(time.time() - start_time)
+    if durations:
+        record_import_durations(durations)
+
+    skipped = len(state_imports) - len(missing_imports)
+    if skipped:
+        average = average_import_duration()
+        saved = f", saving about {skipped * average:.1f} [s]" if average else ""
+        print(
+            f"terraform import directory={directory} skipped {skipped} of {len(state_imports)} addresses already in state{saved}"
+        )
+
+
+def refresh(directory=None, var_files=None, env=None):
     var_files = var_files or []
 
     logger.info(f"terraform refresh directory={directory}")
     command = ["refresh"] + ["-var-file=" + _ for _ in var_files]
 
-    with timer(logger, "terraform refresh"):
-        run_terraform_subprocess(command, cwd=directory, prefix="terraform")
+    with timer(logger, "terraform refresh", directory=directory):
+        run_terraform_subprocess(command, cwd=directory, prefix="terraform", env=env)
 
 
-def destroy(directory=None, targets=None, var_files=None):
+def destroy(directory=None, targets=None, var_files=None, env=None):
     targets = targets or []
     var_files = var_files or []
 
@@ -206,13 +845,22 @@ def destroy(directory=None, targets=None, var_files=None):
         [
             "destroy",
             "-auto-approve",
+            "-json",
         ]
         + ["-target=" + _ for _ in targets]
         + ["-var-file=" + _ for _ in var_files]
     )
 
-    with timer(logger, "terraform destroy"):
-        run_terraform_subprocess(command, cwd=directory, prefix="terraform")
+    with timer(logger, "terraform destroy", directory=directory), terraform_progress(
+        directory, "destroy"
+    ) as line_handler:
+        run_terraform_subprocess(
+            command,
+            cwd=directory,
+            prefix="terraform",
+            line_handler=line_handler,
+            env=env,
+        )
 
 
 def rm_local_state(directory=None):
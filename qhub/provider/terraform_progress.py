@@ -0,0 +1,152 @@
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from qhub import constants
+
+logger = logging.getLogger(__name__)
+
+TIMINGS_DIRECTORY = "timings"
+NUM_SLOWEST_RESOURCES = 10
+
+START_EVENTS = {"apply_start", "refresh_start"}
+END_EVENTS = {"apply_complete", "apply_errored", "refresh_complete"}
+
+
+def timings_path(directory: str, command: str, output_directory=None) -> str:
+    """Timing report of a terraform command, e.g.
+    `.qhub/timings/stages-07-kubernetes-services-apply.json`"""
+    name = (directory or "").strip("/").replace("/", "-") or "terraform"
+    return os.path.join(
+        output_directory or os.curdir,
+        constants.QHUB_STATE_DIRECTORY,
+        TIMINGS_DIRECTORY,
+        f"{name}-{command}.json",
+    )
+
+
+class Progress:
+    """Progress of a terraform command run with its machine readable UI
+
+    With `-json` terraform writes one event per line. Each event is
+    turned back into the human readable message of the event while the
+    start, end and duration of every resource operation along with all
+    diagnostics and the change summary are collected for the timing
+    report of the command.
+    """
+
+    def __init__(self, directory: str, command: str):
+        self.directory = directory
+        self.command = command
+        self.start_time = time.time()
+        self.end_time = None
+        self.operations = {}
+        self.diagnostics = []
+        self.changes = None
+
+    def handle_line(self, line: bytes) -> Optional[bytes]:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return line
+        if not isinstance(event, dict):
+            return line
+
+        event_type = event.get("type", "")
+        hook = event.get("hook", {})
+        address = hook.get("resource", {}).get("addr")
+        operation = (
+            "refresh" if event_type.startswith("refresh_") else hook.get("action")
+        )
+
+        if event_type in START_EVENTS and address:
+            self.operations[address, operation] = {
+                "address": address,
+                "operation": operation,
+                "resource_type": hook["resource"].get("resource_type"),
+                "module": hook["resource"].get("module") or None,
+                "start": time.time() - self.start_time,
+                "end": None,
+                "duration": None,
+                "status": "running",
+            }
+        elif event_type in END_EVENTS and (address, operation) in self.operations:
+            record = self.operations[address, operation]
+            record["end"] = time.time() - self.start_time
+            record["duration"] = hook.get(
+                "elapsed_seconds", record["end"] - record["start"]
+            )
+            record["status"] = (
+                "errored" if event_type == "apply_errored" else "complete"
+            )
+        elif event_type == "diagnostic":
+            diagnostic = event.get("diagnostic", {})
+            self.diagnostics.append(diagnostic)
+            message = event.get("@message", diagnostic.get("summary", ""))
+            if diagnostic.get("detail"):
+                message = f"{message}\n{diagnostic['detail']}"
+            return f"{message}\n".encode("utf-8")
+        elif event_type == "change_summary":
+            self.changes = event.get("changes")
+
+        message = event.get("@message")
+        if not message:
+            return None
+        return f"{message}\n".encode("utf-8")
+
+    def report(self) -> Dict[str, Any]:
+        end_time = self.end_time or time.time()
+        return {
+            "directory": self.directory,
+            "command": self.command,
+            "duration": end_time - self.start_time,
+            "changes": self.changes,
+            "resources": sorted(
+                self.operations.values(),
+                key=lambda _: _["duration"] or 0,
+                reverse=True,
+            ),
+            "diagnostics": self.diagnostics,
+        }
+
+    def save(self, filename: str = None) -> str:
+        filename = filename or timings_path(self.directory, self.command)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return filename
+
+    def print_summary(self, num_resources: int = NUM_SLOWEST_RESOURCES):
+        resources = [_ for _ in self.report()["resources"] if _["duration"]]
+        if not resources:
+            return
+
+        print(f"Slowest resources of terraform {self.command} in {self.directory}:")
+        for resource in resources[:num_resources]:
+            print(
+                f"  {resource['duration']:8.1f} [s] {resource['address']} ({resource['operation']})"
+            )
+
+
+@contextlib.contextmanager
+def terraform_progress(directory: str, command: str):
+    """Collect the progress of a terraform command run with `-json`
+
+    Yields the `line_handler` for `run_subprocess_cmd`. The timing
+    report is saved and the slowest resources printed even when the
+    command fails.
+    """
+    progress = Progress(directory, command)
+    try:
+        yield progress.handle_line
+    finally:
+        progress.end_time = time.time()
+        try:
+            filename = progress.save()
+            logger.info(f"terraform {command} timing report written to {filename}")
+        except OSError as e:
+            logger.warning(f"unable to write terraform {command} timing report: {e}")
+        progress.print_summary()
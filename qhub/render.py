@@ -1,21 +1,46 @@
 import sys
+import json
+import concurrent.futures
 import pathlib
 import functools
 import os
 import shutil
-from typing import List, Dict
+import tempfile
+from typing import List, Dict, Optional
 import hashlib
 
 from ruamel.yaml import YAML
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 from qhub.stages import tf_objects
 from qhub.deprecate import DEPRECATED_FILE_PATHS
+from qhub.constants import QHUB_STATE_DIRECTORY
+from qhub.tracing import span
+from qhub.utils import file_lock
 
 from qhub.provider.cicd.github import gen_qhub_ops, gen_qhub_linter
 from qhub.provider.cicd.gitlab import gen_gitlab_ci
 
 
-def render_template(output_directory, config_filename, force=False, dry_run=False):
+RENDER_MANIFEST_FILENAME = "render-manifest.json"
+TEMPLATE_INDEX_FILENAME = "template-index.json"
+HASH_CHUNK_SIZE = 1024 * 1024  # bytes
+HASH_BATCH_SIZE = 4 * 1024 * 1024  # bytes
+RENDER_STAGING_PREFIX = "render-staging-"
+RENDER_COMMIT_FILENAME = ".render-commit.json"
+RENDER_LOCK_FILENAME = "render.lock"
+
+# linux ioctl to clone a file as a copy-on-write reflink
+FICLONE = 0x40049409
+
+
+def render_template(
+    output_directory, config_filename, force=False, dry_run=False, full=False
+):
     # get directory for qhub templates
     import qhub
 
@@ -55,7 +80,8 @@ def render_template(output_directory, config_filename, force=False, dry_run=Fals
     config["repo_directory"] = output_directory.name
     config["qhub_config_yaml_path"] = str(config_filename.absolute())
 
-    contents = render_contents(config)
+    with span("render contents"):
+        contents = render_contents(config)
 
     directories = [
         "image",
@@ -70,25 +96,39 @@ def render_template(output_directory, config_filename, force=False, dry_run=Fals
     if config["provider"] != "local" and config["terraform_state"]["type"] == "remote":
         directories.append(f"stages/01-terraform-state/{config['provider']}")
 
+    # the manifest of the previous render lets us skip hashing output
+    # files whose size and modification time have not changed
+    manifest = {} if full else load_render_manifest(output_directory)
+
     source_dirs = [os.path.join(str(template_directory), _) for _ in directories]
     output_dirs = [os.path.join(str(output_directory), _) for _ in directories]
-    new, untracked, updated, deleted = inspect_files(
-        source_dirs,
-        output_dirs,
-        source_base_dir=str(template_directory),
-        output_base_dir=str(output_directory),
-        ignore_filenames=[
-            "terraform.tfstate",
-            ".terraform.lock.hcl",
-            "terraform.tfstate.backup",
-        ],
-        ignore_directories=[
-            ".terraform",
-            "__pycache__",
-        ],
-        deleted_paths=DEPRECATED_FILE_PATHS,
-        contents=contents,
-    )
+    with span("render inspect files", full=full) as _span:
+        new, untracked, updated, deleted = inspect_files(
+            source_dirs,
+            output_dirs,
+            source_base_dir=str(template_directory),
+            output_base_dir=str(output_directory),
+            ignore_filenames=[
+                "terraform.tfstate",
+                ".terraform.lock.hcl",
+                "terraform.tfstate.backup",
+            ],
+            ignore_directories=[
+                ".terraform",
+                "__pycache__",
+            ],
+            deleted_paths=DEPRECATED_FILE_PATHS,
+            contents=contents,
+            manifest=manifest,
+            source_index=load_template_index(str(template_directory)),
+        )
+        for name, filenames in [
+            ("new", new),
+            ("untracked", untracked),
+            ("updated", updated),
+            ("deleted", deleted),
+        ]:
+            _span.set_attribute(f"files.{name}", len(filenames))
 
     if new:
         print("The following files will be created:")
@@ -104,22 +144,20 @@ def render_template(output_directory, config_filename, force=False, dry_run=Fals
             print(f"   DELETED   {filename}")
     if untracked:
         print("The following files are untracked (only exist in output directory):")
-        for filename in sorted(updated):
+        for filename in sorted(untracked):
             print(f"   UNTRACKED {filename}")
 
     if dry_run:
         print("dry-run enabled no files will be created, updated, or deleted")
     else:
+        with span("render materialize files", files=len(new | updated)):
+            materialize_files(
+                new | updated, template_directory, output_directory, contents
+            )
+
         for filename in new | updated:
-            input_filename = os.path.join(str(template_directory), filename)
             output_filename = os.path.join(str(output_directory), filename)
-            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-
-            if os.path.exists(input_filename):
-                shutil.copy(input_filename, output_filename)
-            else:
-                with open(output_filename, "w") as f:
-                    f.write(contents[filename])
+            manifest[filename] = manifest_entry(output_filename)
 
         for path in deleted:
             abs_path = os.path.abspath(os.path.join(str(output_directory), path))
@@ -135,6 +173,135 @@ def render_template(output_directory, config_filename, force=False, dry_run=Fals
             elif os.path.isdir(abs_path):
                 shutil.rmtree(abs_path)
 
+            for filename in list(manifest):
+                if filename == path or filename.startswith(path + os.sep):
+                    manifest.pop(filename)
+
+        save_render_manifest(output_directory, manifest)
+
+
+def materialize_files(
+    filenames: List[str],
+    template_directory: pathlib.Path,
+    output_directory: pathlib.Path,
+    contents: Dict[str, str],
+):
+    """Write the given files from the template directory or generated contents
+
+    All files are first written to a staging directory within the
+    output directory. Once every file has been written a commit marker
+    listing them is added to the staging directory and the files are
+    renamed into place. A render interrupted while staging leaves the
+    stage directories untouched. One interrupted during the renames
+    leaves its committed staging directory behind, and the next render
+    rolls it forward by renaming the remaining files before staging its
+    own, so a stage directory never keeps a mix of old and new files.
+
+    Renders of the same output directory hold an exclusive lock while
+    materializing, so that any staging directory found under the lock
+    was left by an interrupted render. Template files are copied with
+    `copy_file` which avoids copying the data through userspace when
+    the filesystem allows it.
+    """
+    state_directory = pathlib.Path(output_directory) / QHUB_STATE_DIRECTORY
+    state_directory.mkdir(parents=True, exist_ok=True)
+
+    with file_lock(str(state_directory / RENDER_LOCK_FILENAME)):
+        for path in state_directory.glob(f"{RENDER_STAGING_PREFIX}*"):
+            if (path / RENDER_COMMIT_FILENAME).exists():
+                rename_staged_files(str(path), output_directory)
+            shutil.rmtree(path, ignore_errors=True)
+
+        staging_directory = tempfile.mkdtemp(
+            prefix=RENDER_STAGING_PREFIX, dir=str(state_directory)
+        )
+        try:
+            for filename in filenames:
+                input_filename = os.path.join(str(template_directory), filename)
+                staged_filename = os.path.join(staging_directory, filename)
+                os.makedirs(os.path.dirname(staged_filename), exist_ok=True)
+
+                if os.path.exists(input_filename):
+                    copy_file(input_filename, staged_filename)
+                else:
+                    with open(staged_filename, "w") as f:
+                        f.write(contents[filename])
+
+            commit_filename = os.path.join(staging_directory, RENDER_COMMIT_FILENAME)
+            with open(f"{commit_filename}.tmp", "w") as f:
+                json.dump(sorted(filenames), f)
+            os.replace(f"{commit_filename}.tmp", commit_filename)
+        except BaseException:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            raise
+
+        # from here on the staging directory is only removed once all
+        # files are in place, otherwise the next render completes it
+        rename_staged_files(staging_directory, output_directory)
+        shutil.rmtree(staging_directory, ignore_errors=True)
+
+
+def rename_staged_files(staging_directory: str, output_directory: pathlib.Path):
+    """Rename the files listed in the commit marker of a staging directory
+    into the output directory, skipping those already renamed"""
+    with open(os.path.join(staging_directory, RENDER_COMMIT_FILENAME)) as f:
+        filenames = json.load(f)
+
+    for filename in filenames:
+        staged_filename = os.path.join(staging_directory, filename)
+        if not os.path.exists(staged_filename):
+            continue
+        output_filename = os.path.join(str(output_directory), filename)
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        os.replace(staged_filename, output_filename)
+
+
+def copy_file(source: str, destination: str):
+    """Copy the contents and permission bits of source to destination
+
+    A copy-on-write reflink is attempted first, then an in-kernel
+    `copy_file_range` and finally `shutil.copyfile` (which itself uses
+    `sendfile` where available). Hardlinks are deliberately not used
+    since rendered files are meant to be edited and committed by users
+    and a hardlink would modify the template installed with qhub.
+    """
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        copied = _reflink(fsrc, fdst) or _copy_file_range(fsrc, fdst)
+
+    if not copied:
+        shutil.copyfile(source, destination)
+    shutil.copymode(source, destination)
+
+
+def _reflink(fsrc, fdst) -> bool:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _copy_file_range(fsrc, fdst) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+
+    size = os.fstat(fsrc.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(
+                fsrc.fileno(), fdst.fileno(), size - offset, offset, offset
+            )
+            if copied == 0:
+                break
+            offset += copied
+    except OSError:
+        return False
+    return offset == size
+
 
 def render_contents(config: Dict):
     """Dynamically generated contents from QHub configuration"""
@@ -185,6 +352,9 @@ def gen_gitignore(config):
 
         # python
         __pycache__
+
+        # qhub local state
+        .qhub
     """
     return {".gitignore": cleandoc(filestoignore)}
 
@@ -226,6 +396,8 @@ def inspect_files(
     ignore_directories: List[str] = None,
     deleted_paths: List[str] = None,
     contents: Dict[str, str] = None,
+    manifest: Dict[str, Dict] = None,
+    source_index: Dict[str, str] = None,
 ):
     """Return created, updated and untracked files by computing a checksum over the provided directory
 
@@ -238,14 +410,33 @@ def inspect_files(
         ignore_directories (list[str]): Directories to ignore while comparing for changes
         deleted_paths (list[str]): Paths that if exist in output directory should be deleted
         contents (dict): filename to content mapping for dynmaically generated files
+        manifest (dict): output filename to size, mtime and sha256 mapping from a
+            previous render. Output files whose size and mtime match their entry are
+            not re-hashed. The mapping is updated in place to reflect the output
+            directory as inspected.
+        source_index (dict): precomputed sha256 of source files keyed by path
+            relative to source_base_dir, files missing from it are hashed
     """
     ignore_filenames = ignore_filenames or []
     ignore_directories = ignore_directories or []
+    deleted_paths = deleted_paths or []
     contents = contents or {}
+    source_index = source_index or {}
+
+    previous_manifest = {}
+    if manifest is not None:
+        previous_manifest = dict(manifest)
+        manifest.clear()
+    else:
+        manifest = {}
 
     source_files = {}
     output_files = {}
 
+    # files that need to be hashed, relative path to absolute path
+    unhashed_source_files = {}
+    unhashed_output_files = {}
+
     def list_files(
         directory: str, ignore_filenames: List[str], ignore_directories: List[str]
     ):
@@ -255,28 +446,60 @@ def inspect_files(
                 if file not in ignore_filenames:
                     yield os.path.join(root, file)
 
+    def inspect_output_file(relative_path: str, absolute_path: str):
+        stat = os.stat(absolute_path)
+        entry = previous_manifest.get(relative_path)
+        if manifest_entry_matches(entry, stat):
+            manifest[relative_path] = entry
+            output_files[relative_path] = entry["sha256"]
+        else:
+            unhashed_output_files[relative_path] = (absolute_path, stat)
+
     for filename in contents:
         source_files[filename] = hashlib.sha256(
             contents[filename].encode("utf8")
         ).hexdigest()
         output_filename = os.path.join(output_base_dir, filename)
         if os.path.isfile(output_filename):
-            output_files[filename] = hash_file(filename)
+            inspect_output_file(filename, output_filename)
 
-    deleted_paths = set()
+    deleted_files = set()
     for path in deleted_paths:
         absolute_path = os.path.join(output_base_dir, path)
         if os.path.exists(absolute_path):
-            deleted_paths.add(path)
+            deleted_files.add(path)
 
     for source_dir, output_dir in zip(source_dirs, output_dirs):
         for filename in list_files(source_dir, ignore_filenames, ignore_directories):
             relative_path = os.path.relpath(filename, source_base_dir)
-            source_files[relative_path] = hash_file(filename)
+            if relative_path in source_index:
+                source_files[relative_path] = source_index[relative_path]
+            else:
+                unhashed_source_files[relative_path] = filename
 
         for filename in list_files(output_dir, ignore_filenames, ignore_directories):
             relative_path = os.path.relpath(filename, output_base_dir)
-            output_files[relative_path] = hash_file(filename)
+            if relative_path not in contents:
+                inspect_output_file(relative_path, filename)
+
+    # hash both sides of the diff in a single pass over the thread pool
+    digests = hash_files(
+        [
+            *unhashed_source_files.values(),
+            *(path for path, _ in unhashed_output_files.values()),
+        ]
+    )
+
+    for relative_path, filename in unhashed_source_files.items():
+        source_files[relative_path] = digests[filename]
+
+    for relative_path, (filename, stat) in unhashed_output_files.items():
+        output_files[relative_path] = digests[filename]
+        manifest[relative_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": digests[filename],
+        }
 
     new_files = source_files.keys() - output_files.keys()
     untracted_files = output_files.keys() - source_files.keys()
@@ -286,17 +509,209 @@ def inspect_files(
         if source_files[prevalent_file] != output_files[prevalent_file]:
             updated_files.add(prevalent_file)
 
-    return new_files, untracted_files, updated_files, deleted_paths
+    return new_files, untracted_files, updated_files, deleted_files
 
 
 def hash_file(file_path: str):
     """Get the hex digest of the given file
 
+    The file is read in chunks of `HASH_CHUNK_SIZE` bytes so that large
+    files are never fully loaded into memory. Reads are unbuffered and
+    no larger than the file so that the many small rendered files do
+    not each allocate a whole chunk.
+
     Args:
         file_path (str): path to file
     """
-    with open(file_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        chunk_size = max(min(os.fstat(fd).st_size, HASH_CHUNK_SIZE), 1)
+        sha256 = hashlib.sha256()
+        for chunk in iter(functools.partial(os.read, fd, chunk_size), b""):
+            sha256.update(chunk)
+    finally:
+        os.close(fd)
+    return sha256.hexdigest()
+
+
+def hash_files(file_paths: List[str], max_workers: int = None) -> Dict[str, str]:
+    """Get the hex digest of each of the given files
+
+    hashlib releases the GIL while hashing so files are grouped into
+    batches of roughly `HASH_BATCH_SIZE` bytes which are hashed
+    concurrently on a thread pool. Small file sets end up in a single
+    batch and are hashed in the calling thread to avoid the thread
+    pool overhead. With a single worker the files are hashed in the
+    calling thread without first reading their sizes.
+
+    Args:
+        file_paths (list[str]): paths to files
+        max_workers (int): size of the thread pool, defaults to the
+            number of cpus
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1:
+        return {file_path: hash_file(file_path) for file_path in file_paths}
+
+    batches, batch, batch_size = [], [], 0
+    for file_path in file_paths:
+        batch.append(file_path)
+        batch_size += os.path.getsize(file_path)
+        if batch_size >= HASH_BATCH_SIZE:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+
+    def _hash_batch(batch: List[str]):
+        return [(file_path, hash_file(file_path)) for file_path in batch]
+
+    if len(batches) <= 1:
+        return {
+            file_path: digest
+            for batch in batches
+            for file_path, digest in _hash_batch(batch)
+        }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {
+            file_path: digest
+            for digests in executor.map(_hash_batch, batches)
+            for file_path, digest in digests
+        }
+
+
+def manifest_entry_matches(entry: Optional[Dict], stat: os.stat_result) -> bool:
+    return bool(
+        entry
+        and entry.get("size") == stat.st_size
+        and entry.get("mtime") == stat.st_mtime_ns
+    )
+
+
+def manifest_entry(file_path: str):
+    """Get the render manifest entry (size, mtime and sha256) of the given file
+
+    Args:
+        file_path (str): path to file
+    """
+    stat = os.stat(file_path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": hash_file(file_path),
+    }
+
+
+def render_manifest_path(output_directory) -> pathlib.Path:
+    return (
+        pathlib.Path(output_directory) / QHUB_STATE_DIRECTORY / RENDER_MANIFEST_FILENAME
+    )
+
+
+def load_render_manifest(output_directory) -> Dict[str, Dict]:
+    """Load the render manifest of the output directory
+
+    A missing or unreadable manifest is treated as empty which forces
+    every output file to be hashed.
+    """
+    manifest_path = render_manifest_path(output_directory)
+    try:
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest.get("files", {})
+
+
+def save_render_manifest(output_directory, manifest: Dict[str, Dict]):
+    manifest_path = render_manifest_path(output_directory)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+    temp_path = manifest_path.with_suffix(".tmp")
+    with temp_path.open("w") as f:
+        json.dump({"files": manifest}, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def template_index_path(template_directory) -> pathlib.Path:
+    return pathlib.Path(template_directory).parent / TEMPLATE_INDEX_FILENAME
+
+
+def build_template_index(template_directory) -> Dict:
+    """Compute the size and sha256 of every file in the template directory
+
+    The result is written to `template_index_path` when building the
+    qhub package, see `scripts/generate-template-index.py`.
+    """
+    from qhub.version import __version__
+
+    paths = []
+    for root, dirs, filenames in os.walk(template_directory):
+        dirs[:] = [d for d in dirs if d not in {".terraform", "__pycache__"}]
+        paths.extend(os.path.join(root, filename) for filename in filenames)
+
+    digests = hash_files(paths)
+    files = {
+        os.path.relpath(path, template_directory): {
+            "size": os.path.getsize(path),
+            "sha256": digests[path],
+        }
+        for path in paths
+    }
+
+    return {"version": __version__, "files": files}
+
+
+@functools.lru_cache(maxsize=None)
+def load_template_index(template_directory: str) -> Optional[Dict[str, str]]:
+    """Load the precomputed sha256 of the template files shipped with qhub
+
+    Returns a mapping of path relative to the template directory to
+    sha256 or `None` when the index is missing or no longer matches the
+    template directory, in which case the template files are hashed.
+    The index is considered stale when it was built for a different qhub
+    version, the set of files or their sizes differ, or in a development
+    checkout when a template file was modified after the index.
+    """
+    from qhub.version import __version__
+
+    index_path = template_index_path(template_directory)
+    try:
+        with index_path.open() as f:
+            index = json.load(f)
+        index_mtime = index_path.stat().st_mtime_ns
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(index, dict) or index.get("version") != __version__:
+        return None
+
+    is_development_checkout = (
+        pathlib.Path(template_directory).parent.parent / ".git"
+    ).exists()
+
+    files = index.get("files", {})
+    num_files = 0
+    for root, dirs, filenames in os.walk(template_directory):
+        dirs[:] = [d for d in dirs if d not in {".terraform", "__pycache__"}]
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            entry = files.get(os.path.relpath(path, template_directory))
+            stat = os.stat(path)
+            if entry is None or entry["size"] != stat.st_size:
+                return None
+            if is_development_checkout and stat.st_mtime_ns > index_mtime:
+                return None
+            num_files += 1
+
+    if num_files != len(files):
+        return None
+
+    return {filename: entry["sha256"] for filename, entry in files.items()}
 
 
 def set_env_vars_in_config(config):
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DNS_PORT = 53
+QUERY_TIMEOUT = 2  # seconds
+FALLBACK_NAMESERVERS = [("1.1.1.1", DNS_PORT), ("8.8.8.8", DNS_PORT)]
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+CLASS_IN = 1
+
+FLAG_RESPONSE = 0x8000
+FLAG_AUTHORITATIVE = 0x0400
+FLAG_TRUNCATED = 0x0200
+FLAG_RECURSION_DESIRED = 0x0100
+RCODE_NXDOMAIN = 3
+
+
+class DNSError(Exception):
+    pass
+
+
+def normalize_name(name: str) -> str:
+    return name.rstrip(".").lower()
+
+
+def encode_name(name: str) -> bytes:
+    labels = [_ for _ in normalize_name(name).split(".") if _]
+    return b"".join(bytes([len(_)]) + _.encode("ascii") for _ in labels) + b"\0"
+
+
+def decode_name(data: bytes, offset: int) -> Tuple[str, int]:
+    """Name at `offset` following compression pointers, along with the
+    offset after the name"""
+    labels = []
+    end_offset = None
+    for _ in range(128):  # bounds pointer loops
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = struct.unpack("!H", data[offset : offset + 2])[0] & 0x3FFF
+        elif length == 0:
+            return ".".join(labels), end_offset or offset + 1
+        else:
+            labels.append(data[offset + 1 : offset + 1 + length].decode("ascii"))
+            offset += 1 + length
+    raise DNSError("malformed dns name")
+
+
+def encode_record(name: str, rtype: int, value: str, ttl: int = 60) -> bytes:
+    if rtype == TYPE_A:
+        rdata = socket.inet_aton(value)
+    else:
+        rdata = encode_name(value)
+    return (
+        encode_name(name)
+        + struct.pack("!HHIH", rtype, CLASS_IN, ttl, len(rdata))
+        + rdata
+    )
+
+
+def encode_message(
+    message_id: int,
+    flags: int,
+    questions: List[Tuple[str, int]],
+    answers: List[Tuple[str, int, str]] = (),
+    authority: List[Tuple[str, int, str]] = (),
+    additional: List[Tuple[str, int, str]] = (),
+) -> bytes:
+    """DNS message in wire format, records are (name, type, value)"""
+    header = struct.pack(
+        "!HHHHHH",
+        message_id,
+        flags,
+        len(questions),
+        len(answers),
+        len(authority),
+        len(additional),
+    )
+    body = b"".join(
+        encode_name(name) + struct.pack("!HH", rtype, CLASS_IN)
+        for name, rtype in questions
+    )
+    for records in (answers, authority, additional):
+        body += b"".join(encode_record(*_) for _ in records)
+    return header + body
+
+
+def decode_message(data: bytes) -> Dict:
+    """Header, questions and the A, NS and CNAME records of a message"""
+    try:
+        message_id, flags, qdcount, ancount, nscount, arcount = struct.unpack(
+            "!HHHHHH", data[:12]
+        )
+        offset = 12
+        questions = []
+        for _ in range(qdcount):
+            name, offset = decode_name(data, offset)
+            rtype, _class = struct.unpack("!HH", data[offset : offset + 4])
+            questions.append((normalize_name(name), rtype))
+            offset += 4
+
+        sections = []
+        for count in (ancount, nscount, arcount):
+            records = []
+            for _ in range(count):
+                name, offset = decode_name(data, offset)
+                rtype, _class, _ttl, length = struct.unpack(
+                    "!HHIH", data[offset : offset + 10]
+                )
+                offset += 10
+                if rtype == TYPE_A and length == 4:
+                    records.append(
+                        (
+                            normalize_name(name),
+                            rtype,
+                            socket.inet_ntoa(data[offset : offset + 4]),
+                        )
+                    )
+                elif rtype in {TYPE_NS, TYPE_CNAME}:
+                    records.append(
+                        (
+                            normalize_name(name),
+                            rtype,
+                            normalize_name(decode_name(data, offset)[0]),
+                        )
+                    )
+                offset += length
+            sections.append(records)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise DNSError(f"malformed dns message: {e}")
+
+    return {
+        "id": message_id,
+        "flags": flags,
+        "rcode": flags & 0xF,
+        "questions": questions,
+        "answers": sections[0],
+        "authority": sections[1],
+        "additional": sections[2],
+    }
+
+
+def query(
+    nameserver: Tuple[str, int],
+    name: str,
+    rtype: int,
+    recursion_desired: bool = False,
+    timeout: float = QUERY_TIMEOUT,
+) -> Dict:
+    """Send a single query to `nameserver` over udp, retrying over tcp
+    when the response was truncated"""
+    message_id = random.getrandbits(16)
+    flags = FLAG_RECURSION_DESIRED if recursion_desired else 0
+    request = encode_message(message_id, flags, [(name, rtype)])
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(timeout)
+        s.sendto(request, nameserver)
+        while True:
+            data, _ = s.recvfrom(4096)
+            response = decode_message(data)
+            if response["id"] == message_id:
+                break
+
+    if response["flags"] & FLAG_TRUNCATED:
+        with socket.create_connection(nameserver, timeout=timeout) as s:
+            s.sendall(struct.pack("!H", len(request)) + request)
+            length = struct.unpack("!H", _recv_exactly(s, 2))[0]
+            response = decode_message(_recv_exactly(s, length))
+    return response
+
+
+def _recv_exactly(s, length: int) -> bytes:
+    data = b""
+    while len(data) < length:
+        chunk = s.recv(length - len(data))
+        if not chunk:
+            raise DNSError("connection closed by nameserver")
+        data += chunk
+    return data
+
+
+def system_nameservers(resolv_conf: str = "/etc/resolv.conf") -> List[Tuple[str, int]]:
+    """Recursive nameservers of the system, used only to discover the
+    authoritative nameservers of a zone"""
+    nameservers = []
+    try:
+        with open(resolv_conf) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    if ":" not in fields[1]:  # ipv4 only
+                        nameservers.append((fields[1], DNS_PORT))
+    except OSError:
+        pass
+    return nameservers or FALLBACK_NAMESERVERS
+
+
+def authoritative_nameservers(
+    domain: str, resolvers: List[Tuple[str, int]] = None, port: int = DNS_PORT
+) -> List[Tuple[str, int]]:
+    """Addresses of the authoritative nameservers of the zone of `domain`
+
+    The NS records of the domain and then of each parent domain are
+    queried through the recursive `resolvers` until a zone is found.
+    """
+    resolvers = resolvers or system_nameservers()
+
+    def _recursive_query(name, rtype):
+        errors = []
+        for resolver in resolvers:
+            try:
+                return query(resolver, name, rtype, recursion_desired=True)
+            except (OSError, DNSError) as e:
+                errors.append(f"{resolver[0]}: {e}")
+        raise DNSError(f"no resolver answered for name={name}: {errors}")
+
+    labels = normalize_name(domain).split(".")
+    for index in range(len(labels) - 1):
+        zone = ".".join(labels[index:])
+        response = _recursive_query(zone, TYPE_NS)
+        # a resolver following a CNAME of `zone` answers with the NS
+        # records of the CNAME target, which belong to another zone
+        names = [
+            value
+            for name, rtype, value in response["answers"]
+            if rtype == TYPE_NS and name == zone
+        ]
+        if not names:
+            continue
+
+        glue = {
+            name: value
+            for name, rtype, value in response["additional"]
+            if rtype == TYPE_A
+        }
+        addresses = []
+        for name in names:
+            if name not in glue:
+                response = _recursive_query(name, TYPE_A)
+                glue.update(
+                    {n: v for n, rtype, v in response["answers"] if rtype == TYPE_A}
+                )
+            if name in glue:
+                addresses.append(glue[name])
+        if addresses:
+            logger.info(f"authoritative nameservers of zone={zone}: {names}")
+            return [(address, port) for address in addresses]
+
+    raise DNSError(f"no authoritative nameservers found for domain={domain}")
+
+
+def authoritative_records(
+    domain: str, nameservers: List[Tuple[str, int]]
+) -> Dict[str, List[str]]:
+    """A and CNAME records of `domain` according to its authoritative
+    nameservers, queried directly without recursion so that no
+    resolver cache is involved"""
+    errors = []
+    for nameserver in nameservers:
+        try:
+            response = query(nameserver, domain, TYPE_A)
+        except (OSError, DNSError) as e:
+            errors.append(f"{nameserver[0]}: {e}")
+            continue
+
+        records = {"A": [], "CNAME": []}
+        if response["rcode"] == RCODE_NXDOMAIN:
+            return records
+        for name, rtype, value in response["answers"]:
+            if name == normalize_name(domain) and rtype == TYPE_A:
+                records["A"].append(value)
+            elif name == normalize_name(domain) and rtype == TYPE_CNAME:
+                records["CNAME"].append(value)
+        return records
+    raise DNSError(f"no authoritative nameserver answered: {errors}")
+
+
+def record_matches(
+    records: Dict[str, List[str]], ip: str, hostname: Optional[str] = None
+) -> bool:
+    """Whether the records point at the ingress, either by a CNAME to its
+    load balancer `hostname` or by an A record of its `ip`"""
+    if hostname and normalize_name(hostname) in records["CNAME"]:
+        return True
+    return ip in records["A"]
+
+
+def authoritative_record(
+    domain: str,
+    nameservers: List[Tuple[str, int]],
+    ip: str,
+    hostname: Optional[str] = None,
+) -> Callable[[], Awaitable[bool]]:
+    """Probe attempt which is ready once the authoritative nameservers
+    point `domain` at the ingress, see `record_matches`"""
+
+    async def _attempt():
+        try:
+            records = await asyncio.get_running_loop().run_in_executor(
+                None, authoritative_records, domain, nameservers
+            )
+        except DNSError as e:
+            raise OSError(str(e))
+        if not record_matches(records, ip, hostname):
+            logger.info(f"authoritative records of domain={domain}: {records}")
+            return False
+        return True
+
+    return _attempt
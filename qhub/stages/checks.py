@@ -1,70 +1,94 @@
-import sys
 import time
 import socket
 
+from qhub.stages import authoritative_dns, kubernetes_watch, probes
+from qhub.tracing import span
+
 
 # check and retry settings
 NUM_ATTEMPTS = 10
 TIMEOUT = 10  # seconds
 
+# polling of the authoritative nameservers for the ingress dns record
+DNS_ROUNDS = 3
+DNS_DEADLINE = 300  # seconds
+DNS_MAX_BACKOFF = 10  # seconds
+
+
+class CheckException(Exception):
+    pass
+
 
 def stage_02_infrastructure(stage_outputs, qhub_config):
-    from kubernetes import client, config
-    from kubernetes.client.rest import ApiException
+    from kubernetes import client
 
     directory = "stages/02-infrastructure"
-    config.load_kube_config(
-        config_file=stage_outputs["stages/02-infrastructure"]["kubeconfig_filename"][
-            "value"
-        ]
+    api_client = kubernetes_watch.api_client(
+        stage_outputs["stages/02-infrastructure"]["kubeconfig_filename"]["value"]
     )
+    deadline = time.monotonic() + kubernetes_watch.WATCH_DEADLINE
 
-    try:
-        api_instance = client.CoreV1Api()
-        result = api_instance.list_namespace()
-    except ApiException:
-        print(
-            f"ERROR: After stage directory={directory} unable to connect to kubernetes cluster"
+    ready, nodes = kubernetes_watch.watch_until(
+        client.CoreV1Api(api_client=api_client).list_node,
+        kubernetes_watch.nodes_ready,
+        deadline,
+    )
+    if not ready:
+        raise CheckException(
+            f"After stage directory={directory} no nodes ready within kubernetes cluster, found nodes={sorted(nodes)}"
         )
-        sys.exit(1)
 
-    if len(result.items) < 1:
-        print(
-            f"ERROR: After stage directory={directory} no nodes provisioned within kubernetes cluster"
+    # cluster dns is required by every workload of the later stages
+    ready, deployments = kubernetes_watch.watch_until(
+        client.AppsV1Api(api_client=api_client).list_namespaced_deployment,
+        kubernetes_watch.deployments_available,
+        deadline,
+        namespace="kube-system",
+        label_selector="k8s-app=kube-dns",
+    )
+    if not ready:
+        raise CheckException(
+            f"After stage directory={directory} kubernetes cluster dns deployments={kubernetes_watch.unavailable_deployments(deployments)} not available"
         )
-        sys.exit(1)
 
     print(
-        f"After stage directory={directory} kubernetes cluster successfully provisioned"
+        f"After stage directory={directory} kubernetes cluster successfully provisioned with {len(nodes)} nodes"
     )
 
 
 def stage_03_kubernetes_initialize(stage_outputs, qhub_config):
-    from kubernetes import client, config
-    from kubernetes.client.rest import ApiException
+    from kubernetes import client
 
     directory = "stages/03-kubernetes-initialize"
-    config.load_kube_config(
-        config_file=stage_outputs["stages/02-infrastructure"]["kubeconfig_filename"][
-            "value"
-        ]
+    api_client = kubernetes_watch.api_client(
+        stage_outputs["stages/02-infrastructure"]["kubeconfig_filename"]["value"]
     )
-
-    try:
-        api_instance = client.CoreV1Api()
-        result = api_instance.list_namespace()
-    except ApiException:
-        print(
-            f"ERROR: After stage directory={directory} unable to connect to kubernetes cluster"
+    deadline = time.monotonic() + kubernetes_watch.WATCH_DEADLINE
+    namespace = qhub_config["namespace"]
+
+    ready, _ = kubernetes_watch.watch_until(
+        client.CoreV1Api(api_client=api_client).list_namespace,
+        kubernetes_watch.namespace_active(namespace),
+        deadline,
+        field_selector=f"metadata.name={namespace}",
+    )
+    if not ready:
+        raise CheckException(
+            f"After stage directory={directory} namespace={namespace} not active within kubernetes cluster"
         )
-        sys.exit(1)
 
-    namespaces = {_.metadata.name for _ in result.items}
-    if qhub_config["namespace"] not in namespaces:
-        print(
-            f"ERROR: After stage directory={directory} namespace={config['namespace']} not provisioned within kubernetes cluster"
+    if qhub_config["provider"] == "aws":
+        ready, deployments = kubernetes_watch.watch_until(
+            client.AppsV1Api(api_client=api_client).list_namespaced_deployment,
+            kubernetes_watch.deployments_available,
+            deadline,
+            namespace=namespace,
+            label_selector="app.kubernetes.io/instance=cluster-autoscaler",
         )
-        sys.exit(1)
+        if not ready:
+            raise CheckException(
+                f"After stage directory={directory} cluster autoscaler deployments={kubernetes_watch.unavailable_deployments(deployments)} not available"
+            )
 
     print(f"After stage directory={directory} kubernetes initialized successfully")
 
@@ -72,27 +96,6 @@ def stage_03_kubernetes_initialize(stage_outputs, qhub_config):
 def stage_04_kubernetes_ingress(stage_outputs, qhub_config):
     directory = "stages/04-kubernetes-ingress"
 
-    def _attempt_tcp_connect(host, port, num_attempts=NUM_ATTEMPTS, timeout=TIMEOUT):
-        for i in range(num_attempts):
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                # normalize hostname to ip address
-                ip = socket.gethostbyname(host)
-                s.settimeout(5)
-                result = s.connect_ex((ip, port))
-                if result == 0:
-                    print(f"Attempt {i+1} succeded to connect to tcp://{ip}:{port}")
-                    return True
-                print(f"Attempt {i+1} failed to connect to tcp tcp://{ip}:{port}")
-            except socket.gaierror:
-                print(f"Attempt {i+1} failed to get IP for {host}...")
-            finally:
-                s.close()
-
-            time.sleep(timeout)
-
-        return False
-
     tcp_ports = {
         80,  # http
         443,  # https
@@ -105,12 +108,31 @@ def stage_04_kubernetes_ingress(stage_outputs, qhub_config):
     host = ip_or_name["hostname"] or ip_or_name["ip"]
     host = host.strip("\n")
 
-    for port in tcp_ports:
-        if not _attempt_tcp_connect(host, port):
-            print(
-                f"ERROR: After stage directory={directory} unable to connect to ingress host={host} port={port}"
-            )
-            sys.exit(1)
+    # resolve the load balancer hostname once then probe all ports
+    # concurrently within the same overall deadline
+    deadline = time.monotonic() + probes.DEFAULT_DEADLINE
+    addresses = []
+    if not probes.run_probes(
+        {host: probes.resolve_host(host, addresses)},
+        deadline=deadline - time.monotonic(),
+        stage=directory,
+    )[host]["ready"]:
+        raise CheckException(
+            f"After stage directory={directory} unable to resolve host={host}"
+        )
+
+    ip = addresses[0]
+    results = probes.run_probes(
+        {f"tcp://{ip}:{port}": probes.tcp_connect(ip, port) for port in tcp_ports},
+        deadline=deadline - time.monotonic(),
+        stage=directory,
+    )
+
+    failed = sorted(name for name, result in results.items() if not result["ready"])
+    if failed:
+        raise CheckException(
+            f"After stage directory={directory} unable to connect to ingress host={host} at {failed}"
+        )
 
     print(
         f"After stage directory={directory} kubernetes ingress available on tcp ports={tcp_ports}"
@@ -121,56 +143,73 @@ def check_ingress_dns(stage_outputs, config, disable_prompt):
     directory = "stages/04-kubernetes-ingress"
 
     ip_or_name = stage_outputs[directory]["load_balancer_address"]["value"]
-    ip = socket.gethostbyname(ip_or_name["hostname"] or ip_or_name["ip"])
+    hostname = ip_or_name["hostname"]
+    ip = socket.gethostbyname(hostname or ip_or_name["ip"])
     domain_name = config["domain"]
 
-    def _attempt_dns_lookup(
-        domain_name, ip, num_attempts=NUM_ATTEMPTS, timeout=TIMEOUT
-    ):
-        for i in range(num_attempts):
+    # the authoritative nameservers see a new record immediately, the
+    # local resolver covers domains only known locally e.g. /etc/hosts
+    attempts = []
+    try:
+        nameservers = authoritative_dns.authoritative_nameservers(domain_name)
+        attempts.append(
+            authoritative_dns.authoritative_record(
+                domain_name, nameservers, ip, hostname
+            )
+        )
+    except (OSError, authoritative_dns.DNSError) as e:
+        print(
+            f"Unable to query the authoritative nameservers of domain={domain_name}, polling the local resolver: {e}"
+        )
+
+    addresses = []
+    resolve_host = probes.resolve_host(domain_name, addresses)
+
+    async def _local_resolver():
+        return await resolve_host() and ip in addresses
+
+    attempts.append(_local_resolver)
+
+    async def _attempt_dns_lookup():
+        error = None
+        for attempt in attempts:
             try:
-                resolved_ip = socket.gethostbyname(domain_name)
-                if resolved_ip == ip:
-                    print(
-                        f"DNS configured domain={domain_name} matches ingress ip={ip}"
-                    )
+                if await attempt():
                     return True
-                else:
-                    print(
-                        f"Attempt {i+1} polling DNS domain={domain_name} does not match ip={ip} instead got {resolved_ip}"
-                    )
-            except socket.gaierror:
-                print(
-                    f"Attempt {i+1} polling DNS domain={domain_name} record does not exist"
-                )
-            time.sleep(timeout)
+            except OSError as e:
+                error = e
+        if error is not None:
+            raise error
         return False
 
-    attempt = 0
-    while not _attempt_dns_lookup(domain_name, ip):
-        sleeptime = 60 * (2**attempt)
-        if not disable_prompt:
+    for i in range(DNS_ROUNDS):
+        results = probes.run_probes(
+            {domain_name: _attempt_dns_lookup},
+            deadline=DNS_DEADLINE,
+            stage=directory,
+            max_backoff=DNS_MAX_BACKOFF,
+        )
+        if results[domain_name]["ready"]:
+            print(f"DNS configured domain={domain_name} matches ingress ip={ip}")
+            return
+
+        if i + 1 < DNS_ROUNDS and not disable_prompt:
             input(
-                f"After attempting to poll the DNS, the record for domain={domain_name} appears not to exist, "
-                f"has recently been updated, or has yet to fully propagate. This non-deterministic behavior is likely due to "
-                f"DNS caching and will likely resolve itself in a few minutes.\n\n\tTo poll the DNS again in {sleeptime} seconds "
+                f"After polling the DNS for {DNS_DEADLINE} seconds, the record for domain={domain_name} appears not to exist "
+                f"or does not point to ip={ip}. The authoritative nameservers of the domain are queried directly, "
+                f"so the record has likely not been created or updated yet.\n\n\tTo poll the DNS again "
                 f"[Press Enter].\n\n...otherwise kill the process and run the deployment again later..."
             )
 
-        print(f"Will attempt to poll DNS again in {sleeptime} seconds...")
-        time.sleep(sleeptime)
-        attempt += 1
-        if attempt == 5:
-            print(
-                f"ERROR: After stage directory={directory} DNS domain={domain_name} does not point to ip={ip}"
-            )
-            sys.exit(1)
+    raise CheckException(
+        f"After stage directory={directory} DNS domain={domain_name} does not point to ip={ip}"
+    )
 
 
 def stage_05_kubernetes_keycloak(stage_outputs, config):
     directory = "stages/05-kubernetes-keycloak"
 
-    from keycloak import KeycloakAdmin
+    from qhub.keycloak import keycloak_admin_session
     from keycloak.exceptions import KeycloakError
 
     keycloak_url = (
@@ -188,19 +227,24 @@ def stage_05_kubernetes_keycloak(stage_outputs, config):
         timeout=TIMEOUT,
     ):
         for i in range(num_attempts):
-            try:
-                KeycloakAdmin(
-                    keycloak_url,
-                    username=username,
-                    password=password,
-                    realm_name=realm_name,
-                    client_id=client_id,
-                    verify=verify,
-                )
-                print(f"Attempt {i+1} succeded connecting to keycloak master realm")
-                return True
-            except KeycloakError:
-                print(f"Attempt {i+1} failed connecting to keycloak master realm")
+            with span(
+                "check attempt", stage=directory, attempt=i + 1, url=keycloak_url
+            ) as _span:
+                try:
+                    keycloak_admin_session(
+                        keycloak_url,
+                        username=username,
+                        password=password,
+                        realm_name=realm_name,
+                        client_id=client_id,
+                        verify=verify,
+                    )
+                    _span.set_attribute("success", True)
+                    print(f"Attempt {i+1} succeded connecting to keycloak master realm")
+                    return True
+                except KeycloakError:
+                    _span.set_attribute("success", False)
+                    print(f"Attempt {i+1} failed connecting to keycloak master realm")
             time.sleep(timeout)
         return False
 
@@ -212,10 +256,9 @@ def stage_05_kubernetes_keycloak(stage_outputs, config):
         stage_outputs[directory]["keycloak_credentials"]["value"]["client_id"],
         verify=False,
     ):
-        print(
-            f"ERROR: unable to connect to keycloak master realm at url={keycloak_url} with root credentials"
+        raise CheckException(
+            f"Unable to connect to keycloak master realm at url={keycloak_url} with root credentials"
         )
-        sys.exit(1)
 
     print("Keycloak service successfully started")
 
@@ -223,7 +266,10 @@ def stage_05_kubernetes_keycloak(stage_outputs, config):
 def stage_06_kubernetes_keycloak_configuration(stage_outputs, config):
     directory = "stages/05-kubernetes-keycloak"
 
-    from keycloak import KeycloakAdmin
+    from qhub.keycloak import (
+        evict_keycloak_admin_session,
+        keycloak_admin_session,
+    )
     from keycloak.exceptions import KeycloakError
 
     keycloak_url = (
@@ -242,27 +288,40 @@ def stage_06_kubernetes_keycloak_configuration(stage_outputs, config):
         timeout=TIMEOUT,
     ):
         for i in range(num_attempts):
-            try:
-                realm_admin = KeycloakAdmin(
-                    keycloak_url,
-                    username=username,
-                    password=password,
-                    realm_name=realm_name,
-                    client_id=client_id,
-                    verify=verify,
-                )
-                existing_realms = {_["id"] for _ in realm_admin.get_realms()}
-                if qhub_realm in existing_realms:
-                    print(
-                        f"Attempt {i+1} succeded connecting to keycloak and qhub realm={qhub_realm} exists"
+            with span(
+                "check attempt",
+                stage="stages/06-kubernetes-keycloak-configuration",
+                attempt=i + 1,
+                url=keycloak_url,
+            ) as _span:
+                realm_admin = None
+                try:
+                    # shares the token of the stage 05 check
+                    realm_admin = keycloak_admin_session(
+                        keycloak_url,
+                        username=username,
+                        password=password,
+                        realm_name=realm_name,
+                        client_id=client_id,
+                        verify=verify,
                     )
-                    return True
-                else:
-                    print(
-                        f"Attempt {i+1} succeeded connecting to keycloak but qhub realm did not exist"
-                    )
-            except KeycloakError:
-                print(f"Attempt {i+1} failed connecting to keycloak master realm")
+                    existing_realms = {_["id"] for _ in realm_admin.get_realms()}
+                    _span.set_attribute("success", qhub_realm in existing_realms)
+                    if qhub_realm in existing_realms:
+                        print(
+                            f"Attempt {i+1} succeded connecting to keycloak and qhub realm={qhub_realm} exists"
+                        )
+                        return True
+                    else:
+                        print(
+                            f"Attempt {i+1} succeeded connecting to keycloak but qhub realm did not exist"
+                        )
+                except KeycloakError:
+                    _span.set_attribute("success", False)
+                    print(f"Attempt {i+1} failed connecting to keycloak master realm")
+                    # the next attempt authenticates with a new session
+                    if realm_admin is not None:
+                        evict_keycloak_admin_session(realm_admin)
             time.sleep(timeout)
         return False
 
@@ -277,39 +336,43 @@ def stage_06_kubernetes_keycloak_configuration(stage_outputs, config):
         ]["value"],
         verify=False,
     ):
-        print(
-            "ERROR: unable to connect to keycloak master realm and ensure that qhub realm exists"
+        raise CheckException(
+            "Unable to connect to keycloak master realm and ensure that qhub realm exists"
         )
-        sys.exit(1)
 
     print("Keycloak service successfully started with qhub realm")
 
 
 def stage_07_kubernetes_services(stage_outputs, config):
     directory = "stages/07-kubernetes-services"
-    import requests
 
     # supress insecure warnings
     import urllib3
 
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    def _attempt_connect_url(
-        url, verify=False, num_attempts=NUM_ATTEMPTS, timeout=TIMEOUT
-    ):
-        for i in range(num_attempts):
-            response = requests.get(service_url, verify=verify, timeout=timeout)
-            if response.status_code < 400:
-                print(f"Attempt {i+1} health check succeded for url={url}")
-                return True
-            else:
-                print(f"Attempt {i+1} health check failed for url={url}")
-            time.sleep(timeout)
-        return False
-
     services = stage_outputs[directory]["service_urls"]["value"]
-    for service_name, service in services.items():
-        service_url = service["health_url"]
-        if not _attempt_connect_url(service_url):
-            print(f"ERROR: Service {service_name} DOWN when checking url={service_url}")
-            sys.exit(1)
+
+    # all services are checked concurrently, each executor thread over
+    # its own session with keep-alive connections to the ingress
+    health_urls = [service["health_url"] for service in services.values()]
+    with probes.thread_sessions(health_urls) as get_session:
+        results = probes.run_probes(
+            {
+                service_name: probes.http_get(
+                    get_session, service["health_url"], verify=False, timeout=TIMEOUT
+                )
+                for service_name, service in services.items()
+            },
+            stage=directory,
+            attempt_timeout=TIMEOUT,
+        )
+    probes.print_probe_table(results)
+
+    down = {
+        service_name: services[service_name]["health_url"]
+        for service_name, result in results.items()
+        if not result["ready"]
+    }
+    if down:
+        raise CheckException(f"Services DOWN when checking urls={down}")
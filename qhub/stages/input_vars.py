@@ -4,6 +4,14 @@ import json
 from urllib.parse import urlencode
 
 
+def kubeconfig_filename():
+    """Kubeconfig written by stage 02, `QHUB_KUBECONFIG` gives each of
+    several deployments on one machine a kubeconfig of its own"""
+    return os.environ.get("QHUB_KUBECONFIG") or os.path.join(
+        tempfile.gettempdir(), "QHUB_KUBECONFIG"
+    )
+
+
 def stage_01_terraform_state(stage_outputs, config):
     if config["provider"] == "do":
         return {
@@ -44,9 +52,7 @@ def stage_02_infrastructure(stage_outputs, config):
             "region": config["digital_ocean"]["region"],
             "kubernetes_version": config["digital_ocean"]["kubernetes_version"],
             "node_groups": config["digital_ocean"]["node_groups"],
-            "kubeconfig_filename": os.path.join(
-                tempfile.gettempdir(), "QHUB_KUBECONFIG"
-            ),
+            "kubeconfig_filename": kubeconfig_filename(),
         }
     elif config["provider"] == "gcp":
         return {
@@ -67,9 +73,7 @@ def stage_02_infrastructure(stage_outputs, config):
                 }
                 for key, value in config["google_cloud_platform"]["node_groups"].items()
             ],
-            "kubeconfig_filename": os.path.join(
-                tempfile.gettempdir(), "QHUB_KUBECONFIG"
-            ),
+            "kubeconfig_filename": kubeconfig_filename(),
         }
     elif config["provider"] == "azure":
         return {
@@ -78,9 +82,7 @@ def stage_02_infrastructure(stage_outputs, config):
             "region": config["azure"]["region"],
             "kubernetes_version": config["azure"]["kubernetes_version"],
             "node_groups": config["azure"]["node_groups"],
-            "kubeconfig_filename": os.path.join(
-                tempfile.gettempdir(), "QHUB_KUBECONFIG"
-            ),
+            "kubeconfig_filename": kubeconfig_filename(),
             "resource_group_name": f'{config["project_name"]}-{config["namespace"]}',
             "node_resource_group_name": f'{config["project_name"]}-{config["namespace"]}-node-resource-group',
         }
@@ -99,9 +101,7 @@ def stage_02_infrastructure(stage_outputs, config):
                 }
                 for key, value in config["amazon_web_services"]["node_groups"].items()
             ],
-            "kubeconfig_filename": os.path.join(
-                tempfile.gettempdir(), "QHUB_KUBECONFIG"
-            ),
+            "kubeconfig_filename": kubeconfig_filename(),
         }
     else:
         return {}
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import nacl.exceptions
+import nacl.secret
+import nacl.utils
+from nacl.encoding import Base64Encoder
+
+from qhub import constants
+from qhub.utils import file_lock, qhub_cache_directory
+
+STAGE_JOURNAL_FILENAME = "stage-journal.json"
+JOURNAL_KEY_FILENAME = "journal.key"
+
+STAGE_APPLIED = "applied"
+STAGE_COMPLETE = "complete"
+
+# files within a stage directory which do not affect what is deployed
+IGNORED_FILENAMES = {
+    "terraform.tfstate",
+    "terraform.tfstate.backup",
+    ".terraform.tfstate.lock.info",
+}
+IGNORED_DIRECTORIES = {".terraform", "__pycache__"}
+
+
+def stage_journal_path(output_directory=None) -> str:
+    return os.path.join(
+        output_directory or os.curdir,
+        constants.QHUB_STATE_DIRECTORY,
+        STAGE_JOURNAL_FILENAME,
+    )
+
+
+def stable_outputs(stage_outputs: Dict) -> Dict:
+    """Stage outputs without values which change on every apply
+
+    Short lived kubernetes tokens (aws, gcp) are regenerated by every
+    refresh and would otherwise invalidate all downstream stages.
+    """
+    outputs = json.loads(json.dumps(stage_outputs))
+    for outputs_ in outputs.values():
+        credentials = outputs_.get("kubernetes_credentials", {}).get("value")
+        if isinstance(credentials, dict):
+            credentials.pop("token", None)
+    return outputs
+
+
+def stage_digest(directory: str, input_vars: Dict, upstream_outputs: Dict) -> str:
+    """Digest of everything a deployment of the stage depends on
+
+    Covers the rendered files of the terraform directory, the input
+    variables of the stage and the outputs of all upstream stages.
+    """
+    from qhub.render import hash_files
+
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_DIRECTORIES)
+        paths.extend(
+            os.path.join(root, filename)
+            for filename in sorted(files)
+            if filename not in IGNORED_FILENAMES
+        )
+    digests = hash_files(paths)
+
+    sha256 = hashlib.sha256()
+    sha256.update(constants.TERRAFORM_VERSION.encode("utf-8"))
+    for path in paths:
+        sha256.update(os.path.relpath(path, directory).encode("utf-8"))
+        sha256.update(digests[path].encode("utf-8"))
+    sha256.update(json.dumps(input_vars, sort_keys=True, default=str).encode("utf-8"))
+    sha256.update(
+        json.dumps(stable_outputs(upstream_outputs), sort_keys=True).encode("utf-8")
+    )
+    return sha256.hexdigest()
+
+
+def journal_key() -> bytes:
+    """Secret key sealing sensitive stage outputs within the journal
+
+    The key is generated once and kept in the per-user qhub cache
+    directory rather than next to the journal in the output directory.
+    """
+    filename = qhub_cache_directory() / JOURNAL_KEY_FILENAME
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(f"{filename}.lock"):
+        if not filename.exists():
+            key = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+            fd = os.open(
+                f"{filename}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(key)
+            os.replace(f"{filename}.tmp", filename)
+        return filename.read_bytes()
+
+
+def seal_outputs(stage_outputs: Dict, key: bytes) -> Dict:
+    """Terraform outputs with the values of `sensitive` outputs encrypted"""
+    box = nacl.secret.SecretBox(key)
+    sealed = {}
+    for name, output in stage_outputs.items():
+        if output.get("sensitive"):
+            output = dict(output)
+            value = json.dumps(output.pop("value", None)).encode("utf-8")
+            output["sealed_value"] = box.encrypt(value, encoder=Base64Encoder).decode(
+                "utf-8"
+            )
+        sealed[name] = output
+    return sealed
+
+
+def unseal_outputs(sealed_outputs: Dict, key: bytes) -> Dict:
+    """Inverse of `seal_outputs`, raises `nacl.exceptions.CryptoError`
+    when the outputs were sealed with a different key"""
+    box = nacl.secret.SecretBox(key)
+    stage_outputs = {}
+    for name, output in sealed_outputs.items():
+        if "sealed_value" in output:
+            output = dict(output)
+            value = box.decrypt(
+                output.pop("sealed_value").encode("utf-8"), encoder=Base64Encoder
+            )
+            output["value"] = json.loads(value)
+        stage_outputs[name] = output
+    return stage_outputs
+
+
+def is_stage_forced(stage: str, force_stages: List[str] = None) -> bool:
+    """Whether `stage` (e.g. `stages/07-kubernetes-services`) was selected
+    by `force_stages` either as `all`, the stage path, the stage name
+    `07-kubernetes-services` or the stage number `07`"""
+    stage_name = os.path.basename(stage)
+    aliases = {"all", stage, stage_name, stage_name.split("-")[0]}
+    return any(_.strip("/") in aliases for _ in force_stages or [])
+
+
+class StageJournal:
+    """Record of each stage's last successful deployment
+
+    For every stage the digest it was deployed with, its outputs and
+    whether it was only `applied` or also passed its checks and is
+    `complete` are persisted to `.qhub/stage-journal.json` within the
+    output directory. Values of sensitive outputs are sealed with the
+    `journal_key`. Stages may be recorded concurrently.
+    """
+
+    def __init__(self, filename: str, stages: Dict[str, Dict] = None):
+        self.filename = filename
+        self.stages = stages or {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, filename: str = None):
+        filename = filename or stage_journal_path()
+        try:
+            with open(filename) as f:
+                stages = json.load(f).get("stages", {})
+        except (OSError, ValueError, AttributeError):
+            stages = {}
+        return cls(filename, stages)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = f"{self.filename}.tmp"
+        with self.lock:
+            fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"stages": self.stages}, f, indent=2, sort_keys=True)
+            os.replace(temp_filename, self.filename)
+
+    def is_unchanged(self, stage: str, digest: str) -> bool:
+        return self.stages.get(stage, {}).get("digest") == digest
+
+    def is_complete(self, stage: str) -> bool:
+        return self.stages.get(stage, {}).get("status") == STAGE_COMPLETE
+
+    def record(self, stage: str, digest: str, outputs: Dict = None):
+        """Record that `stage` was applied with the given digest"""
+        entry = {"digest": digest, "status": STAGE_APPLIED}
+        if outputs is not None:
+            entry["outputs"] = seal_outputs(outputs, journal_key())
+        with self.lock:
+            self.stages[stage] = entry
+            self.save()
+
+    def invalidate(self, stage: str):
+        """Forget `stage` before it is applied, an interrupted or failed
+        apply leaves the infrastructure matching no recorded digest"""
+        with self.lock:
+            if self.stages.pop(stage, None) is not None:
+                self.save()
+
+    def update_outputs(self, stage: str, outputs: Dict):
+        sealed_outputs = seal_outputs(outputs, journal_key())
+        with self.lock:
+            if stage in self.stages:
+                self.stages[stage]["outputs"] = sealed_outputs
+                self.save()
+
+    def set_status(self, stage: str, status: str):
+        with self.lock:
+            if stage in self.stages:
+                self.stages[stage]["status"] = status
+                self.save()
+
+    def outputs(self, stage: str) -> Optional[Dict]:
+        """Recorded outputs of `stage` or None when there are none or
+        they can not be unsealed"""
+        sealed_outputs = self.stages.get(stage, {}).get("outputs")
+        if sealed_outputs is None:
+            return None
+        try:
+            return unseal_outputs(sealed_outputs, journal_key())
+        except (nacl.exceptions.CryptoError, ValueError):
+            return None
+
+    def clear(self):
+        with self.lock:
+            self.stages = {}
+            self.save()
@@ -0,0 +1,137 @@
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+from qhub.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# overall deadline of the readiness checks of a stage
+WATCH_DEADLINE = 600  # seconds
+WATCH_RETRY_DELAY = 2  # seconds
+REQUEST_TIMEOUT_MARGIN = 10  # seconds
+
+_api_client_lock = threading.Lock()
+
+
+def api_client(kubeconfig_filename: str):
+    """Kubernetes api client of `kubeconfig_filename`
+
+    The client, along with its connection pool, is built once and shared
+    by all checks. It is rebuilt only once the kubeconfig is rewritten
+    e.g. by a refresh of short lived credentials.
+    """
+    filename = os.path.abspath(kubeconfig_filename)
+    with _api_client_lock:
+        return _api_client(filename, os.stat(filename).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _api_client(filename: str, mtime: int):
+    from kubernetes import config
+
+    # a client of its own rather than the process wide default configuration
+    return config.new_client_from_config(config_file=filename)
+
+
+def watch_until(
+    list_function: Callable,
+    predicate: Callable[[Dict], bool],
+    deadline: float,
+    **kwargs,
+) -> Tuple[bool, Dict]:
+    """Watch the objects of `list_function` until `predicate` holds for
+    the objects by name or the `deadline` (in `time.monotonic` seconds)
+    passes
+
+    The objects are listed once and then kept current by watch events,
+    so readiness is noticed as soon as the api server reports it. Lost
+    connections are retried and an expired resource version triggers a
+    new list. Returns whether the predicate held along with the objects.
+    """
+    import urllib3
+    from kubernetes import watch
+    from kubernetes.client.rest import ApiException
+
+    objects = {}
+    resource_version = None
+    with span(f"watch {list_function.__name__}", **kwargs) as _span:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _span.set_attribute("success", False)
+                return False, objects
+
+            request_timeout = remaining + REQUEST_TIMEOUT_MARGIN
+            try:
+                if resource_version is None:
+                    result = list_function(_request_timeout=request_timeout, **kwargs)
+                    objects = {_.metadata.name: _ for _ in result.items}
+                    resource_version = result.metadata.resource_version
+                    if predicate(objects):
+                        _span.set_attribute("success", True)
+                        return True, objects
+
+                _watch = watch.Watch()
+                for event in _watch.stream(
+                    list_function,
+                    resource_version=resource_version,
+                    timeout_seconds=max(1, int(remaining)),
+                    _request_timeout=request_timeout,
+                    **kwargs,
+                ):
+                    obj = event["object"]
+                    resource_version = obj.metadata.resource_version
+                    if event["type"] == "DELETED":
+                        objects.pop(obj.metadata.name, None)
+                    else:
+                        objects[obj.metadata.name] = obj
+
+                    if predicate(objects):
+                        _watch.stop()
+                        _span.set_attribute("success", True)
+                        return True, objects
+            except ApiException as e:
+                if e.status == 410:  # resource version expired
+                    resource_version = None
+                    continue
+                logger.info(f"kubernetes {list_function.__name__} failed: {e.reason}")
+                time.sleep(max(0, min(WATCH_RETRY_DELAY, remaining)))
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                logger.info(f"kubernetes {list_function.__name__} failed: {e!r}")
+                time.sleep(max(0, min(WATCH_RETRY_DELAY, remaining)))
+
+
+def condition_true(obj, condition_type: str) -> bool:
+    return any(
+        _.type == condition_type and _.status == "True"
+        for _ in (obj.status.conditions or [])
+    )
+
+
+def nodes_ready(nodes: Dict) -> bool:
+    """At least one node is Ready such that workloads can be scheduled"""
+    return any(condition_true(_, "Ready") for _ in nodes.values())
+
+
+def namespace_active(name: str) -> Callable[[Dict], bool]:
+    def _predicate(namespaces):
+        return name in namespaces and namespaces[name].status.phase == "Active"
+
+    return _predicate
+
+
+def deployments_available(deployments: Dict) -> bool:
+    """All deployments are Available, which holds for no deployments"""
+    return all(condition_true(_, "Available") for _ in deployments.values())
+
+
+def unavailable_deployments(deployments: Dict):
+    return sorted(
+        name
+        for name, deployment in deployments.items()
+        if not condition_true(deployment, "Available")
+    )
@@ -0,0 +1,195 @@
+import asyncio
+import contextlib
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from typing import Awaitable, Callable, Dict, Iterable
+
+from qhub.tracing import span
+
+# overall deadline of a group of probes and backoff between attempts
+DEFAULT_DEADLINE = 300  # seconds
+DEFAULT_ATTEMPT_TIMEOUT = 5  # seconds
+INITIAL_BACKOFF = 1  # seconds
+MAX_BACKOFF = 30  # seconds
+
+
+def backoff_delay(attempt: int, initial=INITIAL_BACKOFF, maximum=MAX_BACKOFF) -> float:
+    """Exponential backoff with full jitter before the next attempt"""
+    return random.uniform(0, min(maximum, initial * 2 ** (attempt - 1)))
+
+
+async def probe(
+    name: str,
+    attempt_function: Callable[[], Awaitable[bool]],
+    deadline: float,
+    attempt_timeout: float = DEFAULT_ATTEMPT_TIMEOUT,
+    stage: str = None,
+    max_backoff: float = MAX_BACKOFF,
+) -> Dict:
+    """Retry `attempt_function` until it returns True or the `deadline`
+    (in `time.monotonic` seconds) passes
+
+    Each attempt is bounded by `attempt_timeout` and the remaining time,
+    errors count as failed attempts. Returns whether the probe became
+    ready, after how many attempts and after how many seconds.
+    """
+    start_time = time.monotonic()
+    attempt = 0
+    error = None
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        with span("check attempt", stage=stage, attempt=attempt, probe=name) as _span:
+            try:
+                ready = await asyncio.wait_for(
+                    attempt_function(), max(0.0, min(attempt_timeout, remaining))
+                )
+            except (asyncio.TimeoutError, OSError) as e:
+                ready, error = False, e
+            _span.set_attribute("success", ready)
+
+        if ready:
+            elapsed = time.monotonic() - start_time
+            print(f"Probe {name} ready after {elapsed:.1f} [s] ({attempt} attempts)")
+            return {
+                "name": name,
+                "ready": True,
+                "attempts": attempt,
+                "time_to_ready": elapsed,
+            }
+
+        delay = backoff_delay(attempt, maximum=max_backoff)
+        if time.monotonic() + delay >= deadline:
+            print(f"Probe {name} not ready after {attempt} attempts: {error!r}")
+            return {
+                "name": name,
+                "ready": False,
+                "attempts": attempt,
+                "time_to_ready": None,
+                "error": repr(error) if error else None,
+            }
+        await asyncio.sleep(delay)
+
+
+def run_probes(
+    probes: Dict[str, Callable[[], Awaitable[bool]]],
+    deadline: float = DEFAULT_DEADLINE,
+    **kwargs,
+) -> Dict[str, Dict]:
+    """Run all probes concurrently within a single overall `deadline` in
+    seconds and return the result of each probe by name"""
+    deadline_time = time.monotonic() + deadline
+
+    async def _run():
+        results = await asyncio.gather(
+            *[
+                probe(name, function, deadline_time, **kwargs)
+                for name, function in probes.items()
+            ]
+        )
+        return {_["name"]: _ for _ in results}
+
+    return asyncio.run(_run())
+
+
+def tcp_connect(host: str, port: int) -> Callable[[], Awaitable[bool]]:
+    """Attempt which opens and closes a tcp connection to host:port"""
+
+    async def _attempt():
+        _, writer = await asyncio.open_connection(host, port)
+        writer.close()
+        await writer.wait_closed()
+        return True
+
+    return _attempt
+
+
+def resolve_host(host: str, addresses: list) -> Callable[[], Awaitable[bool]]:
+    """Attempt which resolves the ipv4 address of host into `addresses`"""
+
+    async def _attempt():
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+        addresses[:] = [info[4][0] for info in infos]
+        return bool(addresses)
+
+    return _attempt
+
+
+@contextlib.contextmanager
+def thread_sessions(urls: Iterable[str]):
+    """Callable returning the `requests.Session` of the calling thread
+
+    A `requests.Session` is not thread safe, so each executor thread
+    sends its requests through its own session. The adapter of a session
+    keeps one keep-alive connection for each distinct host of `urls`.
+    All sessions are closed on exit.
+    """
+    import requests
+
+    pool_connections = max(len({urllib.parse.urlsplit(_).netloc for _ in urls}), 1)
+    local = threading.local()
+    sessions = []
+    lock = threading.Lock()
+
+    def _session():
+        session = getattr(local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_connections, pool_maxsize=1
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            local.session = session
+            with lock:
+                sessions.append(session)
+        return session
+
+    try:
+        yield _session
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def http_get(
+    get_session: Callable, url: str, verify: bool = False, timeout: float = None
+):
+    """Attempt which is ready once `url` responds with a status below 400
+
+    Requests are sent on the default executor of the event loop through
+    the keep-alive connections of the session returned by `get_session`
+    in the executor thread, see `thread_sessions`.
+    """
+
+    def _get():
+        return get_session().get(
+            url, verify=verify, timeout=timeout or DEFAULT_ATTEMPT_TIMEOUT
+        )
+
+    async def _attempt():
+        response = await asyncio.get_running_loop().run_in_executor(None, _get)
+        response.close()
+        return response.status_code < 400
+
+    return _attempt
+
+
+def print_probe_table(results: Dict[str, Dict]):
+    print(f"{'ready':>6} {'attempts':>9} {'time-to-ready [s]':>18}  probe")
+
+    def _key(item):
+        time_to_ready = item[1]["time_to_ready"]
+        return float("inf") if time_to_ready is None else time_to_ready
+
+    for name, result in sorted(results.items(), key=_key):
+        time_to_ready = result["time_to_ready"]
+        time_to_ready = "-" if time_to_ready is None else f"{time_to_ready:.1f}"
+        print(
+            f"{'yes' if result['ready'] else 'no':>6} {result['attempts']:>9} {time_to_ready:>18}  {name}"
+        )
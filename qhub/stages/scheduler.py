@@ -0,0 +1,112 @@
+import concurrent.futures
+import contextvars
+import logging
+from typing import Any, Callable, Dict, Iterable
+
+from qhub.utils import timer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Scheduler:
+    """Run a graph of tasks on a bounded pool of worker threads
+
+    Each task is started as soon as all of its dependencies succeeded
+    so that independent tasks run concurrently. When a task fails all
+    tasks depending on it are cancelled, with `fail_fast` no further
+    tasks are started at all. Tasks already running are always waited
+    for before the first failure is raised.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, fail_fast=True):
+        self.max_workers = max_workers
+        self.fail_fast = fail_fast
+        self.tasks = {}
+
+    def add(self, name: str, function: Callable, dependencies: Iterable[str] = ()):
+        if name in self.tasks:
+            raise ValueError(f"task={name} already exists")
+        self.tasks[name] = (function, set(dependencies))
+
+    def validate(self):
+        for name, (_, dependencies) in self.tasks.items():
+            unknown = dependencies - set(self.tasks)
+            if unknown:
+                raise ValueError(f"task={name} depends on unknown tasks={unknown}")
+
+        visited, visiting = set(), set()
+
+        def visit(name):
+            if name in visiting:
+                raise ValueError(f"task={name} has a cyclic dependency")
+            if name not in visited:
+                visiting.add(name)
+                for dependency in self.tasks[name][1]:
+                    visit(dependency)
+                visiting.remove(name)
+                visited.add(name)
+
+        for name in self.tasks:
+            visit(name)
+
+    def _run_task(self, name, function):
+        with timer(logger, f"task {name}"):
+            return function()
+
+    def run(self) -> Dict[str, Any]:
+        """Run all tasks and return the result of each task by name"""
+        self.validate()
+
+        results = {}
+        failures = {}
+        pending = dict(self.tasks)
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            while pending or running:
+                for name, (function, dependencies) in list(pending.items()):
+                    failed_dependencies = dependencies & set(failures)
+                    if failed_dependencies or (failures and self.fail_fast):
+                        cause = min(failed_dependencies or failures)
+                        logger.warning(
+                            f"task={name} cancelled since task={cause} failed"
+                        )
+                        failures[name] = TaskCancelled(name)
+                        del pending[name]
+                    elif dependencies <= set(results):
+                        # tasks continue the trace of the caller
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            self._run_task,
+                            name,
+                            function,
+                        )
+                        running[future] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        logger.error(f"task={name} failed: {future.exception()!r}")
+                        failures[name] = future.exception()
+                    else:
+                        results[name] = future.result()
+
+        for exception in failures.values():
+            if not isinstance(exception, TaskCancelled):
+                raise exception
+        return results
@@ -0,0 +1,206 @@
+import contextlib
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, List
+
+from qhub.version import __version__
+
+TRACE_FILE_ENVIRONMENT_VARIABLE = "QHUB_TRACE_FILE"
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+_active_tracers = []
+_current_span = contextvars.ContextVar("qhub_current_span", default=None)
+_lock = threading.Lock()
+
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    """Attribute value in the OTLP json encoding"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    elif isinstance(value, int):
+        # 64 bit integers are encoded as strings
+        return {"intValue": str(value)}
+    elif isinstance(value, float):
+        return {"doubleValue": value}
+    elif isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(_) for _ in value]}}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"key": key, "value": otlp_value(value)}
+        for key, value in attributes.items()
+        if value is not None
+    ]
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_span_id: str = None,
+        kind: int = SPAN_KIND_INTERNAL,
+        **attributes,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.status_code = STATUS_CODE_OK
+        self.status_message = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status_code = STATUS_CODE_ERROR
+        self.status_message = message
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time or time.time_ns()),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": self.status_code},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class Tracer:
+    """Spans of a single qhub command exported as an OTLP json trace
+
+    All spans share one trace id. Spans started without an enclosing
+    span in the current context, e.g. within a thread pool, become
+    children of the root span of the command.
+    """
+
+    def __init__(self, command: str):
+        self.trace_id = secrets.token_hex(16)
+        self.root = Span(f"qhub {command}", self.trace_id, command=command)
+        self.spans = []
+
+    def record(self, span: Span):
+        with _lock:
+            self.spans.append(span)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        spans = sorted(self.spans + [self.root], key=lambda _: _.start_time)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": otlp_attributes(
+                            {
+                                "service.name": "qhub",
+                                "service.version": __version__,
+                                "process.pid": os.getpid(),
+                            }
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "qhub", "version": __version__},
+                            "spans": [_.to_otlp() for _ in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def save(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump(self.to_otlp(), f, indent=2)
+
+
+@contextlib.contextmanager
+def _status(_span: Span):
+    try:
+        yield _span
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            _span.set_error(f"exit code {e.code}")
+        raise
+    except BaseException as e:
+        _span.set_error(repr(e))
+        raise
+    finally:
+        _span.end_time = time.time_ns()
+
+
+@contextlib.contextmanager
+def trace(command: str, filename: str = None):
+    """Trace `command` and export its spans to `filename` as OTLP json
+
+    Defaults to the file named by `QHUB_TRACE_FILE`, nothing is traced
+    when neither is set. The trace is saved even when the command fails.
+    """
+    filename = filename or os.environ.get(TRACE_FILE_ENVIRONMENT_VARIABLE)
+    if not filename:
+        yield None
+        return
+
+    tracer = Tracer(command)
+    with _lock:
+        _active_tracers.append(tracer)
+    token = _current_span.set(tracer.root)
+    try:
+        with _status(tracer.root):
+            yield tracer
+    finally:
+        _current_span.reset(token)
+        with _lock:
+            _active_tracers.remove(tracer)
+        tracer.save(filename)
+        print(f"Trace of qhub {command} written to {filename}")
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Record the enclosed block as a span of all active traces
+
+    Yields the span so that results such as an exit code can be set as
+    attributes, outside of a trace the span is simply discarded.
+    """
+    tracers = list(_active_tracers)
+    parent = _current_span.get()
+    if parent is None and tracers:
+        parent = tracers[0].root
+
+    _span = Span(
+        name,
+        parent.trace_id if parent else None,
+        parent.span_id if parent else None,
+        kind=kind,
+        **attributes,
+    )
+    token = _current_span.set(_span)
+    try:
+        with _status(_span):
+            yield _span
+    finally:
+        _current_span.reset(token)
+        for tracer in tracers:
+            tracer.record(_span)
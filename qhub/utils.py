@@ -1,12 +1,7 @@
 from typing import Dict, List
 import pathlib
-import subprocess
-import signal
-import sys
 import time
-import threading
 import os
-import re
 import contextlib
 import functools
 from ruamel.yaml import YAML
@@ -19,6 +14,9 @@ from qhub.provider.cloud import (
 )
 
 from .version import __version__
+from .process import run_subprocess_cmd  # noqa: F401
+from .profile import record_phase
+from .tracing import SPAN_KIND_CLIENT, span
 
 QHUB_K8S_VERSION = os.getenv("QHUB_K8S_VERSION", None)
 
@@ -50,72 +48,63 @@ yaml.default_flow_style = False
 
 
 @contextlib.contextmanager
-def timer(logger, prefix):
+def timer(logger, prefix, **attributes):
+    """Log the duration of the block and record it as a phase, along
+    with `attributes`, within the active `qhub.profile.profile` and as
+    a span of the active `qhub.tracing.trace`"""
     start_time = time.time()
-    yield
-    logger.info(f"{prefix} took {time.time() - start_time:.3f} [s]")
-
-
-@contextlib.contextmanager
-def change_directory(directory):
-    current_directory = os.getcwd()
-    os.chdir(directory)
-    yield
-    os.chdir(current_directory)
-
+    status = "error"
+    try:
+        with span(prefix, **attributes):
+            yield
+        status = "ok"
+    finally:
+        duration = time.time() - start_time
+        record_phase(prefix, start_time, duration, status, **attributes)
+    logger.info(f"{prefix} took {duration:.3f} [s]")
 
-def run_subprocess_cmd(processargs, **kwargs):
-    """Runs subprocess command with realtime stdout logging with optional line prefix."""
-    if "prefix" in kwargs:
-        line_prefix = f"[{kwargs['prefix']}]: ".encode("utf-8")
-        kwargs.pop("prefix")
-    else:
-        line_prefix = b""
 
-    timeout = 0
-    if "timeout" in kwargs:
-        timeout = kwargs.pop("timeout")  # in seconds
+def qhub_cache_directory() -> pathlib.Path:
+    """Per-user cache directory shared by all qhub processes
 
-    strip_errors = kwargs.pop("strip_errors", False)
+    Defaults to `$XDG_CACHE_HOME/qhub` (`~/.cache/qhub`) and can be
+    overridden with the `QHUB_CACHE_DIR` environment variable.
+    """
+    if os.environ.get("QHUB_CACHE_DIR"):
+        return pathlib.Path(os.environ["QHUB_CACHE_DIR"])
 
-    process = subprocess.Popen(
-        processargs,
-        **kwargs,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        preexec_fn=os.setsid,
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        pathlib.Path.home(), ".cache"
     )
-    # Set timeout thread
-    timeout_timer = None
-    if timeout > 0:
+    return pathlib.Path(cache_home) / "qhub"
 
-        def kill_process():
-            try:
-                os.killpg(process.pid, signal.SIGTERM)
-            except ProcessLookupError:
-                pass  # Already finished
 
-        timeout_timer = threading.Timer(timeout, kill_process)
-        timeout_timer.start()
+@contextlib.contextmanager
+def file_lock(filename):
+    """Exclusive inter-process lock held on the given filename
 
-    for line in iter(lambda: process.stdout.readline(), b""):
-        full_line = line_prefix + line
-        if strip_errors:
-            full_line = full_line.decode("utf-8")
-            full_line = re.sub(
-                r"\x1b\[31m", "", full_line
-            )  # Remove red ANSI escape code
-            full_line = full_line.encode("utf-8")
+    On platforms without `fcntl` no locking is performed.
+    """
+    try:
+        import fcntl
+    except ImportError:  # windows
+        yield
+        return
 
-        sys.stdout.buffer.write(full_line)
-        sys.stdout.flush()
+    with open(filename, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-    if timeout_timer is not None:
-        timeout_timer.cancel()
 
-    return process.wait(
-        timeout=10
-    )  # Should already have finished because we have drained stdout
+@contextlib.contextmanager
+def change_directory(directory):
+    current_directory = os.getcwd()
+    os.chdir(directory)
+    yield
+    os.chdir(current_directory)
 
 
 def check_cloud_credentials(config):
@@ -253,7 +242,13 @@ def set_kubernetes_version(
         # to avoid using cloud provider SDK
         # set QHUB_K8S_VERSION environment variable
         if not QHUB_K8S_VERSION:
-            k8s_versions = func(region)
+            with span(
+                "cloud kubernetes versions",
+                kind=SPAN_KIND_CLIENT,
+                provider=cloud_provider,
+                region=region,
+            ):
+                k8s_versions = func(region)
         else:
             k8s_versions = [QHUB_K8S_VERSION]
 
@@ -303,44 +298,6 @@ def modified_environ(*remove: List[str], **update: Dict[str, str]):
         [env.pop(k) for k in remove_after]
 
 
-@contextlib.contextmanager
-def kubernetes_provider_context(kubernetes_credentials: Dict[str, str]):
-    credential_mapping = {
-        "config_path": "KUBE_CONFIG_PATH",
-        "config_context": "KUBE_CTX",
-        "username": "KUBE_USER",
-        "password": "KUBE_PASSWORD",
-        "client_certificate": "KUBE_CLIENT_CERT_DATA",
-        "client_key": "KUBE_CLIENT_KEY_DATA",
-        "cluster_ca_certificate": "KUBE_CLUSTER_CA_CERT_DATA",
-        "host": "KUBE_HOST",
-        "token": "KUBE_TOKEN",
-    }
-
-    credentials = {
-        credential_mapping[k]: v
-        for k, v in kubernetes_credentials.items()
-        if v is not None
-    }
-    with modified_environ(**credentials):
-        yield
-
-
-@contextlib.contextmanager
-def keycloak_provider_context(keycloak_credentials: Dict[str, str]):
-    credential_mapping = {
-        "client_id": "KEYCLOAK_CLIENT_ID",
-        "url": "KEYCLOAK_URL",
-        "username": "KEYCLOAK_USER",
-        "password": "KEYCLOAK_PASSWORD",
-        "realm": "KEYCLOAK_REALM",
-    }
-
-    credentials = {credential_mapping[k]: v for k, v in keycloak_credentials.items()}
-    with modified_environ(**credentials):
-        yield
-
-
 def deep_merge(*args):
     """Deep merge multiple dictionaries.
 
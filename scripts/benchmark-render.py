@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+
+# avoid cloud provider API calls when rendering the configuration
+os.environ.setdefault("QHUB_K8S_VERSION", "1.20")
+
+from ruamel.yaml import YAML  # noqa: E402
+
+from qhub.initialize import render_config  # noqa: E402
+from qhub.render import hash_files, render_template  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark hashing of a qhub render with all eight stages."
+    )
+    parser.add_argument(
+        "-p",
+        "--provider",
+        default="aws",
+        choices=["aws", "gcp", "azure", "do"],
+        help="cloud provider to render stages for",
+    )
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=5, help="number of timed repetitions"
+    )
+    parser.add_argument(
+        "--extra-mib",
+        type=int,
+        default=0,
+        help="add MiB of large files to each rendered stage to simulate large trees",
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=None, help="size of the hashing thread pool"
+    )
+    args = parser.parse_args()
+
+    handle_benchmark_render(args)
+
+
+def sequential_hash_files(file_paths):
+    """Hashing as done before the streaming thread pool engine"""
+    digests = {}
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            digests[file_path] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def best_of(repeat, func, *args, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def handle_benchmark_render(args):
+    with tempfile.TemporaryDirectory() as output_directory:
+        output_directory = pathlib.Path(output_directory)
+        config = render_config(
+            project_name="benchmark",
+            namespace="dev",
+            qhub_domain="benchmark.qhub.dev",
+            cloud_provider=args.provider,
+            ci_provider="github-actions",
+            repository="github.com/benchmark/benchmark",
+            repository_auto_provision=False,
+            auth_provider="password",
+            auth_auto_provision=False,
+            terraform_state="remote",
+            kubernetes_version=None,
+            disable_prompt=True,
+        )
+        config_filename = output_directory / "qhub-config.yaml"
+        with config_filename.open("w") as f:
+            YAML(typ="unsafe", pure=True).dump(config, f)
+
+        render_template(str(output_directory), config_filename)
+
+        for stage_directory in (output_directory / "stages").iterdir():
+            for i in range(args.extra_mib // 8):
+                (stage_directory / f"large-{i}.bin").write_bytes(
+                    os.urandom(8 * 2**20)
+                )
+
+        import qhub
+
+        template_directory = pathlib.Path(qhub.__file__).parent / "template"
+        file_paths = [
+            str(path)
+            for directory in [
+                template_directory / "stages",
+                output_directory / "stages",
+            ]
+            for path in directory.rglob("*")
+            if path.is_file()
+        ]
+        num_bytes = sum(os.path.getsize(_) for _ in file_paths)
+
+        sequential = best_of(args.repeat, sequential_hash_files, file_paths)
+        parallel = best_of(
+            args.repeat, hash_files, file_paths, max_workers=args.max_workers
+        )
+        incremental_render = best_of(
+            args.repeat, render_template, str(output_directory), config_filename
+        )
+
+    print(f"hashed {len(file_paths)} files ({num_bytes / 2**20:.1f} MiB)")
+    print(f"sequential whole file hashing : {sequential * 1000:8.1f} [ms]")
+    print(f"streaming thread pool hashing : {parallel * 1000:8.1f} [ms]")
+    print(f"speedup                       : {sequential / parallel:8.2f}x")
+    print(f"incremental re-render         : {incremental_render * 1000:8.1f} [ms]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+from qhub.provider import terraform
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare a cold `terraform init` of all rendered stages with and without the shared plugin cache."
+    )
+    parser.add_argument(
+        "-o", "--output", default="./", help="rendered qhub output directory"
+    )
+    args = parser.parse_args()
+
+    handle_benchmark_terraform_init(args)
+
+
+def stage_directories(output_directory):
+    directories = []
+    for stage in sorted(pathlib.Path(output_directory, "stages").iterdir()):
+        if list(stage.glob("*.tf")):
+            directories.append(str(stage))
+        else:
+            # stages 01 and 02 are rendered into provider subdirectories
+            directories.extend(str(_.parent) for _ in sorted(stage.glob("*/*.tf")))
+    return list(dict.fromkeys(directories))
+
+
+def init_stages(directories, plugin_cache_directory=None):
+    env = dict(os.environ)
+    env.pop("TF_PLUGIN_CACHE_DIR", None)
+    if plugin_cache_directory:
+        env["TF_PLUGIN_CACHE_DIR"] = plugin_cache_directory
+
+    for directory in directories:
+        shutil.rmtree(os.path.join(directory, ".terraform"), ignore_errors=True)
+
+    terraform_path = terraform.download_terraform_binary()
+    start_time = time.perf_counter()
+    if plugin_cache_directory:
+        terraform.seed_plugin_cache(directories)
+    for directory in directories:
+        if terraform.run_subprocess_cmd(
+            [terraform_path, "init", "-backend=false"],
+            cwd=directory,
+            env=env,
+            prefix=os.path.basename(directory),
+        ):
+            raise terraform.TerraformException(f"terraform init failed in {directory}")
+    return time.perf_counter() - start_time
+
+
+def handle_benchmark_terraform_init(args):
+    directories = stage_directories(args.output)
+    if not directories:
+        raise ValueError(f"no rendered stages found in output={args.output}")
+
+    without_cache = init_stages(directories)
+    with tempfile.TemporaryDirectory() as plugin_cache_directory:
+        os.environ["TF_PLUGIN_CACHE_DIR"] = plugin_cache_directory
+        with_cache = init_stages(directories, plugin_cache_directory)
+
+    print(f"cold init of {len(directories)} stages")
+    print(f"without plugin cache : {without_cache:8.1f} [s]")
+    print(f"with plugin cache    : {with_cache:8.1f} [s]")
+
+
+if __name__ == "__main__":
+    main()
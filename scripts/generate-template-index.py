@@ -0,0 +1,41 @@
+import argparse
+import json
+import logging
+import pathlib
+
+from qhub.render import build_template_index, template_index_path
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute the sha256 index of the qhub template files."
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        default=str(pathlib.Path(__file__).parent.parent / "qhub" / "template"),
+        help="qhub template directory",
+    )
+    args = parser.parse_args()
+
+    handle_generate_template_index(args)
+
+
+def handle_generate_template_index(args):
+    template_directory = pathlib.Path(args.template)
+    if not template_directory.is_dir():
+        raise ValueError(f"template directory={template_directory} is not a directory")
+
+    index = build_template_index(str(template_directory))
+
+    index_path = template_index_path(template_directory)
+    with index_path.open("w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    logger.info(f"wrote index of {len(index['files'])} files to {index_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import argparse
 import json
 
 from qhub.keycloak import get_keycloak_admin_from_config
+from qhub.utils import load_yaml
 
 logging.basicConfig(level=logging.INFO)
 
@@ -24,7 +25,8 @@ def handle_keycloak_export(args):
             f"passed in configuration filename={config_filename} must exist"
         )
 
-    keycloak_admin = get_keycloak_admin_from_config(config_filename)
+    config = load_yaml(config_filename)
+    keycloak_admin = get_keycloak_admin_from_config(config)
 
     realm = {"id": "qhub", "realm": "qhub"}
 
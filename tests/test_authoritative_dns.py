@@ -0,0 +1,153 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from qhub.stages import authoritative_dns, probes
+from qhub.stages.authoritative_dns import TYPE_A, TYPE_CNAME, TYPE_NS
+
+
+class StandInDNSServer:
+    """Local udp dns server answering from `records` keyed by (name, type)"""
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.address = self.socket.getsockname()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, client = self.socket.recvfrom(4096)
+            except OSError:
+                return
+            request = authoritative_dns.decode_message(data)
+            name, rtype = request["questions"][0]
+            self.queries.append((name, rtype, request["flags"]))
+            answers = list(self.records.get((name, rtype), []))
+            if rtype == TYPE_A:
+                answers += self.records.get((name, TYPE_CNAME), [])
+            additional = []
+            for _, answer_type, value in answers:
+                if answer_type == TYPE_NS:
+                    additional += self.records.get((value, TYPE_A), [])
+            response = authoritative_dns.encode_message(
+                request["id"],
+                authoritative_dns.FLAG_RESPONSE | authoritative_dns.FLAG_AUTHORITATIVE,
+                request["questions"],
+                answers=answers,
+                additional=additional,
+            )
+            self.socket.sendto(response, client)
+
+    def close(self):
+        self.socket.close()
+
+
+@pytest.fixture
+def dns_server():
+    server = StandInDNSServer(
+        {
+            ("example.org", TYPE_NS): [("example.org", TYPE_NS, "ns1.example.org")],
+            ("ns1.example.org", TYPE_A): [("ns1.example.org", TYPE_A, "127.0.0.1")],
+        }
+    )
+    yield server
+    server.close()
+
+
+def test_decode_compressed_name():
+    # "qhub.example.org" followed by a pointer to "example.org" at offset 5
+    data = b"\x04qhub\x07example\x03org\x00" + b"\x03www\xc0\x05"
+    assert authoritative_dns.decode_name(data, 0) == ("qhub.example.org", 18)
+    assert authoritative_dns.decode_name(data, 18) == ("www.example.org", 24)
+
+    looping = struct.pack("!H", 0xC000)
+    with pytest.raises(authoritative_dns.DNSError):
+        authoritative_dns.decode_name(looping, 0)
+
+
+def test_authoritative_nameservers(dns_server):
+    port = dns_server.address[1]
+    nameservers = authoritative_dns.authoritative_nameservers(
+        "qhub.example.org", resolvers=[dns_server.address], port=port
+    )
+    assert nameservers == [("127.0.0.1", port)]
+
+    with pytest.raises(authoritative_dns.DNSError):
+        authoritative_dns.authoritative_nameservers(
+            "qhub.missing.test", resolvers=[dns_server.address], port=port
+        )
+
+
+def test_authoritative_nameservers_cname(dns_server):
+    port = dns_server.address[1]
+    # the resolver follows the CNAME to the nameservers of another zone
+    dns_server.records[("aws.example.org", TYPE_NS)] = [
+        ("aws.example.org", TYPE_CNAME, "lb.elb.amazonaws.com"),
+        ("amazonaws.com", TYPE_NS, "ns1.amazonaws.com"),
+    ]
+    dns_server.records[("ns1.amazonaws.com", TYPE_A)] = [
+        ("ns1.amazonaws.com", TYPE_A, "127.0.0.2")
+    ]
+
+    nameservers = authoritative_dns.authoritative_nameservers(
+        "aws.example.org", resolvers=[dns_server.address], port=port
+    )
+    assert nameservers == [("127.0.0.1", port)]
+
+
+def test_authoritative_records(dns_server):
+    dns_server.records[("qhub.example.org", TYPE_A)] = [
+        ("qhub.example.org", TYPE_A, "10.0.0.1")
+    ]
+    dns_server.records[("aws.example.org", TYPE_CNAME)] = [
+        ("aws.example.org", TYPE_CNAME, "lb.elb.amazonaws.com")
+    ]
+
+    records = authoritative_dns.authoritative_records(
+        "qhub.example.org", [dns_server.address]
+    )
+    assert records == {"A": ["10.0.0.1"], "CNAME": []}
+    assert authoritative_dns.record_matches(records, "10.0.0.1")
+    assert not authoritative_dns.record_matches(records, "10.0.0.2")
+
+    records = authoritative_dns.authoritative_records(
+        "aws.example.org", [dns_server.address]
+    )
+    assert authoritative_dns.record_matches(
+        records, "10.0.0.3", hostname="LB.elb.amazonaws.com."
+    )
+
+    # authoritative queries never ask for recursion
+    assert all(
+        not flags & authoritative_dns.FLAG_RECURSION_DESIRED
+        for _, _, flags in dns_server.queries
+    )
+
+
+def test_authoritative_record_propagation(dns_server):
+    attempt = authoritative_dns.authoritative_record(
+        "qhub.example.org", [dns_server.address], "10.0.0.1"
+    )
+
+    def _create_record():
+        time.sleep(0.5)
+        dns_server.records[("qhub.example.org", TYPE_A)] = [
+            ("qhub.example.org", TYPE_A, "10.0.0.1")
+        ]
+
+    threading.Thread(target=_create_record).start()
+    results = probes.run_probes(
+        {"qhub.example.org": attempt}, deadline=10, max_backoff=0.5
+    )
+    result = results["qhub.example.org"]
+    assert result["ready"] and result["attempts"] > 1
+    # noticed shortly after the record was created
+    assert 0.5 <= result["time_to_ready"] < 2
@@ -0,0 +1,39 @@
+import os
+
+from qhub.context import ExecutionContext
+
+
+def test_execution_contexts_are_isolated():
+    first = ExecutionContext()
+    second = ExecutionContext({"PATH": "/usr/bin"})
+
+    first.add_kubernetes_credentials({"host": "a.example.com", "token": None})
+    second.add_kubernetes_credentials({"host": "b.example.com", "token": "secret"})
+    second.add_keycloak_credentials(
+        {
+            "client_id": "admin-cli",
+            "url": "https://b.example.com",
+            "username": "root",
+            "password": "password",
+            "realm": "master",
+        }
+    )
+
+    assert first.environment()["KUBE_HOST"] == "a.example.com"
+    assert "KUBE_TOKEN" not in first.environment()
+    assert "KEYCLOAK_URL" not in first.environment()
+    assert second.environment() == {
+        "PATH": "/usr/bin",
+        "KUBE_HOST": "b.example.com",
+        "KUBE_TOKEN": "secret",
+        "KEYCLOAK_CLIENT_ID": "admin-cli",
+        "KEYCLOAK_URL": "https://b.example.com",
+        "KEYCLOAK_USER": "root",
+        "KEYCLOAK_PASSWORD": "password",
+        "KEYCLOAK_REALM": "master",
+    }
+    assert "KUBE_HOST" not in os.environ
+
+    # environment returns a copy
+    first.environment()["KUBE_HOST"] = "c.example.com"
+    assert first.environment()["KUBE_HOST"] == "a.example.com"
@@ -0,0 +1,69 @@
+import pytest
+
+from qhub import destroy
+from qhub.stages.journal import StageJournal
+
+
+@pytest.fixture
+def terraform_calls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(tmp_path / "cache"))
+
+    calls = {"init": [], "output": [], "deploy": []}
+
+    def _init_all(directories):
+        calls["init"].extend(directories)
+
+    def _output(directory):
+        calls["output"].append(directory)
+        return {"directory": {"value": directory}}
+
+    def _deploy(directory, **kwargs):
+        calls["deploy"].append((directory, kwargs["terraform_import"]))
+        return {"directory": {"value": directory}}
+
+    monkeypatch.setattr(destroy.terraform, "init_all", _init_all)
+    monkeypatch.setattr(destroy.terraform, "output", _output)
+    monkeypatch.setattr(destroy.terraform, "deploy", _deploy)
+    return calls
+
+
+CONFIG = {
+    "provider": "aws",
+    "project_name": "test",
+    "namespace": "dev",
+    "terraform_state": {"type": "remote"},
+}
+
+
+def test_gather_stage_outputs(terraform_calls):
+    journal = StageJournal.load()
+    journal.record(
+        "stages/05-kubernetes-keycloak",
+        "abc",
+        {"keycloak_credentials": {"sensitive": True, "value": {"password": "a"}}},
+    )
+
+    stage_outputs = destroy.gather_stage_outputs(CONFIG)
+
+    assert list(stage_outputs)[:2] == [
+        "stages/01-terraform-state",
+        "stages/02-infrastructure",
+    ]
+    assert stage_outputs["stages/05-kubernetes-keycloak"] == {
+        "keycloak_credentials": {"sensitive": True, "value": {"password": "a"}}
+    }
+    assert stage_outputs["stages/02-infrastructure"] == {
+        "directory": {"value": "stages/02-infrastructure/aws"}
+    }
+    # recorded stages are neither initialized nor read and nothing is imported
+    assert "stages/05-kubernetes-keycloak" not in terraform_calls["init"]
+    assert len(terraform_calls["output"]) == 7
+    assert terraform_calls["deploy"] == []
+
+
+def test_gather_stage_outputs_import_state(terraform_calls):
+    destroy.gather_stage_outputs(CONFIG, terraform_import=True)
+
+    assert terraform_calls["deploy"] == [("stages/01-terraform-state/aws", True)]
+    assert "stages/01-terraform-state/aws" not in terraform_calls["output"]
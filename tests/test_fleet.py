@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from qhub import fleet
+
+
+@pytest.fixture
+def configs(tmp_path):
+    filenames = []
+    for name in ["alpha", "beta"]:
+        directory = tmp_path / name
+        directory.mkdir()
+        filename = directory / "qhub-config.yaml"
+        filename.write_text(f"project_name: {name}\n")
+        filenames.append(str(filename))
+    return filenames
+
+
+def test_fleet_runs(tmp_path, configs):
+    runs = fleet.fleet_runs(configs)
+    assert [_["output_directory"] for _ in runs] == [
+        str(tmp_path / "alpha"),
+        str(tmp_path / "beta"),
+    ]
+
+    runs = fleet.fleet_runs(configs, output_root=str(tmp_path / "out"))
+    assert [_["output_directory"] for _ in runs] == [
+        str(tmp_path / "out" / "alpha"),
+        str(tmp_path / "out" / "beta"),
+    ]
+
+    with pytest.raises(ValueError):
+        fleet.fleet_runs([configs[0], configs[0]])
+
+
+def test_fleet_environment_isolates_runs(tmp_path, monkeypatch):
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(tmp_path / "cache"))
+    alpha = fleet.fleet_environment(str(tmp_path / "alpha"))
+    beta = fleet.fleet_environment(str(tmp_path / "beta"))
+
+    for variable in ["QHUB_KUBECONFIG", "TMPDIR"]:
+        assert alpha[variable] != beta[variable]
+    for variable in ["QHUB_CACHE_DIR", "TF_PLUGIN_CACHE_DIR"]:
+        assert alpha[variable] == beta[variable]
+    assert os.path.isdir(alpha["TMPDIR"])
+
+
+def test_run_fleet(tmp_path, monkeypatch, configs):
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(tmp_path / "cache"))
+
+    def _fleet_command(action, run, extra_args=None):
+        exit_code = 1 if "beta" in run["config"] else 0
+        return ["sh", "-c", f'echo "$QHUB_KUBECONFIG"; exit {exit_code}']
+
+    monkeypatch.setattr(fleet, "fleet_command", _fleet_command)
+
+    report_filename = tmp_path / "report.json"
+    report = fleet.run_fleet(
+        "render", configs, max_parallel=2, report_filename=str(report_filename)
+    )
+
+    assert (report["succeeded"], report["failed"]) == (1, 1)
+    assert json.loads(report_filename.read_text()) == report
+    assert [_["status"] for _ in report["runs"]] == ["succeeded", "failed"]
+
+    # each run logs within its own working directory
+    log = tmp_path / "alpha" / ".qhub" / "logs" / fleet.FLEET_LOG_FILENAME
+    assert str(tmp_path / "alpha" / ".qhub" / "kubeconfig") in log.read_text()
@@ -0,0 +1,304 @@
+import pytest
+
+from qhub import deploy
+from qhub.stages.checks import CheckException
+from qhub.stages.journal import (
+    JOURNAL_KEY_FILENAME,
+    STAGE_APPLIED,
+    StageJournal,
+    is_stage_forced,
+    stage_digest,
+    stage_journal_path,
+)
+
+
+@pytest.fixture(autouse=True)
+def qhub_cache_directory(tmp_path, monkeypatch):
+    cache_directory = tmp_path / "cache"
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(cache_directory))
+    return cache_directory
+
+
+@pytest.fixture
+def stage_directory(tmp_path):
+    directory = tmp_path / "stages" / "03-kubernetes-initialize"
+    directory.mkdir(parents=True)
+    (directory / "main.tf").write_text('resource "null_resource" "a" {}\n')
+    return directory
+
+
+def test_stage_digest(stage_directory):
+    digest = stage_digest(str(stage_directory), {"name": "qhub"}, {})
+
+    # terraform state and working directory do not affect the digest
+    (stage_directory / "terraform.tfstate").write_text("{}")
+    (stage_directory / ".terraform").mkdir()
+    (stage_directory / ".terraform" / "plugin").write_text("binary")
+    assert stage_digest(str(stage_directory), {"name": "qhub"}, {}) == digest
+
+    assert stage_digest(str(stage_directory), {"name": "other"}, {}) != digest
+
+    (stage_directory / "main.tf").write_text('resource "null_resource" "b" {}\n')
+    assert stage_digest(str(stage_directory), {"name": "qhub"}, {}) != digest
+
+
+def test_stage_digest_ignores_kubernetes_token(stage_directory):
+    def outputs(token, host):
+        return {
+            "stages/02-infrastructure": {
+                "kubernetes_credentials": {"value": {"host": host, "token": token}}
+            }
+        }
+
+    digest = stage_digest(str(stage_directory), {}, outputs("a", "example.com"))
+    assert stage_digest(str(stage_directory), {}, outputs("b", "example.com")) == digest
+    assert stage_digest(str(stage_directory), {}, outputs("a", "example.org")) != digest
+
+
+@pytest.mark.parametrize(
+    "force_stages, forced",
+    [
+        (None, False),
+        (["all"], True),
+        (["07"], True),
+        (["07-kubernetes-services"], True),
+        (["stages/07-kubernetes-services/"], True),
+        (["08"], False),
+    ],
+)
+def test_is_stage_forced(force_stages, forced):
+    assert is_stage_forced("stages/07-kubernetes-services", force_stages) == forced
+
+
+def test_stage_journal(tmp_path):
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    assert not journal.is_unchanged("stages/03", "abc")
+
+    journal.record("stages/03", "abc")
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    assert journal.is_unchanged("stages/03", "abc")
+    assert not journal.is_unchanged("stages/03", "def")
+
+    journal.clear()
+    assert not StageJournal.load(journal.filename).is_unchanged("stages/03", "abc")
+
+
+def test_deploy_stage_skips_unchanged(tmp_path, stage_directory, monkeypatch):
+    calls = []
+
+    def _deploy(directory, **kwargs):
+        calls.append(kwargs)
+        return {"name": {"value": "qhub"}}
+
+    monkeypatch.setattr(deploy.terraform, "deploy", _deploy)
+
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    stage = "stages/03-kubernetes-initialize"
+    stage_outputs = {}
+
+    def deploy_stage(**kwargs):
+        return deploy.deploy_stage(
+            stage_outputs,
+            stage,
+            terraform_directory=str(stage_directory),
+            input_vars={"name": "qhub"},
+            journal=journal,
+            **kwargs,
+        )
+
+    assert deploy_stage() == {"name": {"value": "qhub"}}
+    assert calls[-1].get("terraform_apply", True)
+
+    deploy_stage()
+    assert calls[-1]["terraform_apply"] is False
+    assert calls[-1]["terraform_import"] is False
+
+    deploy_stage(force_stages=["03"])
+    assert calls[-1].get("terraform_apply", True)
+
+    # changed upstream outputs redeploy the stage
+    stage_outputs["stages/02-infrastructure"] = {"cluster": {"value": "b"}}
+    deploy_stage()
+    assert calls[-1].get("terraform_apply", True)
+
+
+def test_deploy_stage_failed_apply(tmp_path, stage_directory, monkeypatch):
+    calls = []
+    fail = []
+
+    def _deploy(directory, **kwargs):
+        calls.append(kwargs)
+        if fail:
+            raise deploy.terraform.TerraformException("apply failed")
+        return {"name": {"value": "qhub"}}
+
+    monkeypatch.setattr(deploy.terraform, "deploy", _deploy)
+
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    stage = "stages/03-kubernetes-initialize"
+
+    def deploy_stage(name):
+        return deploy.deploy_stage(
+            {},
+            stage,
+            terraform_directory=str(stage_directory),
+            input_vars={"name": name},
+            journal=journal,
+        )
+
+    deploy_stage("d1")
+
+    # the apply of a changed configuration fails partway
+    fail.append(True)
+    with pytest.raises(deploy.terraform.TerraformException):
+        deploy_stage("d2")
+    assert stage not in StageJournal.load(journal.filename).stages
+
+    # reverting the configuration applies the stage again
+    fail.clear()
+    deploy_stage("d1")
+    assert calls[-1].get("terraform_apply", True)
+
+
+def test_deploy_stage_recreates_missing_kubeconfig(
+    tmp_path, stage_directory, monkeypatch
+):
+    calls = []
+    kubeconfig_filename = tmp_path / "tmp" / "QHUB_KUBECONFIG"
+
+    def _deploy(directory, **kwargs):
+        calls.append(kwargs)
+        if kwargs.get("terraform_apply", True):
+            # the local_file.kubeconfig resource of stage 02
+            kubeconfig_filename.parent.mkdir(exist_ok=True)
+            kubeconfig_filename.write_text("kubeconfig")
+        return {"kubeconfig_filename": {"value": str(kubeconfig_filename)}}
+
+    monkeypatch.setattr(deploy.terraform, "deploy", _deploy)
+
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+
+    def deploy_stage():
+        return deploy.deploy_stage(
+            {},
+            "stages/02-infrastructure",
+            terraform_directory=str(stage_directory),
+            input_vars={"kubeconfig_filename": str(kubeconfig_filename)},
+            journal=journal,
+            refresh_when_unchanged=True,
+            required_files=[str(kubeconfig_filename)],
+        )
+
+    deploy_stage()
+    deploy_stage()
+    assert calls[-1]["terraform_apply"] is False
+    assert calls[-1]["terraform_refresh"] is True
+
+    # e.g. the temporary directory was cleaned up by a reboot
+    kubeconfig_filename.unlink()
+    deploy_stage()
+    assert calls[-1].get("terraform_apply", True)
+    assert kubeconfig_filename.exists()
+
+
+def test_deploy_stage_dry_run(tmp_path, stage_directory, monkeypatch):
+    calls = []
+
+    def _deploy(directory, **kwargs):
+        calls.append(kwargs)
+        return {}
+
+    monkeypatch.setattr(deploy.terraform, "deploy", _deploy)
+
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    for _ in range(2):
+        deploy.deploy_stage(
+            {},
+            "stages/01-terraform-state",
+            terraform_directory=str(stage_directory),
+            input_vars={},
+            journal=journal,
+            terraform_import=True,
+            terraform_apply=False,
+            terraform_plan=True,
+        )
+        # a dry run neither imports nor records the stage as deployed
+        assert calls[-1]["terraform_import"] is False
+        assert calls[-1]["terraform_plan"] is True
+    assert journal.stages == {}
+
+
+def test_stage_journal_seals_sensitive_outputs(tmp_path, qhub_cache_directory):
+    outputs = {
+        "credentials": {"sensitive": True, "type": "string", "value": "secret"},
+        "name": {"sensitive": False, "type": "string", "value": "qhub"},
+    }
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    journal.record("stages/05", "abc", outputs)
+
+    with open(journal.filename) as f:
+        contents = f.read()
+    assert "secret" not in contents
+    assert "qhub" in contents
+
+    journal = StageJournal.load(journal.filename)
+    assert journal.outputs("stages/05") == outputs
+
+    # outputs sealed with another key are unavailable
+    (qhub_cache_directory / JOURNAL_KEY_FILENAME).unlink()
+    assert journal.outputs("stages/05") is None
+
+
+def test_deploy_stage_resume(tmp_path, stage_directory, monkeypatch):
+    calls = []
+
+    def _deploy(directory, **kwargs):
+        calls.append(kwargs)
+        return {"name": {"value": "qhub"}}
+
+    monkeypatch.setattr(deploy.terraform, "deploy", _deploy)
+
+    journal = StageJournal.load(stage_journal_path(str(tmp_path)))
+    stage = "stages/03-kubernetes-initialize"
+
+    def provision(check_function, resume=False):
+        stage_outputs = {}
+        stage_outputs[stage] = deploy.deploy_stage(
+            stage_outputs,
+            stage,
+            terraform_directory=str(stage_directory),
+            input_vars={},
+            journal=journal,
+            resume=resume,
+        )
+        deploy.check_stage(
+            stage,
+            check_function,
+            stage_outputs,
+            {},
+            journal=journal,
+            resume=resume,
+        )
+        return stage_outputs[stage]
+
+    def failing_check(stage_outputs, config):
+        raise CheckException("check failed")
+
+    with pytest.raises(CheckException):
+        provision(failing_check)
+    assert journal.stages[stage]["status"] == STAGE_APPLIED
+
+    # incomplete stages are checked again when resuming
+    checked = []
+    provision(lambda stage_outputs, config: checked.append(stage), resume=True)
+    assert len(calls) == 2 and checked == [stage]
+    assert journal.is_complete(stage)
+
+    # complete stages are neither deployed nor checked when resuming
+    assert provision(failing_check, resume=True) == {"name": {"value": "qhub"}}
+    assert len(calls) == 2
+
+    # a failed check without resume leaves the stage incomplete
+    with pytest.raises(CheckException):
+        provision(failing_check)
+    assert not journal.is_complete(stage)
@@ -0,0 +1,116 @@
+import keycloak
+import pytest
+
+from qhub import keycloak as qhub_keycloak
+
+
+class FakeKeycloakConnection:
+    def __init__(self, admin):
+        self.admin = admin
+        self.token = None
+
+    def get_token(self):
+        FakeKeycloakAdmin.token_exchanges += 1
+        if FakeKeycloakAdmin.fail:
+            raise keycloak.exceptions.KeycloakConnectionError("connection refused")
+        self.token = {"access_token": "token"}
+
+
+class FakeKeycloakAdmin:
+    """Stand-in for `keycloak.KeycloakAdmin` which, like python-keycloak
+    7, only logs in once its connection requests a token"""
+
+    token_exchanges = 0
+    fail = False
+
+    def __init__(self, server_url, username, password, **kwargs):
+        self.server_url = server_url
+        self.kwargs = kwargs
+        self.connection = FakeKeycloakConnection(self)
+
+
+@pytest.fixture
+def fake_keycloak_admin(monkeypatch):
+    monkeypatch.setattr(keycloak, "KeycloakAdmin", FakeKeycloakAdmin)
+    monkeypatch.setattr(qhub_keycloak, "_keycloak_admin_sessions", {})
+    FakeKeycloakAdmin.token_exchanges = 0
+    FakeKeycloakAdmin.fail = False
+    return FakeKeycloakAdmin
+
+
+def test_keycloak_admin_session_shared(fake_keycloak_admin):
+    admin = qhub_keycloak.keycloak_admin_session(
+        "https://example.com/auth/", "root", "secret"
+    )
+    assert (
+        qhub_keycloak.keycloak_admin_session(
+            "https://example.com/auth/", "root", "secret"
+        )
+        is admin
+    )
+    assert fake_keycloak_admin.token_exchanges == 1
+
+    qhub_keycloak.keycloak_admin_session("https://example.com/auth/", "root", "other")
+    assert fake_keycloak_admin.token_exchanges == 2
+
+
+def test_keycloak_admin_session_logs_in(fake_keycloak_admin):
+    admin = qhub_keycloak.keycloak_admin_session(
+        "https://example.com/auth/", "root", "secret"
+    )
+    assert admin.connection.token is not None
+    assert "auto_refresh_token" not in admin.kwargs
+
+
+def test_keycloak_admin_session_failure_not_cached(fake_keycloak_admin):
+    fake_keycloak_admin.fail = True
+    with pytest.raises(keycloak.exceptions.KeycloakConnectionError):
+        qhub_keycloak.keycloak_admin_session(
+            "https://example.com/auth/", "root", "secret"
+        )
+
+    fake_keycloak_admin.fail = False
+    qhub_keycloak.keycloak_admin_session("https://example.com/auth/", "root", "secret")
+    assert fake_keycloak_admin.token_exchanges == 2
+
+
+def test_get_keycloak_admin_from_config(fake_keycloak_admin, monkeypatch):
+    monkeypatch.delenv("KEYCLOAK_SERVER_URL", raising=False)
+    monkeypatch.delenv("KEYCLOAK_ADMIN_PASSWORD", raising=False)
+    config = {
+        "domain": "example.com",
+        "certificate": {"type": "self-signed"},
+        "security": {"keycloak": {"initial_root_password": "secret"}},
+    }
+
+    admin = qhub_keycloak.get_keycloak_admin_from_config(config)
+    assert admin.server_url == "https://example.com/auth/"
+    assert admin.kwargs["verify"] is False
+    assert qhub_keycloak.get_keycloak_admin_from_config(config) is admin
+    assert fake_keycloak_admin.token_exchanges == 1
+
+    fake_keycloak_admin.fail = True
+    config["domain"] = "other.example.com"
+    with pytest.raises(ValueError, match="Failed to connect"):
+        qhub_keycloak.get_keycloak_admin_from_config(config)
+
+
+def test_evict_keycloak_admin_session(fake_keycloak_admin):
+    admin = qhub_keycloak.keycloak_admin_session(
+        "https://example.com/auth/", "root", "secret"
+    )
+    qhub_keycloak.evict_keycloak_admin_session(admin)
+
+    # a failed session is replaced by a newly authenticated one
+    new_admin = qhub_keycloak.keycloak_admin_session(
+        "https://example.com/auth/", "root", "secret"
+    )
+    assert new_admin is not admin
+    assert fake_keycloak_admin.token_exchanges == 2
+    qhub_keycloak.evict_keycloak_admin_session(admin)
+    assert (
+        qhub_keycloak.keycloak_admin_session(
+            "https://example.com/auth/", "root", "secret"
+        )
+        is new_admin
+    )
@@ -0,0 +1,137 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+from qhub.stages import kubernetes_watch
+
+KUBECONFIG = """
+apiVersion: v1
+kind: Config
+clusters:
+- cluster: {{server: "https://{host}:6443"}}
+  name: test
+contexts:
+- context: {{cluster: test, user: test}}
+  name: test
+current-context: test
+users:
+- name: test
+  user: {{token: abc}}
+"""
+
+
+def node(name, ready, resource_version="1"):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, resource_version=resource_version),
+        status=SimpleNamespace(
+            conditions=[
+                SimpleNamespace(type="Ready", status="True" if ready else "False")
+            ]
+        ),
+    )
+
+
+class FakeWatch:
+    """Stand-in for `kubernetes.watch.Watch` yielding the queued events"""
+
+    streams = []
+
+    def stream(self, func, **kwargs):
+        if not self.streams:
+            # no events until the server side timeout of the watch
+            time.sleep(0.05)
+            return
+        events = self.streams.pop(0)
+        if isinstance(events, Exception):
+            raise events
+        yield from events
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture
+def fake_watch(monkeypatch):
+    monkeypatch.setattr("kubernetes.watch.Watch", FakeWatch)
+    FakeWatch.streams = []
+    return FakeWatch
+
+
+def test_api_client_cached(tmp_path):
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text(KUBECONFIG.format(host="127.0.0.1"))
+
+    api_client = kubernetes_watch.api_client(str(kubeconfig))
+    assert kubernetes_watch.api_client(str(kubeconfig)) is api_client
+
+    # a rewritten kubeconfig e.g. renewed credentials builds a new client
+    kubeconfig.write_text(KUBECONFIG.format(host="127.0.0.2"))
+    os.utime(kubeconfig, ns=(0, time.time_ns() + 10**9))
+    new_api_client = kubernetes_watch.api_client(str(kubeconfig))
+    assert new_api_client is not api_client
+    assert new_api_client.configuration.host == "https://127.0.0.2:6443"
+
+
+def test_watch_until_ready(fake_watch):
+    lists = []
+
+    def list_node(**kwargs):
+        lists.append(kwargs)
+        return SimpleNamespace(
+            items=[node("a", False)], metadata=SimpleNamespace(resource_version="1")
+        )
+
+    fake_watch.streams = [
+        [{"type": "MODIFIED", "object": node("a", False, "2")}],
+        # resource version expired while reconnecting, lists again
+        ApiException(status=410, reason="Gone"),
+        [
+            {"type": "ADDED", "object": node("b", False, "3")},
+            {"type": "DELETED", "object": node("a", False, "4")},
+            {"type": "MODIFIED", "object": node("b", True, "5")},
+        ],
+    ]
+
+    ready, nodes = kubernetes_watch.watch_until(
+        list_node, kubernetes_watch.nodes_ready, time.monotonic() + 5
+    )
+    assert ready
+    assert list(nodes) == ["b"]
+    assert len(lists) == 2
+    assert not fake_watch.streams
+
+
+def test_watch_until_deadline(fake_watch):
+    def list_node(**kwargs):
+        return SimpleNamespace(
+            items=[node("a", False)], metadata=SimpleNamespace(resource_version="1")
+        )
+
+    start_time = time.monotonic()
+    ready, nodes = kubernetes_watch.watch_until(
+        list_node, kubernetes_watch.nodes_ready, time.monotonic() + 0.2
+    )
+    assert not ready and list(nodes) == ["a"]
+    assert time.monotonic() - start_time < 1
+
+
+def test_namespace_and_deployment_predicates():
+    namespaces = {"dev": SimpleNamespace(status=SimpleNamespace(phase="Terminating"))}
+    assert not kubernetes_watch.namespace_active("dev")(namespaces)
+    namespaces["dev"].status.phase = "Active"
+    assert kubernetes_watch.namespace_active("dev")(namespaces)
+    assert not kubernetes_watch.namespace_active("prod")(namespaces)
+
+    deployment = SimpleNamespace(
+        status=SimpleNamespace(
+            conditions=[SimpleNamespace(type="Available", status="False")]
+        )
+    )
+    assert kubernetes_watch.deployments_available({})
+    assert not kubernetes_watch.deployments_available({"coredns": deployment})
+    assert kubernetes_watch.unavailable_deployments({"coredns": deployment}) == [
+        "coredns"
+    ]
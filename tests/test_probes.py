@@ -0,0 +1,125 @@
+import socket
+import time
+
+from qhub.stages import probes
+
+
+def test_backoff_delay():
+    for attempt in range(1, 10):
+        delay = probes.backoff_delay(attempt, initial=1, maximum=30)
+        assert 0 <= delay <= min(30, 2 ** (attempt - 1))
+
+
+def test_run_probes_concurrently():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    open_port = server.getsockname()[1]
+
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+
+    ready_time = time.monotonic() + 0.5
+
+    async def _eventually_ready():
+        return time.monotonic() >= ready_time
+
+    try:
+        start_time = time.monotonic()
+        results = probes.run_probes(
+            {
+                "open": probes.tcp_connect("127.0.0.1", open_port),
+                "closed": probes.tcp_connect("127.0.0.1", closed_port),
+                "eventually": _eventually_ready,
+            },
+            deadline=5,
+        )
+    finally:
+        server.close()
+
+    assert results["open"]["ready"] and results["open"]["attempts"] == 1
+    assert results["eventually"]["ready"]
+    assert results["eventually"]["time_to_ready"] >= 0.5
+    assert not results["closed"]["ready"]
+    assert "ConnectionRefusedError" in results["closed"]["error"]
+    # all probes share the single deadline
+    assert time.monotonic() - start_time < 6
+
+
+def test_resolve_host():
+    addresses = []
+    results = probes.run_probes(
+        {"localhost": probes.resolve_host("localhost", addresses)}, deadline=5
+    )
+    assert results["localhost"]["ready"]
+    assert "127.0.0.1" in addresses
+
+
+def test_http_get_pooled(capsys):
+    import http.server
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status = 200 if self.path == "/health" else 503
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        with probes.thread_sessions([f"{url}/health", f"{url}/down"]) as get_session:
+            results = probes.run_probes(
+                {
+                    "jupyterhub": probes.http_get(get_session, f"{url}/health"),
+                    "conda-store": probes.http_get(get_session, f"{url}/health"),
+                    "monitoring": probes.http_get(get_session, f"{url}/down"),
+                },
+                deadline=2,
+            )
+    finally:
+        server.shutdown()
+
+    assert results["jupyterhub"]["ready"] and results["conda-store"]["ready"]
+    assert not results["monitoring"]["ready"]
+    assert results["monitoring"]["attempts"] > 1
+
+    probes.print_probe_table(results)
+    table = capsys.readouterr().out.splitlines()
+    assert table[-1].split() == [
+        "no",
+        str(results["monitoring"]["attempts"]),
+        "-",
+        "monitoring",
+    ]
+
+
+def test_thread_sessions():
+    import threading
+
+    urls = [
+        "https://example.com/hub/health",
+        "https://example.com/conda-store/health",
+        "https://grafana.example.com/health",
+    ]
+    with probes.thread_sessions(urls) as get_session:
+        session = get_session()
+        assert get_session() is session
+        adapter = session.get_adapter("https://example.com")
+        assert adapter._pool_connections == 2
+
+        other_sessions = []
+        thread = threading.Thread(target=lambda: other_sessions.append(get_session()))
+        thread.start()
+        thread.join()
+        assert other_sessions[0] is not session
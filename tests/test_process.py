@@ -0,0 +1,66 @@
+import concurrent.futures
+import io
+import time
+
+from qhub.process import BatchedOutput, run_subprocess_cmd, run_subprocess_cmds
+
+
+def test_run_subprocess_cmd(tmp_path):
+    stream = io.BytesIO()
+    log_filename = tmp_path / "logs" / "stage.log"
+
+    exit_code = run_subprocess_cmd(
+        ["sh", "-c", "echo hidden; echo visible; exit 3"],
+        prefix="terraform",
+        line_handler=lambda line: None if line == b"hidden\n" else line,
+        log_filename=str(log_filename),
+        output=BatchedOutput(stream=stream),
+    )
+
+    assert exit_code == 3
+    assert stream.getvalue() == b"[terraform]: visible\n"
+    assert log_filename.read_bytes().endswith(b"\nvisible\n")
+
+
+def test_run_subprocess_cmd_timeout_kills_process_group():
+    start_time = time.monotonic()
+    exit_code = run_subprocess_cmd(
+        ["sh", "-c", "sleep 30 & sleep 30; wait"],
+        timeout=0.5,
+        output=BatchedOutput(stream=io.BytesIO()),
+    )
+    assert exit_code != 0
+    # the background sleep holding stdout open was killed too
+    assert time.monotonic() - start_time < 10
+
+
+def test_run_subprocess_cmds_concurrently():
+    streams = [io.BytesIO() for _ in range(4)]
+    start_time = time.monotonic()
+    exit_codes = run_subprocess_cmds(
+        [
+            {
+                "processargs": ["sh", "-c", f"sleep 0.5; echo {i}; exit {i}"],
+                "output": BatchedOutput(stream=stream),
+            }
+            for i, stream in enumerate(streams)
+        ],
+        max_concurrency=4,
+    )
+    assert time.monotonic() - start_time < 1.5
+    assert exit_codes == [0, 1, 2, 3]
+    assert [_.getvalue() for _ in streams] == [b"0\n", b"1\n", b"2\n", b"3\n"]
+
+
+def test_run_subprocess_cmd_from_worker_thread():
+    # the stage scheduler runs terraform from its pool threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                run_subprocess_cmd,
+                ["sh", "-c", f"echo {i}; exit {i}"],
+                output=BatchedOutput(stream=io.BytesIO()),
+            )
+            for i in range(2)
+        ]
+        assert [_.result(timeout=30) for _ in futures] == [0, 1]
@@ -0,0 +1,91 @@
+import json
+import logging
+
+import pytest
+
+from qhub.cli import cli
+from qhub.profile import TOTAL_PHASE, compare_profiles, load_profile, profile
+from qhub.utils import timer
+
+logger = logging.getLogger(__name__)
+
+
+def make_report(duration, phases):
+    return {
+        "version": 1,
+        "command": "deploy",
+        "duration": duration,
+        "phases": [
+            {"name": name, "attributes": attributes, "duration": duration_}
+            for name, attributes, duration_ in phases
+        ],
+    }
+
+
+def test_profile_records_timers(tmp_path):
+    filename = tmp_path / "profile.json"
+
+    with timer(logger, "outside"):
+        pass
+
+    with pytest.raises(RuntimeError):
+        with profile("deploy", str(filename)):
+            with timer(logger, "terraform apply", directory="stages/01"):
+                pass
+            with timer(logger, "check", stage="stages/01"):
+                raise RuntimeError()
+
+    report = load_profile(str(filename))
+    assert report["command"] == "deploy"
+    assert [(_["name"], _["attributes"], _["status"]) for _ in report["phases"]] == [
+        ("terraform apply", {"directory": "stages/01"}, "ok"),
+        ("check", {"stage": "stages/01"}, "error"),
+    ]
+
+
+def test_compare_profiles():
+    base = make_report(
+        100.0,
+        [
+            ("terraform apply", {"directory": "stages/02"}, 60.0),
+            ("check", {"stage": "stages/04"}, 1.0),
+            ("check", {"stage": "stages/04"}, 1.0),
+            ("dns wait", {}, 10.0),
+        ],
+    )
+    new = make_report(
+        130.0,
+        [
+            ("terraform apply", {"directory": "stages/02"}, 61.0),
+            ("check", {"stage": "stages/04"}, 4.0),
+            ("dns wait", {}, 30.0),
+            ("render", {}, 2.0),
+        ],
+    )
+
+    rows = compare_profiles(base, new, threshold=0.2, min_seconds=5.0)
+    assert rows[0]["phase"] == TOTAL_PHASE
+    by_phase = {row["phase"]: row for row in rows}
+
+    assert by_phase[TOTAL_PHASE]["regression"]
+    assert by_phase["dns wait"]["regression"]
+    assert by_phase["dns wait"]["delta"] == 20.0
+    # too small relative or absolute slowdowns are not regressions
+    assert not by_phase["terraform apply directory=stages/02"]["regression"]
+    assert not by_phase["check stage=stages/04"]["regression"]
+    # phases missing from the baseline are reported but not regressions
+    assert by_phase["render"]["base"] is None
+    assert not by_phase["render"]["regression"]
+
+
+def test_cli_profile_compare(tmp_path):
+    base = tmp_path / "base.json"
+    new = tmp_path / "new.json"
+    base.write_text(json.dumps(make_report(100.0, [])))
+    new.write_text(json.dumps(make_report(200.0, [])))
+
+    cli(["profile", "compare", str(base), str(new)])
+
+    with pytest.raises(SystemExit) as e:
+        cli(["profile", "compare", str(base), str(new), "--fail-on-regression"])
+    assert e.value.code == 1
@@ -1,10 +1,21 @@
 import os
+import json
+import hashlib
 import pytest
 from pathlib import Path
 
 from ruamel.yaml import YAML
 
-from qhub.render import render_template, set_env_vars_in_config
+import qhub.render
+from qhub.render import (
+    render_template,
+    set_env_vars_in_config,
+    load_render_manifest,
+    hash_file,
+    build_template_index,
+    load_template_index,
+    template_index_path,
+)
 from .conftest import render_config_partial, PRESERVED_DIR
 
 
@@ -117,3 +128,275 @@ def test_exists_after_render(write_qhub_config_to_file):
 
     for i in items_to_check:
         assert i in ls
+
+
+def test_render_manifest(write_qhub_config_to_file):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    manifest = load_render_manifest(output_directory)
+    assert ".gitignore" in manifest
+    assert "stages/04-kubernetes-ingress/main.tf" in manifest
+    assert "stages/04-kubernetes-ingress/_qhub.tf.json" in manifest
+
+    for filename, entry in manifest.items():
+        assert entry["sha256"] == hash_file(output_directory / filename)
+
+
+def test_rerender_skips_hashing_unchanged_files(write_qhub_config_to_file, monkeypatch):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    hashed = []
+    original_hash_file = qhub.render.hash_file
+
+    def _hash_file(file_path):
+        hashed.append(os.path.relpath(file_path, output_directory))
+        return original_hash_file(file_path)
+
+    monkeypatch.setattr(qhub.render, "hash_file", _hash_file)
+    render_template(str(output_directory), qhub_config_loc, force=True)
+
+    # only template side of the diff should be hashed
+    assert not [_ for _ in hashed if _ in load_render_manifest(output_directory)]
+
+
+def test_rerender_restores_edited_and_deleted_files(write_qhub_config_to_file):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    edited_filename = output_directory / "stages/04-kubernetes-ingress/main.tf"
+    original_contents = edited_filename.read_text()
+    edited_filename.write_text(original_contents + "\n# local edit\n")
+
+    deleted_filename = output_directory / "stages/05-kubernetes-keycloak/outputs.tf"
+    deleted_contents = deleted_filename.read_text()
+    deleted_filename.unlink()
+
+    render_template(str(output_directory), qhub_config_loc, force=True)
+
+    assert edited_filename.read_text() == original_contents
+    assert deleted_filename.read_text() == deleted_contents
+
+    manifest = load_render_manifest(output_directory)
+    assert manifest["stages/04-kubernetes-ingress/main.tf"]["sha256"] == hash_file(
+        edited_filename
+    )
+
+
+def test_rerender_full_detects_edit_with_unchanged_stat(write_qhub_config_to_file):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    edited_filename = output_directory / "stages/04-kubernetes-ingress/main.tf"
+    original_contents = edited_filename.read_text()
+    stat = edited_filename.stat()
+
+    # same size edit which preserves the modification time
+    edited_filename.write_text(original_contents[::-1])
+    os.utime(edited_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    render_template(str(output_directory), qhub_config_loc, force=True)
+    assert edited_filename.read_text() == original_contents[::-1]
+
+    render_template(str(output_directory), qhub_config_loc, force=True, full=True)
+    assert edited_filename.read_text() == original_contents
+
+
+def test_rerender_removes_deprecated_paths(write_qhub_config_to_file):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    deprecated_directory = output_directory / "infrastructure"
+    deprecated_directory.mkdir()
+    (deprecated_directory / "main.tf").write_text("# deprecated")
+    deprecated_filename = output_directory / ".github/workflows/image.yaml"
+    deprecated_filename.parent.mkdir(parents=True, exist_ok=True)
+    deprecated_filename.write_text("# deprecated")
+
+    render_template(str(output_directory), qhub_config_loc, force=True)
+
+    assert not deprecated_directory.exists()
+    assert not deprecated_filename.exists()
+    assert (output_directory / PRESERVED_DIR / "file.txt").exists()
+
+
+@pytest.fixture
+def template_with_index(tmp_path):
+    template_directory = tmp_path / "qhub" / "template"
+    (template_directory / "stages" / "04-kubernetes-ingress").mkdir(parents=True)
+    (template_directory / "stages" / "04-kubernetes-ingress" / "main.tf").write_text(
+        "# main"
+    )
+    (template_directory / "image").mkdir()
+    (template_directory / "image" / "Dockerfile").write_text("FROM scratch")
+
+    index = build_template_index(str(template_directory))
+    template_index_path(template_directory).write_text(json.dumps(index))
+    load_template_index.cache_clear()
+
+    yield template_directory
+
+    load_template_index.cache_clear()
+
+
+def test_template_index(template_with_index):
+    index = load_template_index(str(template_with_index))
+
+    main_filename = os.path.join("stages", "04-kubernetes-ingress", "main.tf")
+    assert index == {
+        main_filename: hash_file(template_with_index / main_filename),
+        os.path.join("image", "Dockerfile"): hash_file(
+            template_with_index / "image" / "Dockerfile"
+        ),
+    }
+
+
+def test_template_index_stale(template_with_index):
+    (template_with_index / "image" / "Dockerfile").write_text("FROM python")
+    assert load_template_index(str(template_with_index)) is None
+
+    load_template_index.cache_clear()
+    (template_with_index / "image" / "Dockerfile").write_text("FROM scratch")
+    (template_with_index / "image" / "README.md").write_text("# image")
+    assert load_template_index(str(template_with_index)) is None
+
+
+def test_template_index_stale_in_development_checkout(template_with_index):
+    # same size edit is only detected by modification time in a git checkout
+    filename = template_with_index / "image" / "Dockerfile"
+    filename.write_text("FROM busybox")
+    index_mtime = template_index_path(template_with_index).stat().st_mtime_ns
+    os.utime(filename, ns=(index_mtime + 10**9, index_mtime + 10**9))
+    assert load_template_index(str(template_with_index)) is not None
+
+    load_template_index.cache_clear()
+    (template_with_index.parent.parent / ".git").mkdir()
+    assert load_template_index(str(template_with_index)) is None
+
+
+def test_hash_files(tmp_path):
+    contents = {
+        tmp_path / "empty.txt": b"",
+        tmp_path / "small.txt": b"qhub",
+        # spans multiple chunks of the streaming hash
+        tmp_path / "large.bin": os.urandom(qhub.render.HASH_CHUNK_SIZE * 2 + 17),
+        tmp_path / "chunk.bin": os.urandom(qhub.render.HASH_CHUNK_SIZE),
+        tmp_path / "batch.bin": os.urandom(qhub.render.HASH_BATCH_SIZE),
+    }
+    for path, content in contents.items():
+        path.write_bytes(content)
+
+    # hashed in the calling thread and on the thread pool
+    for max_workers in [1, 2]:
+        digests = qhub.render.hash_files(
+            [str(_) for _ in contents], max_workers=max_workers
+        )
+        assert digests == {
+            str(path): hashlib.sha256(content).hexdigest()
+            for path, content in contents.items()
+        }
+
+
+def test_copy_file(tmp_path):
+    source = tmp_path / "source.sh"
+    source.write_bytes(os.urandom(3 * 1024 * 1024))
+    source.chmod(0o755)
+
+    destination = tmp_path / "destination.sh"
+    qhub.render.copy_file(str(source), str(destination))
+
+    assert destination.read_bytes() == source.read_bytes()
+    assert destination.stat().st_mode == source.stat().st_mode
+
+
+def test_interrupted_render_leaves_output_unchanged(
+    write_qhub_config_to_file, monkeypatch
+):
+    qhub_config_loc, _ = write_qhub_config_to_file
+    output_directory = qhub_config_loc.parent
+
+    stage_directory = output_directory / "stages/04-kubernetes-ingress"
+    for filename in ["main.tf", "variables.tf"]:
+        (stage_directory / filename).write_text("# local edit")
+
+    def _copy_file(source, destination):
+        if source.endswith("variables.tf"):
+            raise KeyboardInterrupt()
+        original_copy_file(source, destination)
+
+    original_copy_file = qhub.render.copy_file
+    monkeypatch.setattr(qhub.render, "copy_file", _copy_file)
+
+    with pytest.raises(KeyboardInterrupt):
+        render_template(str(output_directory), qhub_config_loc, force=True)
+
+    for filename in ["main.tf", "variables.tf"]:
+        assert (stage_directory / filename).read_text() == "# local edit"
+    assert not list((output_directory / ".qhub").glob("render-staging-*"))
+
+    monkeypatch.setattr(qhub.render, "copy_file", original_copy_file)
+    render_template(str(output_directory), qhub_config_loc, force=True)
+    for filename in ["main.tf", "variables.tf"]:
+        assert (stage_directory / filename).read_text() != "# local edit"
+
+
+def test_interrupted_renames_rolled_forward(tmp_path, monkeypatch):
+    template_directory = tmp_path / "template"
+    output_directory = tmp_path / "output"
+    filenames = ["stages/04-kubernetes-ingress/main.tf", "stages/variables.tf"]
+    for filename in filenames:
+        (template_directory / filename).parent.mkdir(parents=True, exist_ok=True)
+        (template_directory / filename).write_text("# rendered")
+        (output_directory / filename).parent.mkdir(parents=True, exist_ok=True)
+        (output_directory / filename).write_text("# local edit")
+
+    def _replace(source, destination):
+        if str(destination).endswith("variables.tf"):
+            raise KeyboardInterrupt()
+        original_replace(source, destination)
+
+    original_replace = os.replace
+    monkeypatch.setattr(os, "replace", _replace)
+    with pytest.raises(KeyboardInterrupt):
+        qhub.render.materialize_files(
+            filenames, template_directory, output_directory, {}
+        )
+    monkeypatch.setattr(os, "replace", original_replace)
+
+    # the committed staging directory is completed by the next render
+    staging_directories = list((output_directory / ".qhub").glob("render-staging-*"))
+    assert len(staging_directories) == 1
+    qhub.render.materialize_files([], template_directory, output_directory, {})
+    for filename in filenames:
+        assert (output_directory / filename).read_text() == "# rendered"
+    assert not list((output_directory / ".qhub").glob("render-staging-*"))
+
+
+def test_materialize_files_waits_for_concurrent_render(tmp_path):
+    import threading
+
+    from qhub.utils import file_lock
+
+    template_directory = tmp_path / "template"
+    output_directory = tmp_path / "output"
+    (template_directory / "stages").mkdir(parents=True)
+    (template_directory / "stages/main.tf").write_text("# rendered")
+    state_directory = output_directory / ".qhub"
+    state_directory.mkdir(parents=True)
+
+    # staging directory of a render which still holds the lock
+    with file_lock(str(state_directory / "render.lock")):
+        staging_directory = state_directory / "render-staging-running"
+        staging_directory.mkdir()
+        thread = threading.Thread(
+            target=qhub.render.materialize_files,
+            args=(["stages/main.tf"], template_directory, output_directory, {}),
+        )
+        thread.start()
+        thread.join(timeout=0.5)
+        assert thread.is_alive()
+        assert staging_directory.exists()
+
+    thread.join(timeout=5)
+    assert (output_directory / "stages/main.tf").read_text() == "# rendered"
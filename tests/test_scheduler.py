@@ -0,0 +1,173 @@
+import os
+import threading
+
+import pytest
+
+from qhub import deploy
+from qhub.stages.checks import CheckException
+from qhub.stages.scheduler import Scheduler
+
+
+def test_scheduler_runs_independent_tasks_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def task(name, wait=False):
+        def _task():
+            if wait:
+                barrier.wait()
+            order.append(name)
+            return name
+
+        return _task
+
+    scheduler = Scheduler(max_workers=2)
+    # a and b can only pass the barrier when running concurrently
+    scheduler.add("a", task("a", wait=True))
+    scheduler.add("b", task("b", wait=True))
+    scheduler.add("c", task("c"), ["a", "b"])
+    assert scheduler.run() == {"a": "a", "b": "b", "c": "c"}
+    assert order[-1] == "c"
+
+
+@pytest.mark.parametrize("fail_fast", [True, False])
+def test_scheduler_cancels_dependents(fail_fast):
+    started = []
+
+    def task(name, exception=None):
+        def _task():
+            started.append(name)
+            if exception:
+                raise exception
+
+        return _task
+
+    scheduler = Scheduler(max_workers=1, fail_fast=fail_fast)
+    scheduler.add("a", task("a", CheckException("check failed")))
+    scheduler.add("b", task("b"), ["a"])
+    scheduler.add("c", task("c"), ["b"])
+    scheduler.add("d", task("d"), ["a_independent"])
+    scheduler.add("a_independent", task("a_independent"))
+
+    with pytest.raises(CheckException):
+        scheduler.run()
+    assert "b" not in started and "c" not in started
+    assert ("d" in started) != fail_fast
+
+
+def test_scheduler_validates_graph():
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None, ["b"])
+    scheduler.add("b", lambda: None, ["a"])
+    with pytest.raises(ValueError, match="cyclic"):
+        scheduler.run()
+
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None, ["missing"])
+    with pytest.raises(ValueError, match="unknown"):
+        scheduler.run()
+
+
+def patch_stages(monkeypatch, record):
+    stage_outputs_by_name = {
+        "02_infrastructure": {
+            "kubernetes_credentials": {"value": {"host": "example.com"}}
+        },
+        "05_kubernetes_keycloak": {
+            "keycloak_credentials": {"value": {"url": "https://example.com"}}
+        },
+    }
+
+    def provision(name):
+        def _provision(stage_outputs, config, check=True, **kwargs):
+            assert kwargs["terraform_init"] is False
+            environment = kwargs["context"].environment()
+            # credentials are only passed to the stages after they exist
+            assert ("KUBE_HOST" in environment) == (name[:2] > "02")
+            assert ("KEYCLOAK_URL" in environment) == (name[:2] > "05")
+            record(f"deploy:{name[:2]}")
+            stage = "stages/" + name.replace("_", "-")
+            stage_outputs[stage] = stage_outputs_by_name.get(name, {})
+
+        return _provision
+
+    for name in [
+        "01_terraform_state",
+        "02_infrastructure",
+        "03_kubernetes_initialize",
+        "04_kubernetes_ingress",
+        "05_kubernetes_keycloak",
+        "06_kubernetes_keycloak_configuration",
+        "07_kubernetes_services",
+        "08_qhub_tf_extensions",
+    ]:
+        monkeypatch.setattr(deploy, f"provision_{name}", provision(name))
+
+    for name in [
+        "stage_02_infrastructure",
+        "stage_03_kubernetes_initialize",
+        "stage_04_kubernetes_ingress",
+        "stage_05_kubernetes_keycloak",
+        "stage_06_kubernetes_keycloak_configuration",
+        "stage_07_kubernetes_services",
+    ]:
+        stage = name.split("_")[1]
+        monkeypatch.setattr(
+            deploy.checks,
+            name,
+            lambda stage_outputs, config, stage=stage: record(f"check:{stage}"),
+        )
+    monkeypatch.setattr(
+        deploy,
+        "provision_ingress_dns",
+        lambda stage_outputs, config, **kwargs: record("ingress-dns"),
+    )
+
+
+def test_provision_stages(monkeypatch):
+    events = []
+    lock = threading.Lock()
+
+    def record(event):
+        with lock:
+            events.append(event)
+
+    patch_stages(monkeypatch, record)
+    monkeypatch.setattr(
+        deploy.terraform, "init", lambda directory, upgrade, env: record("init")
+    )
+
+    config = {"provider": "aws", "terraform_state": {"type": "remote"}}
+    stage_outputs = {}
+    deploy.provision_stages(stage_outputs, config, None, False)
+
+    assert events.count("init") == 8
+    deploys = [_ for _ in events if _.startswith("deploy:")]
+    assert deploys == [f"deploy:0{i}" for i in range(1, 9)]
+    assert events.index("check:04") > events.index("deploy:04")
+    assert events.index("ingress-dns") < events.index("check:05")
+    assert events.index("check:06") < events.index("deploy:07")
+    assert len(stage_outputs) == 8
+    assert "KUBE_HOST" not in os.environ
+
+
+def test_provision_stages_kubernetes_state(monkeypatch):
+    init_environments = {}
+    lock = threading.Lock()
+
+    def init(directory, upgrade, env):
+        with lock:
+            init_environments[directory] = env
+
+    patch_stages(monkeypatch, lambda event: None)
+    monkeypatch.setattr(deploy.terraform, "init", init)
+
+    config = {"provider": "local", "terraform_state": {"type": "remote"}}
+    deploy.provision_stages({}, config, None, False)
+
+    assert len(init_environments) == 7
+    # the kubernetes backend needs the credentials of stage 02 to init
+    for directory, environment in init_environments.items():
+        assert ("KUBE_HOST" in environment) == (
+            directory != "stages/02-infrastructure/local"
+        )
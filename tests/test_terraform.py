@@ -0,0 +1,389 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+import pytest
+
+from qhub.provider import terraform, terraform_progress
+
+
+@pytest.fixture
+def terraform_release(monkeypatch, tmp_path):
+    """Serve a fake terraform release and use a temporary qhub cache directory"""
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(terraform.sys, "platform", "linux")
+    monkeypatch.setattr(terraform.platform, "machine", lambda: "x86_64")
+
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as f:
+        f.writestr("terraform", "#!/bin/sh\necho Terraform v1.0.5\n")
+    zip_bytes = zip_bytes.getvalue()
+
+    release = {
+        "filename": "terraform_1.0.5_linux_amd64.zip",
+        "content": zip_bytes,
+        "checksum": hashlib.sha256(zip_bytes).hexdigest(),
+        "requests": [],
+    }
+
+    def _urlopen(url):
+        release["requests"].append(url)
+        if url.endswith("_SHA256SUMS"):
+            return io.BytesIO(
+                f"{'0' * 64}  terraform_1.0.5_darwin_amd64.zip\n"
+                f"{release['checksum']}  {release['filename']}\n".encode("utf-8")
+            )
+        return io.BytesIO(release["content"])
+
+    monkeypatch.setattr(terraform.urllib.request, "urlopen", _urlopen)
+
+    terraform.download_terraform_binary.cache_clear()
+    yield release
+    terraform.download_terraform_binary.cache_clear()
+
+
+def test_download_terraform_binary(terraform_release, tmp_path):
+    filename = terraform.download_terraform_binary("1.0.5")
+
+    assert filename == str(tmp_path / "cache" / "terraform" / "1.0.5" / "terraform")
+    assert os.access(filename, os.X_OK)
+    assert len(terraform_release["requests"]) == 2
+
+    # memoized within the process
+    assert terraform.download_terraform_binary("1.0.5") == filename
+    assert len(terraform_release["requests"]) == 2
+
+    # cached across processes
+    terraform.download_terraform_binary.cache_clear()
+    assert terraform.download_terraform_binary("1.0.5") == filename
+    assert len(terraform_release["requests"]) == 2
+
+
+def test_download_terraform_binary_checksum_mismatch(terraform_release, tmp_path):
+    terraform_release["checksum"] = hashlib.sha256(b"tampered").hexdigest()
+
+    with pytest.raises(terraform.TerraformException):
+        terraform.download_terraform_binary("1.0.5")
+
+    assert os.listdir(tmp_path / "cache" / "terraform" / "1.0.5") == [".lock"]
+
+
+def test_required_providers(tmp_path):
+    (tmp_path / "modules" / "service").mkdir(parents=True)
+    (tmp_path / "versions.tf").write_text(
+        """
+terraform {
+  required_providers {
+    helm = {
+      source  = "hashicorp/helm"
+      version = "2.1.2"
+    }
+    keycloak = {
+      source  = "mrparkers/keycloak"
+      version = "3.7.0"
+    }
+  }
+}
+"""
+    )
+    (tmp_path / "modules" / "service" / "main.tf").write_text(
+        """
+resource "random_password" "password" {
+  length = 32
+}
+
+resource "keycloak_realm" "main" {
+  realm = "qhub"
+}
+"""
+    )
+    (tmp_path / "_qhub.tf.json").write_text(
+        terraform.tf_render_objects(
+            [terraform.RequiredProvider("kubernetes", source="hashicorp/kubernetes")]
+        )
+    )
+
+    assert terraform.required_providers(str(tmp_path)) == {
+        ("hashicorp/helm", "2.1.2"),
+        ("mrparkers/keycloak", "3.7.0"),
+        ("hashicorp/kubernetes", ""),
+        ("hashicorp/random", ""),
+    }
+
+
+def test_seed_plugin_cache(tmp_path, monkeypatch):
+    for stage, version in [("03-stage", "2.1.2"), ("04-stage", "2.2.0")]:
+        (tmp_path / stage).mkdir()
+        (tmp_path / stage / "main.tf").write_text(
+            "terraform {\n  required_providers {\n    helm = {\n"
+            f'      source = "hashicorp/helm"\n      version = "{version}"\n'
+            "    }\n  }\n}\n"
+            'resource "kubernetes_namespace" "main" {}\n'
+            'resource "helm_release" "main" {}\n'
+        )
+
+    terraform.tf_clear()
+    seeded_modules = []
+
+    def _run_terraform_subprocess(processargs, cwd, **kwargs):
+        assert processargs == ["init", "-backend=false"]
+        with open(os.path.join(cwd, "main.tf.json")) as f:
+            required_providers = json.load(f)["terraform"]["required_providers"]
+        seeded_modules.append(
+            sorted((_["source"], _.get("version")) for _ in required_providers.values())
+        )
+
+    monkeypatch.setattr(
+        terraform, "run_terraform_subprocess", _run_terraform_subprocess
+    )
+    terraform.seed_plugin_cache(
+        [str(tmp_path / "03-stage"), str(tmp_path / "04-stage")]
+    )
+
+    # seeding does not register objects rendered by `tf_render`
+    assert json.loads(terraform.tf_render()) == {}
+
+    # conflicting provider versions are seeded in separate modules
+    assert seeded_modules == [
+        [("hashicorp/helm", "2.1.2"), ("hashicorp/kubernetes", None)],
+        [("hashicorp/helm", "2.2.0")],
+    ]
+
+
+@pytest.fixture
+def terraform_init_commands(tmp_path, monkeypatch):
+    commands = []
+    plugin_cache = tmp_path / "plugin-cache" / "hashicorp" / "helm" / "linux_amd64"
+
+    def _run_terraform_subprocess(processargs, cwd, **kwargs):
+        commands.append(processargs)
+        if os.path.exists(os.path.join(cwd, "fail")) and "-upgrade" not in processargs:
+            raise terraform.TerraformException("Terraform returned an error")
+        with open(os.path.join(cwd, ".terraform.lock.hcl"), "w") as f:
+            f.write("# lock")
+
+        # providers are linked from the plugin cache
+        plugin_cache.mkdir(parents=True, exist_ok=True)
+        (plugin_cache / "terraform-provider-helm").write_text("binary")
+        provider = os.path.join(cwd, ".terraform", "providers", "hashicorp", "helm")
+        os.makedirs(provider, exist_ok=True)
+        if not os.path.islink(os.path.join(provider, "linux_amd64")):
+            os.symlink(plugin_cache, os.path.join(provider, "linux_amd64"))
+
+    monkeypatch.setattr(
+        terraform, "run_terraform_subprocess", _run_terraform_subprocess
+    )
+    return commands
+
+
+def test_init_skipped_when_fingerprint_unchanged(tmp_path, terraform_init_commands):
+    (tmp_path / "versions.tf").write_text(
+        'terraform {\n  required_providers {\n    helm = {\n      source = "hashicorp/helm"\n      version = "2.1.2"\n    }\n  }\n}\n'
+    )
+    (tmp_path / "main.tf").write_text(
+        'module "service" {\n  count = 1\n  source = "./modules/service"\n}\n'
+    )
+
+    terraform.init(str(tmp_path))
+    terraform.init(str(tmp_path))
+    assert terraform_init_commands == [["init"]]
+
+    terraform.init(str(tmp_path), upgrade=True)
+    assert terraform_init_commands[-1] == ["init", "-upgrade"]
+
+    # module sources require a new init
+    (tmp_path / "main.tf").write_text(
+        'module "service" {\n  count = 1\n  source = "./modules/other"\n}\n'
+    )
+    terraform.init(str(tmp_path))
+    assert terraform_init_commands[-1] == ["init"]
+    assert len(terraform_init_commands) == 3
+
+    # removing .terraform requires a new init
+    (tmp_path / ".terraform" / terraform.INIT_FINGERPRINT_FILENAME).unlink()
+    terraform.init(str(tmp_path))
+    assert len(terraform_init_commands) == 4
+
+    # providers removed from the plugin cache require a new init
+    shutil.rmtree(tmp_path / "plugin-cache")
+    assert not terraform.is_initialized(str(tmp_path))
+    terraform.init(str(tmp_path))
+    assert len(terraform_init_commands) == 5
+    assert terraform.is_initialized(str(tmp_path))
+
+
+def test_init_retries_with_upgrade(tmp_path, terraform_init_commands):
+    (tmp_path / "fail").write_text("")
+
+    terraform.init(str(tmp_path))
+    assert terraform_init_commands == [["init"], ["init", "-upgrade"]]
+    assert terraform.is_initialized(str(tmp_path))
+
+
+def test_plan_summary():
+    plan_json = {
+        "resource_changes": [
+            {"address": "a.new", "change": {"actions": ["create"]}},
+            {"address": "a.same", "change": {"actions": ["no-op"]}},
+            {"address": "a.updated", "change": {"actions": ["update"]}},
+            {"address": "a.replaced", "change": {"actions": ["delete", "create"]}},
+            {"address": "a.deleted", "change": {"actions": ["delete"]}},
+            {"address": "data.a.read", "change": {"actions": ["read"]}},
+        ],
+        "output_changes": {
+            "changed": {"actions": ["update"]},
+            "unchanged": {"actions": ["no-op"]},
+        },
+    }
+    assert terraform.plan_summary(plan_json) == {
+        "add": ["a.new"],
+        "change": ["a.updated"],
+        "replace": ["a.replaced"],
+        "destroy": ["a.deleted"],
+        "outputs": ["changed"],
+    }
+
+
+@pytest.mark.parametrize("has_changes", [True, False])
+def test_deploy_plan_first(tmp_path, monkeypatch, has_changes):
+    monkeypatch.chdir(tmp_path)
+    commands = []
+
+    def _run_terraform_subprocess(processargs, cwd, exit_codes=(0,), **kwargs):
+        commands.append(processargs[0])
+        assert kwargs["env"] == {"KUBE_HOST": "example.com"}
+        if processargs[0] == "plan":
+            assert exit_codes == (0, 2)
+            return 2 if has_changes else 0
+        if processargs[0] == "apply":
+            # a saved plan is applied without any variables
+            assert processargs[-1].endswith(".tfplan")
+            assert not any(_.startswith("-var-file") for _ in processargs)
+        return 0
+
+    monkeypatch.setattr(
+        terraform, "run_terraform_subprocess", _run_terraform_subprocess
+    )
+    monkeypatch.setattr(terraform, "show", lambda directory, plan_file, env: {})
+    monkeypatch.setattr(terraform, "output", lambda directory, env: {})
+
+    plan_summaries = {}
+    terraform.deploy(
+        str(tmp_path),
+        terraform_init=False,
+        terraform_plan=True,
+        plan_summaries=plan_summaries,
+        env={"KUBE_HOST": "example.com"},
+    )
+    assert commands == (["plan", "apply"] if has_changes else ["plan"])
+    assert plan_summaries[str(tmp_path)]["add"] == []
+
+
+@pytest.mark.parametrize("seeded", [True, False])
+def test_init_all(monkeypatch, seeded):
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def _init(directory, upgrade=False, env=None):
+        with lock:
+            active.append(directory)
+            max_active.append(len(active))
+        try:
+            if directory == "fail":
+                raise terraform.TerraformException("Terraform returned an error")
+            time.sleep(0.05)
+        finally:
+            with lock:
+                active.remove(directory)
+
+    def _seed_plugin_cache(directories):
+        if not seeded:
+            raise terraform.TerraformException("Terraform returned an error")
+
+    monkeypatch.setattr(terraform, "init", _init)
+    monkeypatch.setattr(terraform, "is_initialized", lambda directory: False)
+    monkeypatch.setattr(terraform, "seed_plugin_cache", _seed_plugin_cache)
+
+    with pytest.raises(terraform.TerraformException):
+        terraform.init_all(["a", "b", "fail", "c"], max_workers=4)
+    # without a seeded plugin cache directories are initialized serially
+    assert (max(max_active) > 1) == seeded
+
+
+@pytest.mark.parametrize(
+    "addresses, imported",
+    [
+        ({"a.present"}, ["a.missing"]),
+        (None, ["a.present", "a.missing"]),
+    ],
+)
+def test_import_missing(tmp_path, monkeypatch, capsys, addresses, imported):
+    monkeypatch.setenv("QHUB_CACHE_DIR", str(tmp_path))
+    terraform.record_import_durations([10.0, 20.0])
+
+    tfimports = []
+    monkeypatch.setattr(terraform, "state_list", lambda directory, env: addresses)
+    monkeypatch.setattr(
+        terraform, "tfimport", lambda addr, id, **kwargs: tfimports.append(addr)
+    )
+
+    terraform.import_missing(
+        str(tmp_path), [("a.present", "present"), ("a.missing", "missing")]
+    )
+    assert tfimports == imported
+    if addresses:
+        assert "skipped 1 of 2 addresses" in capsys.readouterr().out
+    assert terraform.average_import_duration() < 15.0
+
+
+def test_terraform_progress(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    resource = {"addr": "helm_release.jupyterhub", "resource_type": "helm_release"}
+    events = [
+        {"type": "version", "@message": "Terraform 1.0.5"},
+        {
+            "type": "apply_start",
+            "@message": "helm_release.jupyterhub: Creating...",
+            "hook": {"resource": resource, "action": "create"},
+        },
+        {
+            "type": "apply_complete",
+            "@message": "helm_release.jupyterhub: Creation complete after 42s",
+            "hook": {"resource": resource, "action": "create", "elapsed_seconds": 42},
+        },
+        {
+            "type": "diagnostic",
+            "@message": "Warning: deprecated",
+            "diagnostic": {
+                "severity": "warning",
+                "summary": "deprecated",
+                "detail": "use x",
+            },
+        },
+        {"type": "change_summary", "changes": {"add": 1, "change": 0, "remove": 0}},
+    ]
+
+    with terraform_progress.terraform_progress(
+        "stages/07-kubernetes-services", "apply"
+    ) as line_handler:
+        lines = [line_handler(json.dumps(_).encode("utf-8")) for _ in events]
+        assert line_handler(b"plain text\n") == b"plain text\n"
+
+    assert lines[1] == b"helm_release.jupyterhub: Creating...\n"
+    assert lines[3] == b"Warning: deprecated\nuse x\n"
+    assert "42.0 [s] helm_release.jupyterhub (create)" in capsys.readouterr().out
+
+    with open(
+        terraform_progress.timings_path("stages/07-kubernetes-services", "apply")
+    ) as f:
+        report = json.load(f)
+    assert report["changes"]["add"] == 1
+    assert report["resources"][0]["address"] == "helm_release.jupyterhub"
+    assert report["resources"][0]["duration"] == 42
+    assert report["diagnostics"][0]["summary"] == "deprecated"
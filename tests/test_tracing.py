@@ -0,0 +1,88 @@
+import json
+import logging
+
+import pytest
+
+from qhub.stages.scheduler import Scheduler
+from qhub.tracing import STATUS_CODE_ERROR, STATUS_CODE_OK, span, trace
+from qhub.utils import timer
+
+logger = logging.getLogger(__name__)
+
+
+def load_spans(filename):
+    with open(filename) as f:
+        resource_spans = json.load(f)["resourceSpans"]
+    spans = resource_spans[0]["scopeSpans"][0]["spans"]
+    return {_["name"]: _ for _ in spans}
+
+
+def attributes(_span):
+    return {_["key"]: list(_["value"].values())[0] for _ in _span["attributes"]}
+
+
+def test_trace(tmp_path):
+    filename = tmp_path / "trace.json"
+
+    with span("outside"):
+        pass
+
+    with pytest.raises(SystemExit):
+        with trace("deploy", str(filename)):
+            with timer(logger, "terraform apply", directory="stages/02"):
+                with span("terraform apply subprocess") as _span:
+                    _span.set_attribute("exit_code", 0)
+            with span("check attempt", attempt=1):
+                raise SystemExit(1)
+
+    spans = load_spans(filename)
+    assert set(spans) == {
+        "qhub deploy",
+        "terraform apply",
+        "terraform apply subprocess",
+        "check attempt",
+    }
+    assert len({_["traceId"] for _ in spans.values()}) == 1
+
+    root = spans["qhub deploy"]
+    assert "parentSpanId" not in root
+    assert root["status"]["code"] == STATUS_CODE_ERROR
+    assert spans["terraform apply"]["parentSpanId"] == root["spanId"]
+    assert (
+        spans["terraform apply subprocess"]["parentSpanId"]
+        == spans["terraform apply"]["spanId"]
+    )
+    assert attributes(spans["terraform apply"]) == {"directory": "stages/02"}
+    assert attributes(spans["terraform apply subprocess"]) == {"exit_code": "0"}
+    assert spans["terraform apply"]["status"]["code"] == STATUS_CODE_OK
+    assert spans["check attempt"]["status"] == {
+        "code": STATUS_CODE_ERROR,
+        "message": "exit code 1",
+    }
+
+
+def test_trace_scheduler_tasks(tmp_path):
+    filename = tmp_path / "trace.json"
+
+    def task():
+        with span("work"):
+            pass
+
+    with trace("deploy", str(filename)):
+        with span("stages"):
+            scheduler = Scheduler(max_workers=2)
+            scheduler.add("a", task)
+            scheduler.run()
+
+    spans = load_spans(filename)
+    # tasks run on worker threads continue the trace of the scheduler
+    assert spans["task a"]["parentSpanId"] == spans["stages"]["spanId"]
+    assert spans["work"]["parentSpanId"] == spans["task a"]["spanId"]
+
+
+def test_trace_disabled(monkeypatch):
+    monkeypatch.delenv("QHUB_TRACE_FILE", raising=False)
+    with trace("deploy") as tracer:
+        with span("work") as _span:
+            _span.set_attribute("key", "value")
+    assert tracer is None